@@ -0,0 +1,29 @@
+import os
+import argparse
+from nanovllm import LLM, SamplingParams
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stream a JSONL/Parquet file of prompts through nano-vllm.")
+    parser.add_argument("input", help="records with prompt, prompt_token_ids or title/body, plus optional SamplingParams fields")
+    parser.add_argument("output", help="JSONL completions, appended in completion order")
+    parser.add_argument("--model", default=os.path.expanduser("~/huggingface/Qwen3-0.6B/"))
+    parser.add_argument("--checkpoint", help="resume state, defaults to OUTPUT.ckpt")
+    parser.add_argument("--queue-depth", type=int, default=1024)
+    parser.add_argument("--temperature", type=float, default=0.6)
+    parser.add_argument("--max-tokens", type=int, default=256)
+    parser.add_argument("--tensor-parallel-size", type=int, default=1)
+    parser.add_argument("--pipeline-parallel-size", type=int, default=1)
+    parser.add_argument("--enforce-eager", action="store_true")
+    args = parser.parse_args()
+
+    llm = LLM(args.model, enforce_eager=args.enforce_eager, tensor_parallel_size=args.tensor_parallel_size,
+              pipeline_parallel_size=args.pipeline_parallel_size)
+    sampling_params = SamplingParams(temperature=args.temperature, max_tokens=args.max_tokens)
+    num_written = llm.generate_file(args.input, args.output, sampling_params, args.queue_depth,
+                                    args.checkpoint or args.output + ".ckpt")
+    print(f"Wrote {num_written} completions to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
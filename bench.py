@@ -1,74 +1,78 @@
 import os
-import time
-from random import randint, seed
-from nanovllm import LLM, SamplingParams
+import json
+import argparse
+from transformers import Qwen3Config
+from nanovllm import LLM
+from nanovllm.config import Config
+from nanovllm.engine.mock_model_runner import MockLLMEngine
+from nanovllm.utils.cudagraph import default_capture_sizes, padding_cost, tune_capture_sizes
+from nanovllm.utils.workload import add_workload_args, build_requests, replay, summarize, print_summary
 # from vllm import LLM, SamplingParams
 
 
-def main():
-    BENCH_PREFIX_SHARING = True
-    block_size = 256
-    min_input_len = block_size * 2  # 確保總長度足夠
-    shared_prefix_len = block_size  # 每個 prefix 共享一個完整 block
-
-    seed(0)
-    num_seqs = 256
-    max_input_len = 1024
-    max_output_len = 1024  # 修正 typo: ouput → output
-
-    path = os.path.expanduser("~/huggingface/Qwen3-0.6B/")
-    llm = LLM(path, enforce_eager=False, max_model_len=4096)
+def parse_args():
+    parser = argparse.ArgumentParser(description="Replay a workload through nano-vllm and report serving metrics.")
+    parser.add_argument("--model", default=os.path.expanduser("~/huggingface/Qwen3-0.6B/"))
+    add_workload_args(parser)
+    parser.add_argument("--mock", action="store_true", help="random tokens instead of a model, to benchmark the scheduler on CPU")
+    parser.add_argument("--num-kvcache-blocks", type=int, default=-1)
+    parser.add_argument("--kvcache-block-size", type=int, default=256)
+    parser.add_argument("--max-num-seqs", type=int, default=512)
+    parser.add_argument("--max-num-batched-tokens", type=int, default=16384)
+    parser.add_argument("--max-model-len", type=int, default=4096)
+    parser.add_argument("--enforce-eager", action="store_true")
+    parser.add_argument("--cudagraph-capture-sizes", type=int, nargs="+")
+    parser.add_argument("--lazy-cudagraph-capture", action="store_true")
+    parser.add_argument("--tune-capture-sizes", type=int, metavar="MAX_GRAPHS",
+                        help="report the capture sizes that minimize padding for the observed decode batch sizes")
+    parser.add_argument("--attention-backend", default="auto")
+    parser.add_argument("--device", choices=("cuda", "cpu"), default="cuda")
+    parser.add_argument("--output", help="write the results as JSON")
+    return parser.parse_args()
 
-    if not BENCH_PREFIX_SHARING:
-        prompt_token_ids = [[randint(0, 10000) for _ in range(randint(100, max_input_len))] for _ in range(num_seqs)]
-    else:
-        # ====== 關鍵修改：三種不同的 agent prefix ======
-        num_groups = 3
-        # 平均分配序列數量（最後一組補餘數）
-        group_sizes = [num_seqs // num_groups] * num_groups
-        for i in range(num_seqs % num_groups):
-            group_sizes[i] += 1
 
-        # 生成三種不同的共享 prefix（每種長度 = block_size）
-        shared_prefixes = [
-            [randint(0, 10000) for _ in range(shared_prefix_len)]
-            for _ in range(num_groups)
-        ]
+def make_engine(args):
+    kwargs = dict(
+        kvcache_block_size=args.kvcache_block_size,
+        max_num_seqs=args.max_num_seqs,
+        max_num_batched_tokens=args.max_num_batched_tokens,
+        max_model_len=args.max_model_len,
+        cudagraph_capture_sizes=args.cudagraph_capture_sizes,
+        lazy_cudagraph_capture=args.lazy_cudagraph_capture,
+        attention_backend=args.attention_backend if not args.mock else "sdpa",    # no kernel runs, only block alignment matters
+    )
+    if not args.mock:
+        if args.num_kvcache_blocks > 0:
+            kwargs["num_kvcache_blocks"] = args.num_kvcache_blocks
+        return LLM(args.model, enforce_eager=args.enforce_eager, device=args.device, **kwargs)
+    num_blocks = args.num_kvcache_blocks if args.num_kvcache_blocks > 0 else 1024
+    if os.path.isdir(args.model):
+        from transformers import AutoTokenizer
+        config = Config(args.model, num_kvcache_blocks=num_blocks, **kwargs)
+        return MockLLMEngine(config, AutoTokenizer.from_pretrained(args.model, use_fast=True))
+    config = Config(args.model, hf_config=Qwen3Config(), num_kvcache_blocks=num_blocks, **kwargs)
+    return MockLLMEngine(config)
 
-        prompt_token_ids = []
-        for group_id in range(num_groups):
-            prefix = shared_prefixes[group_id]
-            group_size = group_sizes[group_id]
-            for _ in range(group_size):
-                unique_part_len = randint(
-                    min_input_len - shared_prefix_len,
-                    max_input_len - shared_prefix_len
-                )
-                unique_part = [randint(0, 10000) for _ in range(unique_part_len)]
-                prompt_token_ids.append(prefix + unique_part)
-        # ==============================================
 
-    sampling_params = [
-        SamplingParams(temperature=0.6, ignore_eos=True, max_tokens=randint(100, max_output_len))
-        for _ in range(num_seqs)
-    ]
-
-    print('{' + f'"num_seqs": {num_seqs}' + '}')
-    t = time.time()
-    llm.generate(prompt_token_ids, sampling_params, use_tqdm=False)
-    t = (time.time() - t)
-    total_tokens = sum(sp.max_tokens for sp in sampling_params)
-    throughput = total_tokens / t
-    print(f"Total: {total_tokens}tok, Time: {t:.2f}s, Throughput: {throughput:.2f}tok/s")
+def main():
+    args = parse_args()
+    requests = build_requests(args)
+    llm = make_engine(args)
+    seqs, duration = replay(llm, requests)
+    results = summarize(seqs, duration, llm.get_stats())
+    results["config"] = vars(args)
 
-    # again test
-    print('{' + f'"num_seqs": {num_seqs}' + '}')
-    t = time.time()
-    llm.generate(prompt_token_ids, sampling_params, use_tqdm=False)
-    t = (time.time() - t)
-    total_tokens = sum(sp.max_tokens for sp in sampling_params)
-    throughput = total_tokens / t
-    print(f"Total: {total_tokens}tok, Time: {t:.2f}s, Throughput: {throughput:.2f}tok/s")
+    print_summary(results)
+    if args.tune_capture_sizes:
+        histogram = llm.get_batch_size_histogram()
+        current = args.cudagraph_capture_sizes or default_capture_sizes(min(args.max_num_seqs, 512))
+        tuned = tune_capture_sizes(histogram, args.tune_capture_sizes)
+        results["tuned_capture_sizes"] = tuned
+        print(f"Capture sizes: {current}, padded slots: {padding_cost(current, histogram)}")
+        print(f"Tuned capture sizes: {tuned}, padded slots: {padding_cost(tuned, histogram)}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,89 @@
+import json
+import argparse
+from time import perf_counter
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+from nanovllm.utils.parallel_state import init_parallel_state
+from nanovllm.layers.linear import RowParallelLinear
+from nanovllm.layers.embed_head import VocabParallelEmbedding
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Time tensor parallel all-reduces with and without chunked compute-communication overlap.")
+    parser.add_argument("--device", choices=("cuda", "cpu"), default="cpu", help="cpu runs on gloo, cuda on nccl")
+    parser.add_argument("--tensor-parallel-sizes", type=int, nargs="+", default=[2, 4])
+    parser.add_argument("--comm-overlap-chunks", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--num-tokens", type=int, nargs="+", default=[64, 1024])
+    parser.add_argument("--hidden-size", type=int, default=1024)
+    parser.add_argument("--intermediate-size", type=int, default=3072)
+    parser.add_argument("--vocab-size", type=int, default=32768)
+    parser.add_argument("--iters", type=int, default=20)
+    parser.add_argument("--output", help="write the results as JSON")
+    return parser.parse_args()
+
+
+def timed(fn, args, device):
+    for _ in range(3):
+        fn()
+    if device == "cuda":
+        torch.cuda.synchronize()
+    dist.barrier()
+    t = perf_counter()
+    for _ in range(args.iters):
+        fn()
+    if device == "cuda":
+        torch.cuda.synchronize()
+    return (perf_counter() - t) / args.iters
+
+
+@torch.inference_mode()
+def worker(rank, tp_size, args, results):
+    device = args.device
+    dist.init_process_group("nccl" if device == "cuda" else "gloo", "tcp://localhost:2334", world_size=tp_size, rank=rank)
+    if device == "cuda":
+        torch.cuda.set_device(rank)
+    torch.set_default_device(device)
+    torch.manual_seed(0)
+    init_parallel_state(tp_size, 1)
+    down_proj = RowParallelLinear(args.intermediate_size, args.hidden_size)
+    down_proj.weight_loader(down_proj.weight, torch.randn(args.hidden_size, args.intermediate_size) / args.intermediate_size ** 0.5)
+    embed = VocabParallelEmbedding(args.vocab_size, args.hidden_size)
+    embed.weight_loader(embed.weight, torch.randn(args.vocab_size, args.hidden_size))
+    for num_tokens in args.num_tokens:
+        x = torch.randn(num_tokens, args.intermediate_size)[:, rank * down_proj.weight.size(1):(rank + 1) * down_proj.weight.size(1)]
+        x = x.contiguous()
+        input_ids = torch.randint(0, args.vocab_size, (num_tokens,))
+        init_parallel_state(tp_size, 1)
+        reference = down_proj(x), embed(input_ids)
+        for num_chunks in args.comm_overlap_chunks:
+            init_parallel_state(tp_size, 1, num_chunks)
+            # chunking only splits rows, so it must match the unchunked outputs
+            torch.testing.assert_close(down_proj(x), reference[0])
+            torch.testing.assert_close(embed(input_ids), reference[1])
+            error = max((down_proj(x) - reference[0]).abs().max().item(), (embed(input_ids) - reference[1]).abs().max().item())
+            result = dict(tensor_parallel_size=tp_size, num_tokens=num_tokens, comm_overlap_chunks=num_chunks,
+                          row_parallel_ms=timed(lambda: down_proj(x), args, device) * 1e3,
+                          embedding_ms=timed(lambda: embed(input_ids), args, device) * 1e3,
+                          max_abs_error=error)
+            if rank == 0:
+                results.append(result)
+    dist.destroy_process_group()
+
+
+def main():
+    args = parse_args()
+    results = mp.Manager().list()
+    for tp_size in args.tensor_parallel_sizes:
+        mp.spawn(worker, (tp_size, args, results), nprocs=tp_size)
+    print(f"{'tp':>3} {'tokens':>7} {'chunks':>7} {'row_parallel':>13} {'embedding':>10} {'max_abs_error':>14}")
+    for r in results:
+        print(f"{r['tensor_parallel_size']:>3} {r['num_tokens']:>7} {r['comm_overlap_chunks']:>7} "
+              f"{r['row_parallel_ms']:>11.3f}ms {r['embedding_ms']:>8.3f}ms {r['max_abs_error']:>14.2e}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(list(results), f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
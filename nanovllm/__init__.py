@@ -1,2 +1,2 @@
-from nanovllm.llm import LLM
+from nanovllm.llm import LLM, DataParallelLLM
 from nanovllm.sampling_params import SamplingParams
@@ -2,6 +2,10 @@ import os
 from dataclasses import dataclass
 from transformers import AutoConfig
 
+from nanovllm.utils.profiling import parse_profile_steps
+from nanovllm.utils.memory_profiler import Workload
+from nanovllm.layers.rotary_embedding import get_rope_parameters, scaled_max_position
+
 
 @dataclass
 class Config:
@@ -11,22 +15,74 @@ class Config:
     max_model_len: int = 4096
     gpu_memory_utilization: float = 0.5
     tensor_parallel_size: int = 1
+    pipeline_parallel_size: int = 1
+    num_micro_batches: int | None = None
+    data_parallel_rank: int = 0
+    vocab_parallel_sampling: bool = True
+    comm_overlap_chunks: int = 1
     enforce_eager: bool = False
     hf_config: AutoConfig | None = None
     eos: int = -1
     kvcache_block_size: int = 256
     num_kvcache_blocks: int = -1
-
-    # print?
-    DEBUG_SCHEDULER = True  # ← 控制排程器 debug
-    DEBUG_BLOCK_MANAGER = True
-    DEBUG_PREEMPT = True
-    DEBUG_BLOCK_MANAGER_LV2 = False
+    device: str = "cuda"
+    attention_backend: str = "auto"
+    kv_cache_profiling: str = "warmup"
+    profile_workload: Workload | None = None
+    cudagraph_capture_sizes: list[int] | None = None
+    lazy_cudagraph_capture: bool = False
+    trace_file: str | None = None
+    trace_buffer_size: int = 65536
+    metrics_port: int | None = None
+    profile_steps: list[int] | None = None
+    profile_dir: str = "profiles"
+    host_kv_cache_blocks: int = 0
+    disk_kv_cache_blocks: int = 0
+    disk_kv_cache_dir: str | None = None
+    pinned_prefixes: list[list[int]] | None = None
+    pinned_prefix_cache_dir: str | None = None
+    preemption_policy: str = "lifo"
+    tenant_weights: dict[str, float] | None = None
+    tenant_max_kv_blocks: dict[str, int] | None = None
+    tokenizer_batch_size: int = 1024
+    tokenizer_processes: int = 0
+    lora_adapters: dict[str, str] | None = None
+    max_loras: int = 4
+    max_lora_rank: int = 16
 
     def __post_init__(self):
-        assert os.path.isdir(self.model)
-        assert self.kvcache_block_size % 256 == 0
-        assert 1 <= self.tensor_parallel_size <= 8
-        self.hf_config = AutoConfig.from_pretrained(self.model)
-        self.max_model_len = min(self.max_model_len, self.hf_config.max_position_embeddings)
+        if self.attention_backend in ("sdpa", "triton", "flashinfer"):
+            assert self.kvcache_block_size % 16 == 0
+        else:
+            assert self.kvcache_block_size % 256 == 0
+        assert self.kv_cache_profiling in ("warmup", "analytical")
+        if self.cudagraph_capture_sizes is not None:
+            self.cudagraph_capture_sizes = sorted(set(self.cudagraph_capture_sizes))
+            assert self.cudagraph_capture_sizes and 1 <= self.cudagraph_capture_sizes[0]
+        if self.profile_steps is None and os.environ.get("NANOVLLM_PROFILE_STEPS"):
+            self.profile_steps = parse_profile_steps(os.environ["NANOVLLM_PROFILE_STEPS"])
+        if self.profile_steps is not None:
+            self.profile_steps = sorted(set(self.profile_steps))
+        assert self.preemption_policy in ("lifo", "priority", "fewest_computed", "most_freed")
+        assert self.host_kv_cache_blocks >= 0 and self.disk_kv_cache_blocks >= 0
+        assert 1 <= self.tensor_parallel_size * self.pipeline_parallel_size <= 8
+        assert self.comm_overlap_chunks >= 1
+        assert self.max_loras >= 1 and self.max_lora_rank >= 1
+        if self.num_micro_batches is None:
+            self.num_micro_batches = self.pipeline_parallel_size
+        assert self.device in ("cuda", "cpu")
+        if self.device == "cpu":
+            self.enforce_eager = True
+        if self.hf_config is None:
+            assert os.path.isdir(self.model)
+            self.hf_config = AutoConfig.from_pretrained(self.model)
+        assert self.hf_config.num_hidden_layers >= self.pipeline_parallel_size
+        _, rope_scaling = get_rope_parameters(self.hf_config)
+        max_position = scaled_max_position(self.hf_config.max_position_embeddings, rope_scaling)
+        self.max_model_len = min(self.max_model_len, max_position)
+        sliding_window = getattr(self.hf_config, "sliding_window", None)
+        if sliding_window and getattr(self.hf_config, "use_sliding_window", True):
+            # attention is not limited to the model's window, which is only exact for contexts that fit in it
+            assert self.max_model_len <= sliding_window, \
+                f"max_model_len {self.max_model_len} exceeds the model's sliding window, pass max_model_len <= {sliding_window}"
         assert self.max_num_batched_tokens >= self.max_model_len
@@ -1,9 +1,10 @@
-from collections import deque
+from collections import Counter, deque
 import xxhash
 import numpy as np
 
 from nanovllm.engine.sequence import Sequence
-from nanovllm.config import Config
+from nanovllm.engine.kv_cache_tiers import TierIndex
+from nanovllm.utils.tracing import tracer, AllocateEvent, CacheHitEvent, FreeEvent
 
 class Block:
 
@@ -25,12 +26,20 @@ class Block:
 
 class BlockManager:
 
-    def __init__(self, num_blocks: int, block_size: int):
+    def __init__(self, num_blocks: int, block_size: int, num_host_blocks: int = 0, num_disk_blocks: int = 0,
+                 tenant_max_blocks: dict[str, int] | None = None):
         self.block_size = block_size
         self.blocks: list[Block] = [Block(i) for i in range(num_blocks)]
         self.hash_to_block_id: dict[int, int] = dict()
         self.free_block_ids: deque[int] = deque(range(num_blocks))
         self.used_block_ids: set[int] = set()
+        self.num_cache_queries = 0
+        self.num_cache_hits = 0
+        self.tiers = TierIndex(num_host_blocks, num_disk_blocks) if num_host_blocks or num_disk_blocks else None
+        self.kv_transfers: list[tuple[str, int, int]] = []
+        self.num_tier_hits = 0
+        self.tenant_max_blocks = tenant_max_blocks or {}
+        self.tenant_blocks: Counter[str] = Counter()    # block table entries, shared blocks count for every sequence
 
     @classmethod
     def compute_hash(cls, token_ids: list[int], prefix: int = -1):
@@ -40,6 +49,18 @@ class BlockManager:
         h.update(np.array(token_ids).tobytes())
         return h.intdigest()
 
+    @classmethod
+    def hash_seed(cls, lora_id: str | None, sliding_window: int | None = None, num_sink_tokens: int = 0) -> int:
+        # the hash chain of an adapter's or a windowed sequence's blocks starts from the adapter id and the
+        # window, so only blocks computed with the same adapter and attending over the same window are shared
+        if lora_id is None and sliding_window is None:
+            return -1
+        return xxhash.xxh64(f"{lora_id}/{sliding_window}/{num_sink_tokens}".encode()).intdigest()
+
+    @classmethod
+    def seq_hash_seed(cls, seq: Sequence) -> int:
+        return cls.hash_seed(seq.lora_id, seq.sliding_window, seq.num_sink_tokens)
+
     def _allocate_block(self, block_id: int) -> Block:
         block = self.blocks[block_id]
         assert block.ref_count == 0
@@ -48,79 +69,70 @@ class BlockManager:
         self.used_block_ids.add(block_id)
         return self.blocks[block_id]
 
+    def _allocate_free_block(self) -> Block:
+        # the block may still hold a cached prefix block, evict it to the host/disk tiers first
+        block = self.blocks[self.free_block_ids[0]]
+        if block.hash != -1:
+            if self.hash_to_block_id.get(block.hash) == block.block_id:
+                del self.hash_to_block_id[block.hash]
+            if self.tiers is not None:
+                self.kv_transfers.extend(self.tiers.offload(block.hash, block.token_ids, block.block_id))
+        return self._allocate_block(block.block_id)
+
     def _deallocate_block(self, block_id: int) -> Block:
         assert self.blocks[block_id].ref_count == 0
         self.used_block_ids.remove(block_id)
         self.free_block_ids.append(block_id)
 
+    def tenant_has_room(self, seq: Sequence, num_blocks: int) -> bool:
+        cap = self.tenant_max_blocks.get(seq.tenant)
+        return cap is None or self.tenant_blocks[seq.tenant] + num_blocks <= cap
+
     def can_allocate(self, seq: Sequence) -> bool:
-        return len(self.free_block_ids) >= seq.num_blocks
+        return len(self.free_block_ids) >= seq.num_resident_blocks and self.tenant_has_room(seq, seq.num_resident_blocks)
 
     def allocate(self, seq: Sequence):
         assert not seq.block_table
-        h = -1
+        h = self.seq_hash_seed(seq)
         cache_miss = False
-
-        # 🟢 新增：印出開始分配
-        if Config.DEBUG_BLOCK_MANAGER_LV2:
-            print(f"[DEBUG] Allocating for seq {seq.seq_id}, total blocks: {seq.num_blocks}, prompt_len={len(seq)}")
-
         for i in range(seq.num_blocks):
             token_ids = seq.block(i)
             h = self.compute_hash(token_ids, h) if len(token_ids) == self.block_size else -1
-
-            # 🟢 新增：印出當前 block 的 tokens 和 hash
-            if Config.DEBUG_BLOCK_MANAGER_LV2:
-                print(f"  [Block {i}] tokens: {token_ids[:4]}... (len={len(token_ids)}), hash: {h}")
-
+            if seq.is_dropped_block(i):    # out of the window of a preempted sequence, only chained through
+                continue
+            if seq.pooling is not None and (i + 1) * self.block_size > seq.output_start:
+                cache_miss = True    # the hidden states of these positions are needed, so they are recomputed
             block_id = self.hash_to_block_id.get(h, -1)
-
-            # 🟢 新增：印出是否找到 hash 對應的 block_id
-            if Config.DEBUG_BLOCK_MANAGER_LV2:
-                print(f"    → hash_to_block_id.get({h}) = {block_id}")
-
-            if block_id == -1 or self.blocks[block_id].token_ids != token_ids:
-                cache_miss = True
-
-                # 🟢 新增：印出 cache miss 原因
-                if Config.DEBUG_BLOCK_MANAGER_LV2:
-                    reason = "block_id == -1" if block_id == -1 else "token_ids mismatch"
-                    print(f"    ❌ CACHE MISS (reason: {reason}) → will allocate new block")
-
-            if cache_miss:
-                block_id = self.free_block_ids[0]
-                block = self._allocate_block(block_id)
-
-                # 🟢 新增：印出新分配的 block_id
-                if Config.DEBUG_BLOCK_MANAGER_LV2:
-                    print(f"    ➤ Allocated NEW block_id: {block_id}")
-            else:
+            block = None
+            if cache_miss or block_id == -1 or self.blocks[block_id].token_ids != token_ids:
+                block = self._allocate_free_block()
+                block_id = block.block_id
+                location = self.tiers.lookup(h, token_ids) if self.tiers is not None and h != -1 and not cache_miss else None
+                if location is None:
+                    cache_miss = True
+                else:
+                    self.kv_transfers.append(self.tiers.load_op(location, block_id))
+                    seq.num_cached_tokens += self.block_size
+                    self.num_tier_hits += 1
+            if h != -1:
+                self.num_cache_queries += 1
+                self.num_cache_hits += not cache_miss
+            if block is None:
                 seq.num_cached_tokens += self.block_size
-
-                # 🟢 新增：印出命中快取
-                if Config.DEBUG_BLOCK_MANAGER_LV2:
-                    print(f"    ✅ CACHE HIT → reusing block_id: {block_id}, num_cached_tokens now: {seq.num_cached_tokens}")
-
+                if tracer.enabled:
+                    tracer.emit(CacheHitEvent(seq.seq_id, block_id))
                 if block_id in self.used_block_ids:
                     block = self.blocks[block_id]
                     block.ref_count += 1
                 else:
                     block = self._allocate_block(block_id)
-
             if h != -1:
                 block.update(h, token_ids)
                 self.hash_to_block_id[h] = block_id
-
-                # 🟢 新增：印出 hash 映射更新
-                if Config.DEBUG_BLOCK_MANAGER_LV2:
-                    print(f"    ➤ Updated hash {h} → block_id {block_id}")
-
             seq.block_table.append(block_id)
-
-        # 🟢 新增：印出分配完成結果
-        if Config.DEBUG_BLOCK_MANAGER_LV2:
-            print(f"[DEBUG] ✅ Finished allocating seq {seq.seq_id}: "
-                  f"num_cached_tokens={seq.num_cached_tokens}, block_table={seq.block_table}")
+        self.tenant_blocks[seq.tenant] += len(seq.block_table)
+        if tracer.enabled:
+            tracer.emit(AllocateEvent(seq.seq_id, list(seq.block_table), seq.num_cached_tokens))
 
     def deallocate(self, seq: Sequence):
         for block_id in reversed(seq.block_table):
@@ -128,64 +140,51 @@ class BlockManager:
             block.ref_count -= 1
             if block.ref_count == 0:
                 self._deallocate_block(block_id)
-            if Config.DEBUG_BLOCK_MANAGER:
-                print(f"  [FREE] block {block_id} from seq {seq.seq_id}")
+        self.tenant_blocks[seq.tenant] -= len(seq.block_table)
+        if tracer.enabled:
+            tracer.emit(FreeEvent(seq.seq_id, list(seq.block_table)))
         seq.num_cached_tokens = 0
+        # a preempted windowed sequence is prefilled again over its sinks and window only
+        seq.num_dropped_blocks = self.num_out_of_window_blocks(seq) if seq.sliding_window is not None else 0
         seq.block_table.clear()
 
+    def num_out_of_window_blocks(self, seq: Sequence) -> int:
+        # keep the sink blocks, the blocks overlapping the window and always the previous block,
+        # whose hash the next full block chains from
+        first_window_block = min((len(seq) - seq.sliding_window) // self.block_size, seq.num_blocks - 2)
+        return max(first_window_block - seq.num_sink_blocks, 0)
+
+    def release_out_of_window(self, seq: Sequence):
+        while seq.num_dropped_blocks < self.num_out_of_window_blocks(seq):
+            block_id = seq.block_table.pop(seq.num_sink_blocks)
+            block = self.blocks[block_id]
+            block.ref_count -= 1
+            if block.ref_count == 0:
+                self._deallocate_block(block_id)
+            seq.num_dropped_blocks += 1
+            self.tenant_blocks[seq.tenant] -= 1
+            if tracer.enabled:
+                tracer.emit(FreeEvent(seq.seq_id, [block_id]))
+
     def can_append(self, seq: Sequence) -> bool:
-        return len(self.free_block_ids) >= (len(seq) % self.block_size == 1)
+        num_new_blocks = len(seq) % self.block_size == 1
+        return len(self.free_block_ids) >= num_new_blocks and self.tenant_has_room(seq, num_new_blocks)
 
     def may_append(self, seq: Sequence):
         block_table = seq.block_table
         last_block = self.blocks[block_table[-1]]
-
-        # 🟢 新增：印出進入 may_append
-        if Config.DEBUG_BLOCK_MANAGER_LV2:
-            print(f"[DEBUG] may_append for seq {seq.seq_id}, len(seq)={len(seq)}, "
-                  f"last_block_id={last_block.block_id}, last_block.hash={last_block.hash}, "
-                  f"block_table={block_table}")
-
         if len(seq) % self.block_size == 1:
             assert last_block.hash != -1
-
-            # 🟢 新增：印出「需要新 block」的原因
-            if Config.DEBUG_BLOCK_MANAGER_LV2:
-                print(f"  ➤ len(seq) % block_size == 1 → need NEW block for new token")
-
-            block_id = self.free_block_ids[0]
-            self._allocate_block(block_id)
-            block_table.append(block_id)
-
-            # 🟢 新增：印出新分配的 block
-            if Config.DEBUG_BLOCK_MANAGER_LV2:
-                print(f"  ➤ Allocated NEW block_id: {block_id} for seq {seq.seq_id}")
-
+            block_table.append(self._allocate_free_block().block_id)
+            self.tenant_blocks[seq.tenant] += 1
         elif len(seq) % self.block_size == 0:
             assert last_block.hash == -1
-
-            # 🟢 新增：印出「完整 block，準備計算 hash」
-            if Config.DEBUG_BLOCK_MANAGER_LV2:
-                print(f"  ➤ len(seq) % block_size == 0 → block now full, computing hash...")
-
             token_ids = seq.block(seq.num_blocks-1)
-            prefix = self.blocks[block_table[-2]].hash if len(block_table) > 1 else -1
+            prefix = self.blocks[block_table[-2]].hash if len(block_table) > 1 else self.seq_hash_seed(seq)
             h = self.compute_hash(token_ids, prefix)
-
-            # 🟢 新增：印出計算的 hash 和 token_ids
-            if Config.DEBUG_BLOCK_MANAGER_LV2:
-                print(f"    → token_ids[:4]={token_ids[:4]}..., prefix_hash={prefix}, computed_hash={h}")
-
             last_block.update(h, token_ids)
             self.hash_to_block_id[h] = last_block.block_id
-
-            # 🟢 新增：印出 hash 映射更新
-            if Config.DEBUG_BLOCK_MANAGER_LV2:
-                print(f"    ➤ Mapped hash {h} → block_id {last_block.block_id}")
-
         else:
             assert last_block.hash == -1
-
-            # 🟢 新增：印出「partial block，無需動作」
-            if Config.DEBUG_BLOCK_MANAGER_LV2:
-                print(f"  ➤ len(seq) % block_size = {len(seq) % self.block_size} → partial block, no hash update needed")
\ No newline at end of file
+        if seq.sliding_window is not None:
+            self.release_out_of_window(seq)
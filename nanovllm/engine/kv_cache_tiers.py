@@ -0,0 +1,115 @@
+import os
+import json
+from collections import OrderedDict, deque
+import numpy as np
+import torch
+import xxhash
+
+HOST, DISK = "host", "disk"
+
+
+class TierIndex:
+    # LRU index of full blocks evicted from the GPU, keyed by the chained block hash. The host pool keeps
+    # the most recently evicted blocks and spills its oldest to disk, the oldest disk blocks are dropped.
+    # Blocks loaded back stay indexed, so evicting them again costs no copy.
+
+    def __init__(self, num_host_blocks: int, num_disk_blocks: int):
+        self.entries = {HOST: OrderedDict(), DISK: OrderedDict()}    # hash -> (slot, token_ids)
+        self.free_slots = {HOST: deque(range(num_host_blocks)), DISK: deque(range(num_disk_blocks))}
+        self.capacity = {HOST: num_host_blocks, DISK: num_disk_blocks}
+
+    def __len__(self):
+        return len(self.entries[HOST]) + len(self.entries[DISK])
+
+    def lookup(self, h: int, token_ids: list[int]) -> tuple[str, int] | None:
+        for tier in (HOST, DISK):
+            entry = self.entries[tier].get(h)
+            if entry is not None and entry[1] == token_ids:
+                self.entries[tier].move_to_end(h)
+                return tier, entry[0]
+        return None
+
+    def _take_slot(self, tier: str, ops: list):
+        if self.free_slots[tier]:
+            return self.free_slots[tier].popleft()
+        h, (slot, token_ids) = self.entries[tier].popitem(last=False)
+        if tier == HOST and self.capacity[DISK]:
+            disk_slot = self._take_slot(DISK, ops)
+            self.entries[DISK][h] = disk_slot, token_ids
+            ops.append(("host_to_disk", slot, disk_slot))
+        return slot
+
+    def offload(self, h: int, token_ids: list[int], block_id: int) -> list[tuple[str, int, int]]:
+        if self.lookup(h, token_ids) is not None:
+            return []
+        ops = []
+        tier = HOST if self.capacity[HOST] else DISK
+        slot = self._take_slot(tier, ops)
+        self.entries[tier][h] = slot, token_ids
+        ops.append((f"gpu_to_{tier}", block_id, slot))
+        return ops
+
+    @staticmethod
+    def load_op(location: tuple[str, int], block_id: int) -> tuple[str, int, int]:
+        tier, slot = location
+        return f"{tier}_to_gpu", slot, block_id
+
+
+class KVCacheTiers:
+    # host and disk storage of one rank's KV blocks, replays the ops emitted by TierIndex in order
+
+    def __init__(self, kv_cache: torch.Tensor, num_host_blocks: int, num_disk_blocks: int, disk_path: str | None = None):
+        self.kv_cache = kv_cache
+        self.block_shape = kv_cache[:, :, 0].shape
+        self.host = torch.empty((num_host_blocks, *self.block_shape), dtype=kv_cache.dtype, device="cpu",
+                                pin_memory=kv_cache.is_cuda)
+        self.disk = None
+        self.disk_path = disk_path
+        if num_disk_blocks:
+            block_bytes = kv_cache[:, :, 0].numel() * kv_cache.element_size()
+            self.disk = np.memmap(disk_path, np.uint8, "w+", shape=(num_disk_blocks, block_bytes))
+
+    def synchronize(self):
+        if self.kv_cache.is_cuda:
+            torch.cuda.current_stream().synchronize()
+
+    def to_bytes(self, block: torch.Tensor) -> np.ndarray:
+        return block.contiguous().view(-1).view(torch.uint8).numpy()
+
+    def from_bytes(self, data: np.ndarray) -> torch.Tensor:
+        return torch.from_numpy(np.array(data)).view(self.kv_cache.dtype).view(self.block_shape)
+
+    def apply(self, ops: list[tuple[str, int, int]]):
+        kv_cache = self.kv_cache
+        for op, src, dst in ops:
+            if op == "gpu_to_host":
+                self.host[dst].copy_(kv_cache[:, :, src], non_blocking=True)
+            elif op == "gpu_to_disk":
+                self.disk[dst] = self.to_bytes(kv_cache[:, :, src].cpu())
+            elif op == "host_to_disk":
+                self.synchronize()
+                self.disk[dst] = self.to_bytes(self.host[src])
+            elif op == "host_to_gpu":
+                kv_cache[:, :, dst].copy_(self.host[src], non_blocking=True)
+            elif op == "disk_to_gpu":
+                kv_cache[:, :, dst].copy_(self.from_bytes(self.disk[src]))
+            else:
+                raise ValueError(op)
+        self.synchronize()
+
+    def close(self):
+        if self.disk is not None:
+            del self.disk
+            self.disk = None
+            os.remove(self.disk_path)
+
+
+def pinned_prefix_dir(config) -> str:
+    # saved blocks are only valid for the same weights, block size, sharding and dtype
+    key = json.dumps([os.path.abspath(config.model), config.hf_config.to_dict(), config.kvcache_block_size,
+                      config.tensor_parallel_size, config.pipeline_parallel_size], sort_keys=True, default=str)
+    return os.path.join(config.pinned_prefix_cache_dir, xxhash.xxh64(key.encode()).hexdigest())
+
+
+def block_file(directory: str, h: int, rank: int) -> str:
+    return os.path.join(directory, f"{h:016x}.rank{rank}.pt")
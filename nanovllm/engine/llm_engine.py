@@ -1,8 +1,14 @@
+import os
 import atexit
+from collections import deque
+from itertools import islice
+import json
 from dataclasses import fields
 from time import perf_counter
 from tqdm.auto import tqdm
 from transformers import AutoTokenizer
+import torch
+import torch.nn.functional as F
 import torch.multiprocessing as mp
 
 from nanovllm.config import Config
@@ -10,6 +16,13 @@ from nanovllm.sampling_params import SamplingParams
 from nanovllm.engine.sequence import Sequence
 from nanovllm.engine.scheduler import Scheduler
 from nanovllm.engine.model_runner import ModelRunner
+from nanovllm.engine.kv_cache_tiers import pinned_prefix_dir, block_file
+from nanovllm.engine.metrics import EngineStats, StepStats, to_prometheus, start_metrics_server
+from nanovllm.utils.tracing import tracer, InitEvent, StepEvent
+from nanovllm.utils.profiling import profile_range
+from nanovllm.utils.tokenization import TokenizerWorker
+from nanovllm.utils.memory_profiler import profile_cached
+from nanovllm.utils.batch_io import read_records, record_prompt, record_sampling_params, Checkpoint
 
 
 _global_step_counter = 0
@@ -29,22 +42,65 @@ class LLMEngine:
         config_fields = {field.name for field in fields(Config)}
         config_kwargs = {k: v for k, v in kwargs.items() if k in config_fields}
         config = Config(model, **config_kwargs)
+        if config.kv_cache_profiling == "analytical" and config.profile_workload is not None:
+            self.apply_memory_profile(config)
+        Sequence.block_size = config.kvcache_block_size
         self.ps = []
         self.events = []
         ctx = mp.get_context("spawn")
-        for i in range(1, config.tensor_parallel_size):
+        for i in range(1, config.tensor_parallel_size * config.pipeline_parallel_size):
             event = ctx.Event()
             process = ctx.Process(target=ModelRunner, args=(config, i, event))
             process.start()
             self.ps.append(process)
             self.events.append(event)
         self.model_runner = ModelRunner(config, 0, self.events)
-        self.tokenizer = AutoTokenizer.from_pretrained(config.model, use_fast=True)
-        config.eos = self.tokenizer.eos_token_id
-        self.scheduler = Scheduler(config)
+        tokenizer = AutoTokenizer.from_pretrained(config.model, use_fast=True)
+        config.eos = tokenizer.eos_token_id
+        self.init_state(config, tokenizer)
         atexit.register(self.exit)
 
+    @staticmethod
+    def apply_memory_profile(config: Config):
+        # the recommendation is cached on disk, so only the first start for a model, device and workload computes it
+        if config.device == "cuda":
+            total_memory = torch.cuda.mem_get_info()[1]
+        else:
+            total_memory = os.sysconf("SC_PHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+        profile = profile_cached(config.model, config.hf_config, total_memory, config.profile_workload,
+                                 max_model_len=config.max_model_len, gpu_memory_utilization=config.gpu_memory_utilization,
+                                 tensor_parallel_size=config.tensor_parallel_size)
+        config.kvcache_block_size = profile.kvcache_block_size
+        config.max_num_seqs = profile.max_num_seqs
+        config.max_num_batched_tokens = profile.max_num_batched_tokens
+
+    def init_state(self, config: Config, tokenizer):
+        # everything built on top of the model runner, shared with MockLLMEngine
+        self.tokenizer = tokenizer
+        self.tokenizer_worker = TokenizerWorker(tokenizer, config.tokenizer_processes)
+        self.tokenizer_batch_size = config.tokenizer_batch_size
+        self.scheduler = Scheduler(config)
+        self.profile_steps = set(config.profile_steps or ())
+        self.profile_dir = config.profile_dir
+        self.profile_start = None
+        if config.trace_file is not None:
+            tracer.enable(config.trace_file, config.trace_buffer_size)
+            tracer.emit(InitEvent(config.num_kvcache_blocks, config.kvcache_block_size))
+        self.pinned_seqs = []
+        if config.pinned_prefixes:
+            self.pin_prefixes(config)
+        self.stats = EngineStats()
+        self.metrics_server = start_metrics_server(self.get_prometheus_metrics, config.metrics_port) if config.metrics_port else None
+
     def exit(self):
+        atexit.unregister(self.exit)
+        tracer.flush()
+        self.tokenizer_worker.shutdown()
+        if self.profile_start is not None:
+            self.model_runner.call("stop_profile", f"steps_{self.profile_start}-{self.stats.num_steps - 1}")
+            self.profile_start = None
+        if self.metrics_server is not None:
+            self.metrics_server.shutdown()
         self.model_runner.call("exit")
         del self.model_runner
         for p in self.ps:
@@ -55,17 +111,97 @@ class LLMEngine:
             prompt = self.tokenizer.encode(prompt)
         seq = Sequence(prompt, sampling_params)
         self.scheduler.add(seq)
+        return seq
 
     def step(self):
-        print("-" * 20 + f" step{get_global_step()}")
+        tracer.step = get_global_step()
         increment_global_step()
-        seqs, is_prefill = self.scheduler.schedule()
+        step = self.stats.num_steps
+        if step in self.profile_steps and self.profile_start is None:
+            self.profile_start = step
+            self.model_runner.call("start_profile")
+        t0 = perf_counter()
+        with profile_range("schedule"):
+            seqs, is_prefill = self.scheduler.schedule()
+        if tracer.enabled:
+            tracer.emit(StepEvent(is_prefill, {seq.seq_id: list(seq.block_table) for seq in self.scheduler.running}))
+        num_prefill_tokens = sum(seq.num_uncached_tokens for seq in seqs) if is_prefill else 0
+        num_decode_tokens = 0 if is_prefill else len(seqs)
+        self.transfer_kv()
+        t1 = perf_counter()
         token_ids = self.model_runner.call("run", seqs, is_prefill)
-        self.scheduler.postprocess(seqs, token_ids)
-        outputs = [(seq.seq_id, seq.completion_token_ids) for seq in seqs if seq.is_finished]
+        t2 = perf_counter()
+        with profile_range("postprocess"):
+            self.scheduler.postprocess(seqs, token_ids)
+        prepare_time, forward_time, sample_time = self.model_runner.timings
+        self.stats.record_step(StepStats(is_prefill, len(seqs), num_prefill_tokens, num_decode_tokens, t1 - t0,
+                                         prepare_time, forward_time, sample_time, perf_counter() - t2))
+        outputs = [(seq.seq_id, seq.completion_token_ids, seq.metrics) for seq in seqs if seq.is_finished]
+        for _, _, metrics in outputs:
+            self.stats.record_finished(metrics)
+        if self.profile_start is not None and step + 1 not in self.profile_steps:
+            self.model_runner.call("stop_profile", f"steps_{self.profile_start}-{step}")
+            self.profile_start = None
         num_tokens = sum(len(seq) for seq in seqs) if is_prefill else -len(seqs)
         return outputs, num_tokens
 
+    def transfer_kv(self):
+        block_manager = self.scheduler.block_manager
+        if block_manager.kv_transfers:
+            with profile_range("transfer_kv"):
+                self.model_runner.call("transfer_kv", block_manager.kv_transfers)
+            block_manager.kv_transfers = []
+
+    def pin_prefixes(self, config: Config):
+        # prefill the full blocks of each prefix once and keep the sequences allocated, so their blocks
+        # stay referenced and are never evicted; blocks saved by a previous run are loaded instead
+        block_manager = self.scheduler.block_manager
+        block_size = config.kvcache_block_size
+        directory = pinned_prefix_dir(config) if config.pinned_prefix_cache_dir else None
+        seqs = [Sequence(prefix[:len(prefix) // block_size * block_size]) for prefix in config.pinned_prefixes if len(prefix) >= block_size]
+        assert sum(seq.num_blocks for seq in seqs) <= len(block_manager.free_block_ids), "pinned prefixes do not fit in the KV cache"
+        restored = []
+        for seq in seqs:
+            assert len(seq) <= config.max_model_len
+            block_manager.allocate(seq)
+            while directory is not None and seq.num_cached_blocks < seq.num_blocks:
+                h = block_manager.blocks[seq.block_table[seq.num_cached_blocks]].hash
+                num_ranks = config.tensor_parallel_size * config.pipeline_parallel_size
+                if not all(os.path.exists(block_file(directory, h, rank)) for rank in range(num_ranks)):
+                    break
+                restored.append((h, seq.block_table[seq.num_cached_blocks]))
+                seq.num_cached_tokens += block_size
+        self.transfer_kv()
+        if restored:
+            self.model_runner.call("load_kv_blocks", directory, restored)
+        batch = []
+        num_batched_tokens = 0
+        for seq in [seq for seq in seqs if seq.num_cached_tokens < len(seq)] + [None]:
+            if batch and (seq is None or num_batched_tokens + len(seq) > config.max_num_batched_tokens):
+                self.model_runner.call("run", batch, True)
+                if directory is not None:
+                    restored_ids = {block_id for _, block_id in restored}
+                    self.model_runner.call("save_kv_blocks", directory, [
+                        (block_manager.blocks[block_id].hash, block_id)
+                        for s in batch for block_id in s.block_table[s.num_cached_blocks:] if block_id not in restored_ids
+                    ])
+                batch = []
+                num_batched_tokens = 0
+            if seq is not None:
+                batch.append(seq)
+                num_batched_tokens += len(seq) - seq.num_cached_tokens
+        self.pinned_seqs = seqs
+
+    def get_stats(self) -> dict:
+        return self.stats.snapshot(self.scheduler)
+
+    def get_batch_size_histogram(self) -> dict[int, int]:
+        # decode batch sizes seen by rank 0, to tune cudagraph_capture_sizes with tune_capture_sizes
+        return dict(self.model_runner.batch_size_histogram)
+
+    def get_prometheus_metrics(self) -> str:
+        return to_prometheus(self.get_stats())
+
     def is_finished(self):
         return self.scheduler.is_finished()
 
@@ -79,11 +215,22 @@ class LLMEngine:
             pbar = tqdm(total=len(prompts), desc="Generating", dynamic_ncols=True)
         if not isinstance(sampling_params, list):
             sampling_params = [sampling_params] * len(prompts)
-        for prompt, sp in zip(prompts, sampling_params):
-            self.add_request(prompt, sp)
+        # prompts are encoded in chunks on the tokenizer worker, and each chunk is added as soon as it is ready
+        # so prefill starts before the whole input is tokenized
+        batch_size = self.tokenizer_batch_size
+        chunks = deque()
+        num_submitted = num_added = 0
         outputs = {}
         prefill_throughput = decode_throughput = 0.
-        while not self.is_finished():
+        while num_added < len(prompts) or not self.is_finished():
+            while len(chunks) < self.tokenizer_worker.max_in_flight and num_submitted < len(prompts):
+                chunks.append(self.tokenizer_worker.encode(prompts[num_submitted:num_submitted + batch_size]))
+                num_submitted += batch_size
+            if chunks and (chunks[0].done() or self.is_finished()):
+                for token_ids in chunks.popleft().result():
+                    self.add_request(token_ids, sampling_params[num_added])
+                    num_added += 1
+                continue
             t = perf_counter()
             output, num_tokens = self.step()
             if use_tqdm:
@@ -95,12 +242,131 @@ class LLMEngine:
                     "Prefill": f"{int(prefill_throughput)}tok/s",
                     "Decode": f"{int(decode_throughput)}tok/s",
                 })
-            for seq_id, token_ids in output:
-                outputs[seq_id] = token_ids
+            for seq_id, token_ids, metrics in output:
+                outputs[seq_id] = self.tokenizer_worker.decode(token_ids), token_ids, metrics
                 if use_tqdm:
                     pbar.update(1)
         outputs = [outputs[seq_id] for seq_id in sorted(outputs.keys())]
-        outputs = [{"text": self.tokenizer.decode(token_ids), "token_ids": token_ids} for token_ids in outputs]
+        outputs = [{"text": text.result(), "token_ids": token_ids, "metrics": metrics}
+                   for text, token_ids, metrics in outputs]
         if use_tqdm:
             pbar.close()
         return outputs
+
+    def add_pooling_request(self, token_ids: list[int], pooling: str, output_start: int,
+                            sampling_params: SamplingParams | None = None) -> Sequence:
+        # a prefill-only sequence: it is scheduled and prefix cached like any other, but finishes with its
+        # pooled output after the prefill instead of taking decode blocks
+        seq = Sequence(token_ids, sampling_params or SamplingParams())
+        seq.pooling = pooling
+        seq.output_start = output_start
+        self.scheduler.add(seq)
+        return seq
+
+    def run_prefill_only(self, seqs: list[Sequence], desc: str, use_tqdm: bool):
+        if use_tqdm:
+            pbar = tqdm(total=len(seqs), desc=desc, dynamic_ncols=True)
+        pending = {seq.seq_id for seq in seqs}
+        while pending:
+            output, _ = self.step()
+            for seq_id, _, _ in output:
+                if seq_id in pending:
+                    pending.remove(seq_id)
+                    if use_tqdm:
+                        pbar.update(1)
+        if use_tqdm:
+            pbar.close()
+
+    def embed(
+        self,
+        prompts: list[str] | list[list[int]],
+        pooling: str = "last",
+        normalize: bool = True,
+        sampling_params: SamplingParams | None = None,
+        use_tqdm: bool = True,
+    ) -> list[list[float]]:
+        # the final hidden state of the last token, or the mean over all tokens, of every prompt
+        assert pooling in ("last", "mean")
+        prompts = [self.tokenizer.encode(prompt) if isinstance(prompt, str) else prompt for prompt in prompts]
+        seqs = [self.add_pooling_request(prompt, pooling, 0 if pooling == "mean" else len(prompt) - 1, sampling_params)
+                for prompt in prompts]
+        self.run_prefill_only(seqs, "Embedding", use_tqdm)
+        embeddings = torch.tensor([seq.pooled_output for seq in seqs])
+        return (F.normalize(embeddings, dim=-1) if normalize else embeddings).tolist()
+
+    def score(
+        self,
+        prompts: list[str] | list[list[int]],
+        continuations: list[str] | list[list[int]],
+        sampling_params: SamplingParams | None = None,
+        use_tqdm: bool = True,
+    ) -> list[dict]:
+        # the log-likelihood of every continuation given its prompt, in total and per token. Prompts
+        # shared between requests, e.g. one query against many documents, are prefilled once.
+        seqs = []
+        for prompt, continuation in zip(prompts, continuations):
+            if isinstance(prompt, str):
+                prompt = self.tokenizer.encode(prompt)
+            if isinstance(continuation, str):
+                continuation = self.tokenizer.encode(continuation, add_special_tokens=False)
+            assert prompt and continuation
+            seqs.append(self.add_pooling_request(prompt + continuation, "logprobs", len(prompt) - 1, sampling_params))
+        self.run_prefill_only(seqs, "Scoring", use_tqdm)
+        return [{"logprob": sum(seq.pooled_output), "token_logprobs": seq.pooled_output} for seq in seqs]
+
+    def generate_file(
+        self,
+        input_path: str,
+        output_path: str,
+        sampling_params: SamplingParams | None = None,
+        queue_depth: int = 1024,
+        checkpoint_path: str | None = None,
+        checkpoint_interval: int = 256,
+    ) -> int:
+        # streams a JSONL/Parquet file of prompts through the engine, keeping at most about queue_depth
+        # sequences in the scheduler and appending each completion to output_path as a JSON line once it
+        # finishes. With a checkpoint, a rerun skips finished records and truncates partial output.
+        sampling_params = sampling_params or SamplingParams()
+        checkpoint = Checkpoint(checkpoint_path)
+        records = ((i, record) for i, record in read_records(input_path) if not checkpoint.is_done(i))
+        chunks = deque()    # (encode future, [(index, record)])
+        in_flight = {}    # seq_id -> (index, record)
+        finished = deque()    # (decode future, index, record, token_ids, metrics)
+        exhausted = False
+        num_written = num_unsaved = 0
+        with open(output_path, "a+b") as f:
+            f.truncate(checkpoint.output_offset)
+            f.seek(0, os.SEEK_END)
+            while True:
+                while not exhausted and len(chunks) < self.tokenizer_worker.max_in_flight:
+                    batch = list(islice(records, self.tokenizer_batch_size))
+                    if not batch:
+                        exhausted = True
+                        break
+                    chunks.append((self.tokenizer_worker.encode([record_prompt(record) for _, record in batch]), batch))
+                while chunks and len(self.scheduler.waiting) + len(self.scheduler.running) < queue_depth and \
+                        (chunks[0][0].done() or self.is_finished()):
+                    future, batch = chunks.popleft()
+                    for token_ids, (i, record) in zip(future.result(), batch):
+                        seq = self.add_request(token_ids, record_sampling_params(record, sampling_params))
+                        in_flight[seq.seq_id] = i, record
+                if not self.is_finished():
+                    output, _ = self.step()
+                    for seq_id, token_ids, metrics in output:
+                        i, record = in_flight.pop(seq_id)
+                        finished.append((self.tokenizer_worker.decode(token_ids), i, record, token_ids, metrics))
+                done = self.is_finished() and exhausted and not chunks
+                while finished and (finished[0][0].done() or done):
+                    text, i, record, token_ids, metrics = finished.popleft()
+                    result = dict(index=i, id=record.get("id", i), text=text.result(), token_ids=token_ids, metrics=metrics)
+                    f.write((json.dumps(result) + "\n").encode())
+                    checkpoint.mark_done(i)
+                    num_written += 1
+                    num_unsaved += 1
+                if num_unsaved >= checkpoint_interval or (done and num_unsaved):
+                    f.flush()
+                    os.fsync(f.fileno())
+                    checkpoint.save(f.tell())
+                    num_unsaved = 0
+                if done:
+                    return num_written
@@ -0,0 +1,84 @@
+import os
+import json
+from collections import OrderedDict
+import torch
+from torch import nn
+from safetensors.torch import load_file
+
+from nanovllm.engine.sequence import Sequence
+from nanovllm.layers.lora import add_lora
+
+
+def load_adapter(path: str, packed_modules_mapping: dict) -> dict[str, list[tuple]]:
+    # a PEFT adapter directory as {module name: [(shard_id, lora_a, scaled lora_b)]}
+    with open(os.path.join(path, "adapter_config.json")) as f:
+        adapter_config = json.load(f)
+    r = adapter_config["r"]
+    scaling = adapter_config["lora_alpha"] / (r ** 0.5 if adapter_config.get("use_rslora") else r)
+    tensors = load_file(os.path.join(path, "adapter_model.safetensors"))
+    weights = {}
+    for name, lora_a in tensors.items():
+        if ".lora_A." not in name:
+            continue
+        lora_b = tensors[name.replace(".lora_A.", ".lora_B.")]
+        module_name = name[:name.index(".lora_A.")].removeprefix("base_model.model.")
+        shard_id = None
+        prefix, _, leaf = module_name.rpartition(".")
+        if leaf in packed_modules_mapping:
+            leaf, shard_id = packed_modules_mapping[leaf]
+            module_name = f"{prefix}.{leaf}"
+        weights.setdefault(module_name, []).append((shard_id, lora_a, lora_b * scaling))
+    return weights
+
+
+class LoRAManager:
+    # maps the adapters of a batch to the max_loras slots of every LoRALinear, evicting the least recently
+    # used adapter not in the batch. Adapters read from disk stay in host memory, so a swap is a copy.
+    # Every rank runs the same batches and so makes the same assignments.
+
+    def __init__(self, model: nn.Module, adapters: dict[str, str], max_loras: int, max_rank: int):
+        self.modules = add_lora(model, max_loras, max_rank)
+        self.packed_modules_mapping = getattr(model, "packed_modules_mapping", {})
+        self.adapters = adapters
+        self.max_loras = max_loras
+        self.host_weights = {}
+        self.slots: OrderedDict[str, int] = OrderedDict()
+        self.free_slots = list(range(max_loras))
+
+    def load(self, lora_id: str, slot: int):
+        if lora_id not in self.host_weights:
+            self.host_weights[lora_id] = load_adapter(self.adapters[lora_id], self.packed_modules_mapping)
+        for module in self.modules.values():
+            module.clear_slot(slot)
+        for module_name, shards in self.host_weights[lora_id].items():
+            if module_name not in self.modules:    # owned by another pipeline stage
+                continue
+            for shard_id, lora_a, lora_b in shards:
+                self.modules[module_name].set_slot(slot, shard_id, lora_a, lora_b)
+
+    def activate(self, lora_ids: set[str]) -> dict[str, int]:
+        assert len(lora_ids) <= self.max_loras
+        for lora_id in lora_ids & self.slots.keys():
+            self.slots.move_to_end(lora_id)
+        for lora_id in lora_ids - self.slots.keys():
+            if self.free_slots:
+                slot = self.free_slots.pop(0)
+            else:
+                slot = self.slots.pop(next(iter(self.slots)))
+            self.load(lora_id, slot)
+            self.slots[lora_id] = slot
+        return {lora_id: self.slots[lora_id] for lora_id in lora_ids}
+
+    def prepare(self, seqs: list[Sequence], num_tokens: list[int], device) -> list[tuple[int, torch.Tensor]] | None:
+        # the rows of the batch each adapter slot applies to, sequences without an adapter get none
+        lora_ids = {seq.lora_id for seq in seqs if seq.lora_id is not None}
+        if not lora_ids:
+            return None
+        slots = self.activate(lora_ids)
+        rows = {}
+        start = 0
+        for seq, n in zip(seqs, num_tokens):
+            if seq.lora_id is not None:
+                rows.setdefault(slots[seq.lora_id], []).extend(range(start, start + n))
+            start += n
+        return [(slot, torch.tensor(indices, dtype=torch.int64, device=device)) for slot, indices in rows.items()]
@@ -0,0 +1,190 @@
+from bisect import bisect_left
+from dataclasses import dataclass
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from threading import Thread
+
+
+@dataclass
+class StepStats:
+    is_prefill: bool
+    batch_size: int
+    num_prefill_tokens: int
+    num_decode_tokens: int
+    schedule_time: float
+    prepare_time: float
+    forward_time: float
+    sample_time: float
+    postprocess_time: float
+
+
+METRICS = [
+    # name, type, help
+    ("num_steps", "counter", "Engine steps executed."),
+    ("prefill_tokens_total", "counter", "Prompt tokens computed in prefill steps."),
+    ("decode_tokens_total", "counter", "Tokens sampled in decode steps, one per scheduled sequence."),
+    ("batch_size", "gauge", "Sequences in the last step."),
+    ("num_waiting", "gauge", "Sequences in the waiting queue."),
+    ("num_running", "gauge", "Sequences in the running queue."),
+    ("kv_blocks_total", "gauge", "KV cache blocks."),
+    ("kv_blocks_used", "gauge", "KV cache blocks referenced by sequences."),
+    ("kv_block_utilization", "gauge", "Fraction of KV cache blocks in use."),
+    ("prefix_cache_queries_total", "counter", "Full blocks looked up in the prefix cache."),
+    ("prefix_cache_hits_total", "counter", "Full blocks found in the prefix cache."),
+    ("prefix_cache_hit_rate", "gauge", "Prefix cache hits over lookups."),
+    ("kv_tier_hits_total", "counter", "Prefix cache hits loaded back from the host or disk tier."),
+    ("kv_tier_blocks", "gauge", "Blocks held by the host and disk tiers."),
+    ("num_preemptions_total", "counter", "Sequences preempted for lack of KV blocks."),
+    ("schedule_seconds_total", "counter", "Time spent in Scheduler.schedule."),
+    ("prepare_seconds_total", "counter", "Time spent building model inputs."),
+    ("forward_seconds_total", "counter", "Time spent in the model forward pass."),
+    ("sample_seconds_total", "counter", "Time spent sampling."),
+    ("postprocess_seconds_total", "counter", "Time spent in Scheduler.postprocess."),
+]
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.075, 0.1, 0.25, 0.5, 0.75, 1., 2.5, 5., 7.5, 10., 30., 60., 120., float("inf"))
+
+HISTOGRAMS = [
+    # name, Sequence.metrics key, help
+    ("queue_time_seconds", "queue_time", "Time from arrival to first scheduling."),
+    ("ttft_seconds", "ttft", "Time from arrival to the first output token."),
+    ("tpot_seconds", "tpot", "Mean time per output token after the first."),
+    ("e2e_latency_seconds", "e2e_latency", "Time from arrival to finish."),
+]
+
+
+class Histogram:
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.sum = 0.
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        # linear interpolation inside the bucket, like Prometheus' histogram_quantile
+        if not self.count:
+            return 0.
+        rank = q * self.count
+        cumulative = 0
+        for i, count in enumerate(self.counts):
+            if cumulative + count >= rank and count:
+                lower = self.buckets[i - 1] if i else 0.
+                upper = self.buckets[i] if i < len(self.buckets) - 1 else lower
+                return lower + (upper - lower) * (rank - cumulative) / count
+            cumulative += count
+        return self.buckets[-2]
+
+    def to_dict(self) -> dict:
+        cumulative = 0
+        buckets = []
+        for le, count in zip(self.buckets, self.counts):
+            cumulative += count
+            buckets.append((le, cumulative))
+        return dict(count=self.count, sum=self.sum, mean=self.sum / max(self.count, 1),
+                    p50=self.quantile(0.5), p90=self.quantile(0.9), p99=self.quantile(0.99), buckets=buckets)
+
+
+class EngineStats:
+
+    def __init__(self):
+        self.num_steps = 0
+        self.prefill_tokens_total = 0
+        self.decode_tokens_total = 0
+        self.schedule_seconds_total = 0.
+        self.prepare_seconds_total = 0.
+        self.forward_seconds_total = 0.
+        self.sample_seconds_total = 0.
+        self.postprocess_seconds_total = 0.
+        self.last_step: StepStats | None = None
+        self.histograms = {name: Histogram() for name, _, _ in HISTOGRAMS}
+
+    def record_step(self, stats: StepStats):
+        self.num_steps += 1
+        self.prefill_tokens_total += stats.num_prefill_tokens
+        self.decode_tokens_total += stats.num_decode_tokens
+        self.schedule_seconds_total += stats.schedule_time
+        self.prepare_seconds_total += stats.prepare_time
+        self.forward_seconds_total += stats.forward_time
+        self.sample_seconds_total += stats.sample_time
+        self.postprocess_seconds_total += stats.postprocess_time
+        self.last_step = stats
+
+    def record_finished(self, metrics: dict):
+        for name, key, _ in HISTOGRAMS:
+            if metrics[key] is not None:
+                self.histograms[name].observe(metrics[key])
+
+    def snapshot(self, scheduler) -> dict:
+        block_manager = scheduler.block_manager
+        num_blocks = len(block_manager.blocks)
+        num_used = len(block_manager.used_block_ids)
+        return dict(
+            num_steps=self.num_steps,
+            prefill_tokens_total=self.prefill_tokens_total,
+            decode_tokens_total=self.decode_tokens_total,
+            batch_size=self.last_step.batch_size if self.last_step else 0,
+            num_waiting=len(scheduler.waiting),
+            num_running=len(scheduler.running),
+            kv_blocks_total=num_blocks,
+            kv_blocks_used=num_used,
+            kv_block_utilization=num_used / num_blocks if num_blocks else 0.,
+            prefix_cache_queries_total=block_manager.num_cache_queries,
+            prefix_cache_hits_total=block_manager.num_cache_hits,
+            prefix_cache_hit_rate=block_manager.num_cache_hits / max(block_manager.num_cache_queries, 1),
+            kv_tier_hits_total=block_manager.num_tier_hits,
+            kv_tier_blocks=len(block_manager.tiers) if block_manager.tiers is not None else 0,
+            num_preemptions_total=scheduler.num_preemptions,
+            schedule_seconds_total=self.schedule_seconds_total,
+            prepare_seconds_total=self.prepare_seconds_total,
+            forward_seconds_total=self.forward_seconds_total,
+            sample_seconds_total=self.sample_seconds_total,
+            postprocess_seconds_total=self.postprocess_seconds_total,
+            **{name: histogram.to_dict() for name, histogram in self.histograms.items()},
+        )
+
+
+def to_prometheus(snapshot: dict, prefix: str = "nanovllm") -> str:
+    lines = []
+    for name, kind, help in METRICS:
+        lines.append(f"# HELP {prefix}_{name} {help}")
+        lines.append(f"# TYPE {prefix}_{name} {kind}")
+        lines.append(f"{prefix}_{name} {snapshot[name]}")
+    for name, _, help in HISTOGRAMS:
+        histogram = snapshot[name]
+        lines.append(f"# HELP {prefix}_{name} {help}")
+        lines.append(f"# TYPE {prefix}_{name} histogram")
+        for le, count in histogram["buckets"]:
+            le = "+Inf" if le == float("inf") else le
+            lines.append(f'{prefix}_{name}_bucket{{le="{le}"}} {count}')
+        lines.append(f"{prefix}_{name}_sum {histogram['sum']}")
+        lines.append(f"{prefix}_{name}_count {histogram['count']}")
+    return "\n".join(lines) + "\n"
+
+
+def start_metrics_server(get_metrics, port: int, host: str = "0.0.0.0") -> ThreadingHTTPServer:
+
+    class Handler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path != "/metrics":
+                self.send_error(404)
+                return
+            body = get_metrics().encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "text/plain; version=0.0.4")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), Handler)
+    Thread(target=server.serve_forever, daemon=True).start()
+    return server
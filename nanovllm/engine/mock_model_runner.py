@@ -0,0 +1,59 @@
+from random import Random
+from collections import Counter
+
+from nanovllm.config import Config
+from nanovllm.engine.sequence import Sequence
+from nanovllm.engine.llm_engine import LLMEngine
+
+
+class MockModelRunner:
+    # stands in for ModelRunner: samples random tokens without touching a model or an accelerator
+
+    def __init__(self, config: Config, seed: int = 0):
+        self.vocab_size = config.hf_config.vocab_size
+        self.random = Random(seed)
+        self.timings = (0., 0., 0.)
+        self.batch_size_histogram = Counter()
+
+    def call(self, method_name, *args):
+        return getattr(self, method_name)(*args)
+
+    def run(self, seqs: list[Sequence], is_prefill: bool) -> list[int]:
+        if not is_prefill:
+            self.batch_size_histogram[len(seqs)] += 1
+        return [self.random.randrange(self.vocab_size) for _ in seqs]
+
+    def transfer_kv(self, ops):
+        pass
+
+    def load_kv_blocks(self, directory, blocks):
+        pass
+
+    def save_kv_blocks(self, directory, blocks):
+        pass
+
+    def start_profile(self):
+        pass
+
+    def stop_profile(self, name):
+        pass
+
+    def exit(self):
+        pass
+
+
+class MockLLMEngine(LLMEngine):
+    # the real Scheduler and BlockManager driven by a MockModelRunner, num_kvcache_blocks must be set
+
+    def __init__(self, config: Config, tokenizer=None, model_runner=None):
+        assert config.num_kvcache_blocks > 0
+        Sequence.block_size = config.kvcache_block_size
+        self.ps = []
+        self.events = []
+        self.model_runner = model_runner or MockModelRunner(config)
+        self.init_state(config, tokenizer)
+
+    def add_request(self, prompt: str | list[int], sampling_params):
+        if isinstance(prompt, str) and self.tokenizer is None:
+            prompt = list(prompt.encode())
+        return super().add_request(prompt, sampling_params)
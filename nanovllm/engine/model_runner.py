@@ -1,4 +1,7 @@
+import os
 import pickle
+from collections import Counter
+from time import perf_counter
 import torch
 import torch.distributed as dist
 from multiprocessing.synchronize import Event
@@ -6,10 +9,19 @@ from multiprocessing.shared_memory import SharedMemory
 
 from nanovllm.config import Config
 from nanovllm.engine.sequence import Sequence
-from nanovllm.models.qwen3 import Qwen3ForCausalLM
-from nanovllm.layers.sampler import Sampler
+from nanovllm.engine.kv_cache_tiers import KVCacheTiers, block_file
+from nanovllm.engine.lora_manager import LoRAManager
+from nanovllm.models.registry import get_model_class
+from nanovllm.layers.sampler import Sampler, VocabParallelSampler
+from nanovllm.layers.attention_backends import get_attention_backend
 from nanovllm.utils.context import set_context, get_context, reset_context
 from nanovllm.utils.loader import load_model
+from nanovllm.utils.guided_decoding import get_token_fsm
+from nanovllm.utils.memory_profiler import activation_bytes, cudagraph_bytes, kv_block_bytes, cache_dir
+from nanovllm.utils.cudagraph import default_capture_sizes, select_bucket
+from nanovllm.utils.profiling import profiler, profile_range
+from nanovllm.utils.parallel_state import (init_parallel_state, get_tp_rank, is_first_stage, is_last_stage,
+                                           prev_stage_rank, next_stage_rank, split_micro_batches)
 
 
 class ModelRunner:
@@ -19,19 +31,47 @@ class ModelRunner:
         hf_config = config.hf_config
         self.block_size = config.kvcache_block_size
         self.enforce_eager = config.enforce_eager
-        self.world_size = config.tensor_parallel_size
+        self.tp_size = config.tensor_parallel_size
+        self.pp_size = config.pipeline_parallel_size
+        self.world_size = self.tp_size * self.pp_size
         self.rank = rank
         self.event = event
+        self.device = config.device
+        Sequence.block_size = self.block_size
+        self.batch_size_histogram = Counter()
+        self.timings = (0., 0., 0.)
 
-        dist.init_process_group("nccl", "tcp://localhost:2333", world_size=self.world_size, rank=rank)
-        torch.cuda.set_device(rank)
+        backend = "nccl" if self.device == "cuda" else "gloo"
+        # data parallel replicas are independent engines, each on its own devices, port and shared memory
+        dp_rank = config.data_parallel_rank
+        dist.init_process_group(backend, f"tcp://localhost:{2333 + dp_rank}", world_size=self.world_size, rank=rank)
+        init_parallel_state(self.tp_size, self.pp_size, config.comm_overlap_chunks)
+        self.is_sampler = is_last_stage() and get_tp_rank() == 0    # hands the sampled tokens to rank 0
+        self.vocab_parallel_sampling = config.vocab_parallel_sampling and self.tp_size > 1
+        self.runs_sampler = is_last_stage() and (self.is_sampler or self.vocab_parallel_sampling)
+        if self.device == "cuda":
+            torch.cuda.set_device(dp_rank * self.world_size + rank)
         default_dtype = torch.get_default_dtype()
         torch.set_default_dtype(hf_config.torch_dtype)
-        torch.set_default_device("cuda")
-        self.model = Qwen3ForCausalLM(hf_config)
+        torch.set_default_device(self.device)
+        self.model = get_model_class(hf_config)(hf_config)
         load_model(self.model, config.model)
-        self.sampler = Sampler()
-        self.warmup_model()
+        self.lora_manager = None
+        if config.lora_adapters:
+            self.lora_manager = LoRAManager(self.model, config.lora_adapters, config.max_loras, config.max_lora_rank)
+        self.attn_backend = get_attention_backend(config.attention_backend, self.device)(self)
+        self.enforce_eager = (self.enforce_eager or not self.attn_backend.supports_cudagraph or self.pp_size > 1 or
+                              not getattr(self.model, "supports_cudagraph", True))
+        for module in self.model.modules():
+            if hasattr(module, "k_cache") and hasattr(module, "v_cache"):
+                module.backend = self.attn_backend
+        if self.vocab_parallel_sampling and is_last_stage():
+            self.model.lm_head.gather_logits = False
+            self.sampler = VocabParallelSampler(self.model.lm_head.vocab_start_idx)
+        else:
+            self.sampler = Sampler()
+        if config.kv_cache_profiling == "warmup":
+            self.warmup_model()
         self.allocate_kv_cache()
         if not self.enforce_eager:
             self.capture_cudagraph()
@@ -39,12 +79,13 @@ class ModelRunner:
         torch.set_default_dtype(default_dtype)
 
         if self.world_size > 1:
+            shm_name = f"nanovllm{dp_rank or ''}"
             if rank == 0:
-                self.shm = SharedMemory(name="nanovllm", create=True, size=2**20)
+                self.shm = SharedMemory(name=shm_name, create=True, size=2**20)
                 dist.barrier()
             else:
                 dist.barrier()
-                self.shm = SharedMemory(name="nanovllm")
+                self.shm = SharedMemory(name=shm_name)
                 self.loop()
 
     def exit(self):
@@ -55,7 +96,10 @@ class ModelRunner:
                 self.shm.unlink()
         if not self.enforce_eager:
             del self.graphs, self.graph_pool
-        torch.cuda.synchronize()
+        if self.kv_tiers is not None:
+            self.kv_tiers.close()
+        if self.device == "cuda":
+            torch.cuda.synchronize()
         dist.destroy_process_group()
 
     def loop(self):
@@ -88,46 +132,95 @@ class ModelRunner:
         method = getattr(self, method_name, None)
         return method(*args)
 
+    def to_device(self, data: list, dtype: torch.dtype) -> torch.Tensor:
+        if self.device == "cpu":
+            return torch.tensor(data, dtype=dtype)
+        return torch.tensor(data, dtype=dtype, pin_memory=True).cuda(non_blocking=True)
+
     def warmup_model(self):
-        torch.cuda.empty_cache()
-        torch.cuda.reset_peak_memory_stats()
+        if self.device == "cuda":
+            torch.cuda.empty_cache()
+            torch.cuda.reset_peak_memory_stats()
         max_num_batched_tokens, max_model_len = self.config.max_num_batched_tokens, self.config.max_model_len
         num_seqs = min(max_num_batched_tokens // max_model_len, self.config.max_num_seqs)
         seqs = [Sequence([0] * max_model_len) for _ in range(num_seqs)]
         self.run(seqs, True)
-        torch.cuda.empty_cache()
+        if self.device == "cuda":
+            torch.cuda.empty_cache()
+
+    def estimate_activation_memory(self):
+        config = self.config
+        max_num_batched_tokens, max_model_len = config.max_num_batched_tokens, config.max_model_len
+        num_seqs = min(max_num_batched_tokens // max_model_len, config.max_num_seqs)
+        activations = activation_bytes(config.hf_config, max_num_batched_tokens, num_seqs, self.tp_size)
+        if not self.enforce_eager:
+            capture_sizes = self.get_capture_sizes()
+            activations += cudagraph_bytes(config.hf_config, capture_sizes[-1], len(capture_sizes), self.tp_size)
+        return activations
 
     def allocate_kv_cache(self):
         config = self.config
         hf_config = config.hf_config
-        free, total = torch.cuda.mem_get_info()
-        used = total - free
-        peak = torch.cuda.memory_stats()["allocated_bytes.all.peak"]
-        current = torch.cuda.memory_stats()["allocated_bytes.all.current"]
-        num_kv_heads = hf_config.num_key_value_heads // self.world_size
-        block_bytes = 2 * hf_config.num_hidden_layers * self.block_size * num_kv_heads * hf_config.head_dim * hf_config.torch_dtype.itemsize
-        config.num_kvcache_blocks = int(total * config.gpu_memory_utilization - used - peak + current) // block_bytes
+        analytical = config.kv_cache_profiling == "analytical"
+        if self.device == "cuda":
+            free, total = torch.cuda.mem_get_info()
+            used = total - free
+            peak = torch.cuda.memory_stats()["allocated_bytes.all.peak"]
+            current = torch.cuda.memory_stats()["allocated_bytes.all.current"]
+            activations = self.estimate_activation_memory() if analytical else peak - current
+            available = int(total * config.gpu_memory_utilization - used - activations)
+        else:
+            free = os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+            activations = self.estimate_activation_memory() if analytical else 0
+            available = int(free * config.gpu_memory_utilization - activations)
+        num_kv_heads = hf_config.num_key_value_heads // self.tp_size
+        num_layers = self.model.model.end_layer - self.model.model.start_layer
+        block_bytes = kv_block_bytes(hf_config, self.block_size, self.tp_size) * num_layers // hf_config.num_hidden_layers
+        config.num_kvcache_blocks = available // block_bytes
+        if self.world_size > 1:    # one scheduler indexes every rank's cache, so all ranks use the smallest
+            num_blocks = torch.tensor(config.num_kvcache_blocks, device=self.device)
+            dist.all_reduce(num_blocks, dist.ReduceOp.MIN)
+            config.num_kvcache_blocks = num_blocks.item()
         # config.num_kvcache_blocks = 5
         assert config.num_kvcache_blocks > 0
-        before = torch.cuda.memory_allocated()
-        self.kv_cache = torch.empty(2, hf_config.num_hidden_layers, config.num_kvcache_blocks, self.block_size, num_kv_heads, hf_config.head_dim)
+        before = torch.cuda.memory_allocated() if self.device == "cuda" else 0
+        self.kv_cache = torch.empty(2, num_layers, config.num_kvcache_blocks, self.block_size, num_kv_heads, hf_config.head_dim)
         kv_cache_memory_gb = self.kv_cache.numel() * self.kv_cache.element_size() / 1024**3
         print(f"KV Cache 已分配: {kv_cache_memory_gb:.2f} GB")
-        after = torch.cuda.memory_allocated()
-        print(f"KV Cache 分配實際增加: {(after - before) / 1024**3:.2f} GB")
+        if self.device == "cuda":
+            after = torch.cuda.memory_allocated()
+            print(f"KV Cache 分配實際增加: {(after - before) / 1024**3:.2f} GB")
         layer_id = 0
         for module in self.model.modules():
             if hasattr(module, "k_cache") and hasattr(module, "v_cache"):
                 module.k_cache = self.kv_cache[0, layer_id]
                 module.v_cache = self.kv_cache[1, layer_id]
                 layer_id += 1
+        self.kv_tiers = None
+        if config.host_kv_cache_blocks or config.disk_kv_cache_blocks:
+            disk_dir = config.disk_kv_cache_dir or os.path.join(cache_dir(), "kv")
+            os.makedirs(disk_dir, exist_ok=True)
+            disk_path = os.path.join(disk_dir, f"kv.{os.getpid()}.rank{self.rank}.bin")
+            self.kv_tiers = KVCacheTiers(self.kv_cache, config.host_kv_cache_blocks, config.disk_kv_cache_blocks, disk_path)
+
+    def transfer_kv(self, ops: list[tuple[str, int, int]]):
+        self.kv_tiers.apply(ops)
+
+    def save_kv_blocks(self, directory: str, blocks: list[tuple[int, int]]):
+        os.makedirs(directory, exist_ok=True)
+        for h, block_id in blocks:
+            path = block_file(directory, h, self.rank)
+            torch.save(self.kv_cache[:, :, block_id].cpu(), path + ".tmp")
+            os.replace(path + ".tmp", path)
+
+    def load_kv_blocks(self, directory: str, blocks: list[tuple[int, int]]):
+        for h, block_id in blocks:
+            self.kv_cache[:, :, block_id].copy_(torch.load(block_file(directory, h, self.rank)))
 
     def prepare_block_tables(self, seqs: list[Sequence]):
         max_len = max(len(seq.block_table) for seq in seqs)
         block_tables = [seq.block_table + [-1] * (max_len - len(seq.block_table)) for seq in seqs]
-        for bt, seq in zip(block_tables, seqs):
-            print(seq.seq_id, bt)
-        block_tables = torch.tensor(block_tables, dtype=torch.int32, pin_memory=True).cuda(non_blocking=True)
+        block_tables = self.to_device(block_tables, torch.int32)
         return block_tables
 
     def prepare_prefill(self, seqs: list[Sequence]):
@@ -138,36 +231,34 @@ class ModelRunner:
         max_seqlen_q = 0
         max_seqlen_k = 0
         slot_mapping = []
-        block_tables = None
         for seq in seqs:
-            if Config.DEBUG_BLOCK_MANAGER:
-                print(f"Seq {seq.seq_id}: len={len(seq)}, num_cached_tokens={seq.num_cached_tokens}, has_block_table={seq.block_table is not None}")
-            seqlen = len(seq)
-            input_ids.extend(seq[seq.num_cached_tokens:])
-            positions.extend(list(range(seq.num_cached_tokens, seqlen)))
-            seqlen_q = seqlen - seq.num_cached_tokens
-            seqlen_k = seqlen
+            seq_positions = seq.resident_positions()[seq.num_cached_tokens:]
+            input_ids.extend(seq[seq.num_cached_tokens:] if not seq.num_dropped_blocks else [seq[i] for i in seq_positions])
+            positions.extend(seq_positions)
+            seqlen_q = seq.num_uncached_tokens
+            seqlen_k = seq.num_resident_tokens
             cu_seqlens_q.append(cu_seqlens_q[-1] + seqlen_q)
             cu_seqlens_k.append(cu_seqlens_k[-1] + seqlen_k)
             max_seqlen_q = max(seqlen_q, max_seqlen_q)
             max_seqlen_k = max(seqlen_k, max_seqlen_k)
             if not seq.block_table:    # warmup
                 continue
-            for i in range(seq.num_cached_blocks, seq.num_blocks):
+            for i in range(seq.num_cached_blocks, seq.num_resident_blocks):
                 start = seq.block_table[i] * self.block_size
-                if i != seq.num_blocks - 1:
+                if i != seq.num_resident_blocks - 1:
                     end = start + self.block_size
                 else:
                     end = start + seq.last_block_num_tokens 
                 slot_mapping.extend(list(range(start, end)))
-        if cu_seqlens_k[-1] > cu_seqlens_q[-1]:    # prefix cache
-            block_tables = self.prepare_block_tables(seqs)
-        input_ids = torch.tensor(input_ids, dtype=torch.int64, pin_memory=True).cuda(non_blocking=True)
-        positions = torch.tensor(positions, dtype=torch.int64, pin_memory=True).cuda(non_blocking=True)
-        cu_seqlens_q = torch.tensor(cu_seqlens_q, dtype=torch.int32, pin_memory=True).cuda(non_blocking=True)
-        cu_seqlens_k = torch.tensor(cu_seqlens_k, dtype=torch.int32, pin_memory=True).cuda(non_blocking=True)
-        slot_mapping = torch.tensor(slot_mapping, dtype=torch.int32, pin_memory=True).cuda(non_blocking=True)
-        set_context(True, cu_seqlens_q, cu_seqlens_k, max_seqlen_q, max_seqlen_k, slot_mapping, None, block_tables)
+        input_ids = self.to_device(input_ids, torch.int64)
+        positions = self.to_device(positions, torch.int64)
+        slot_mapping = self.to_device(slot_mapping, torch.int32)
+        attn_metadata = self.attn_backend.prepare_prefill(seqs, cu_seqlens_q, cu_seqlens_k, max_seqlen_q, max_seqlen_k)
+        lora_segments = None
+        if self.lora_manager is not None:
+            num_tokens = [end - start for start, end in zip(cu_seqlens_q, cu_seqlens_q[1:])]
+            lora_segments = self.lora_manager.prepare(seqs, num_tokens, self.device)
+        set_context(True, slot_mapping=slot_mapping, lora_segments=lora_segments, **attn_metadata)
         return input_ids, positions
 
     def prepare_decode(self, seqs: list[Sequence]):
@@ -178,31 +269,91 @@ class ModelRunner:
         for seq in seqs:
             input_ids.append(seq.last_token)
             positions.append(len(seq) - 1)
-            context_lens.append(len(seq))
+            context_lens.append(seq.num_resident_tokens)
             slot_mapping.append(seq.block_table[-1] * self.block_size + seq.last_block_num_tokens  - 1)
-        input_ids = torch.tensor(input_ids, dtype=torch.int64, pin_memory=True).cuda(non_blocking=True)
-        positions = torch.tensor(positions, dtype=torch.int64, pin_memory=True).cuda(non_blocking=True)
-        slot_mapping = torch.tensor(slot_mapping, dtype=torch.int32, pin_memory=True).cuda(non_blocking=True)
-        context_lens = torch.tensor(context_lens, dtype=torch.int32, pin_memory=True).cuda(non_blocking=True)
-        block_tables = self.prepare_block_tables(seqs)
-        set_context(False, slot_mapping=slot_mapping, context_lens=context_lens, block_tables=block_tables)
+        input_ids = self.to_device(input_ids, torch.int64)
+        positions = self.to_device(positions, torch.int64)
+        slot_mapping = self.to_device(slot_mapping, torch.int32)
+        attn_metadata = self.attn_backend.prepare_decode(seqs, context_lens)
+        lora_segments = self.lora_manager.prepare(seqs, [1] * len(seqs), self.device) if self.lora_manager is not None else None
+        set_context(False, slot_mapping=slot_mapping, lora_segments=lora_segments, **attn_metadata)
         return input_ids, positions
 
     def prepare_sample(self, seqs: list[Sequence]):
         temperatures = []
         for seq in seqs:
             temperatures.append(seq.temperature)
-        temperatures = torch.tensor(temperatures, dtype=torch.float32, pin_memory=True).cuda(non_blocking=True)
+        temperatures = self.to_device(temperatures, torch.float32)
         return temperatures
 
+    def prepare_guided(self, seqs: list[Sequence]) -> tuple[torch.Tensor, torch.Tensor] | None:
+        # the allowed-token masks of the guided sequences, cut to this rank's vocab shard when sampling
+        # from sharded logits
+        rows = [i for i, seq in enumerate(seqs) if seq.guide_key is not None]
+        if not rows:
+            return None
+        vocab_size = self.config.hf_config.vocab_size
+        masks = torch.stack([get_token_fsm(self.config.model, vocab_size, seqs[i].guide_key, seqs[i].guided_pattern)
+                             .allowed(seqs[i].guide_state) for i in rows])
+        if self.vocab_parallel_sampling:
+            lm_head = self.model.lm_head
+            masks = masks[:, lm_head.vocab_start_idx:lm_head.vocab_start_idx + lm_head.weight.size(0)]
+        if self.device == "cuda":
+            masks = masks.pin_memory().cuda(non_blocking=True)
+        return self.to_device(rows, torch.int64), masks
+
+    def apply_guided(self, logits: torch.Tensor, rows: torch.Tensor, masks: torch.Tensor):
+        logits[rows] = logits[rows].masked_fill(~masks, float("-inf"))
+
+    def pooled_size(self, seq: Sequence) -> int:
+        return len(seq) - 1 - seq.output_start if seq.pooling == "logprobs" else self.config.hf_config.hidden_size
+
+    def compute_pooled(self, seqs: list[Sequence], hidden_states: torch.Tensor) -> list[torch.Tensor | None] | None:
+        # the outputs of prefill-only sequences: their last or mean final hidden state, or the log
+        # probabilities of their tokens after output_start. Every rank of the last stage takes part.
+        if not any(seq.pooling is not None for seq in seqs):
+            return None
+        outputs = [None] * len(seqs)
+        rows = []
+        targets = []
+        scored = []
+        start = 0
+        for i, seq in enumerate(seqs):
+            end = start + seq.num_uncached_tokens
+            if seq.pooling == "last":
+                outputs[i] = hidden_states[end - 1].float()
+            elif seq.pooling == "mean":
+                assert seq.num_cached_tokens == 0
+                outputs[i] = hidden_states[start:end].float().mean(0)
+            elif seq.pooling == "logprobs":
+                first = start + seq.output_start - seq.num_cached_tokens
+                rows.extend(range(first, end - 1))
+                targets.extend(seq[seq.output_start + 1:])
+                scored.append(i)
+            start = end
+        if rows:
+            logprobs = self.model.lm_head.logprobs(hidden_states[self.to_device(rows, torch.int64)], self.to_device(targets, torch.int64))
+            for i, seq_logprobs in zip(scored, logprobs.split([self.pooled_size(seqs[i]) for i in scored])):
+                outputs[i] = seq_logprobs
+        return outputs
+
     @torch.inference_mode()
     def run_model(self, input_ids: torch.Tensor, positions: torch.Tensor, is_prefill: bool):
-        if is_prefill or self.enforce_eager or input_ids.size(0) > 512:
-            return self.model.compute_logits(self.model(input_ids, positions))
+        bs = input_ids.size(0)
+        # the graphs are captured without adapters, batches using one run eagerly
+        graph_bs = None if is_prefill or self.enforce_eager or get_context().lora_segments else select_bucket(self.graph_bs, bs)
+        if not is_prefill:
+            self.batch_size_histogram[bs] += 1
+        if graph_bs is None:
+            with profile_range("model"):
+                hidden_states = self.model(input_ids, positions)
+            with profile_range("compute_logits"):
+                return hidden_states, self.model.compute_logits(hidden_states)
         else:
-            bs = input_ids.size(0)
             context = get_context()
-            graph = self.graphs[next(x for x in self.graph_bs if x >= bs)]
+            if graph_bs not in self.graphs:
+                self.capture_graph(graph_bs)
+            graph = self.graphs[graph_bs]
             graph_vars = self.graph_vars
             graph_vars["input_ids"][:bs] = input_ids
             graph_vars["positions"][:bs] = positions
@@ -211,52 +362,163 @@ class ModelRunner:
             graph_vars["context_lens"].zero_()
             graph_vars["context_lens"][:bs] = context.context_lens
             graph_vars["block_tables"][:bs, :context.block_tables.size(1)] = context.block_tables
-            graph.replay()
-            return self.model.compute_logits(graph_vars["outputs"][:bs])
-
-    def run(self, seqs: list[Sequence], is_prefill: bool) -> list[int]:
-        if Config.DEBUG_SCHEDULER:
-            print("This is going to be prefill" if is_prefill else "This is going to be decode")
-        input_ids, positions = self.prepare_prefill(seqs) if is_prefill else self.prepare_decode(seqs)
-        temperatures = self.prepare_sample(seqs) if self.rank == 0 else None
-        logits = self.run_model(input_ids, positions, is_prefill)
-        token_ids = self.sampler(logits, temperatures).tolist() if self.rank == 0 else None
+            with profile_range("model.cudagraph"):
+                graph.replay()
+            with profile_range("compute_logits"):
+                return None, self.model.compute_logits(graph_vars["outputs"][:bs])
+
+    def synchronize(self):
+        if self.device == "cuda":
+            torch.cuda.synchronize()
+
+    @torch.inference_mode()
+    def run(self, seqs: list[Sequence], is_prefill: bool) -> list[int | list[float]]:
+        # one sampled token per sequence, or the pooled output of a prefill-only sequence
+        if self.pp_size > 1:
+            return self.run_pipeline(seqs, is_prefill)
+        t0 = perf_counter()
+        with profile_range("prepare_prefill" if is_prefill else "prepare_decode"):
+            input_ids, positions = self.prepare_prefill(seqs) if is_prefill else self.prepare_decode(seqs)
+            temperatures = self.prepare_sample(seqs) if self.runs_sampler else None
+        t1 = perf_counter()
+        hidden_states, logits = self.run_model(input_ids, positions, is_prefill)
+        with profile_range("compute_pooled"):
+            pooled = self.compute_pooled(seqs, hidden_states) if is_prefill else None
+        with profile_range("prepare_guided"):
+            # built on the host while the device still runs the forward pass
+            guided = self.prepare_guided(seqs) if self.runs_sampler else None
+        self.synchronize()
+        t2 = perf_counter()
+        with profile_range("sampler"):
+            if guided is not None:
+                self.apply_guided(logits, *guided)
+            token_ids = self.sampler(logits, temperatures) if self.runs_sampler else None
+            token_ids = token_ids.tolist() if self.rank == 0 else None
+        if pooled is not None and self.rank == 0:
+            token_ids = [token_id if output is None else output.tolist() for token_id, output in zip(token_ids, pooled)]
         reset_context()
+        self.timings = (t1 - t0, t2 - t1, perf_counter() - t2)
         return token_ids
 
+    @torch.inference_mode()
+    def run_pipeline(self, seqs: list[Sequence], is_prefill: bool) -> list[int | list[float]] | None:
+        # every stage runs the micro-batches in order and hands each one to the next stage without
+        # waiting for it, so stage s works on micro-batch i while stage s+1 works on micro-batch i-1
+        hf_config = self.config.hf_config
+        num_tokens = [seq.num_uncached_tokens for seq in seqs] if is_prefill else [1] * len(seqs)
+        sends = []
+        token_ids = []
+        pooled = []
+        timings = [0., 0., 0.]
+        for start, end in split_micro_batches(num_tokens, self.config.num_micro_batches):
+            micro_batch = seqs[start:end]
+            t0 = perf_counter()
+            with profile_range("prepare_prefill" if is_prefill else "prepare_decode"):
+                input_ids, positions = self.prepare_prefill(micro_batch) if is_prefill else self.prepare_decode(micro_batch)
+                temperatures = self.prepare_sample(micro_batch) if self.runs_sampler else None
+            t1 = perf_counter()
+            intermediate = None
+            if not is_first_stage():
+                intermediate = torch.empty(2, sum(num_tokens[start:end]), hf_config.hidden_size,
+                                           dtype=hf_config.torch_dtype, device=self.device)
+                with profile_range("recv"):
+                    dist.recv(intermediate, prev_stage_rank())
+            with profile_range("model"):
+                output = self.model(input_ids, positions, intermediate)
+            if not is_last_stage():
+                output = torch.stack(output)
+                sends.append((dist.isend(output, next_stage_rank()), output))
+                t2 = perf_counter()
+            else:
+                with profile_range("compute_logits"):
+                    logits = self.model.compute_logits(output)
+                if is_prefill:
+                    with profile_range("compute_pooled"):
+                        pooled.extend(self.compute_pooled(micro_batch, output) or [None] * len(micro_batch))
+                with profile_range("prepare_guided"):
+                    guided = self.prepare_guided(micro_batch) if self.runs_sampler else None
+                self.synchronize()
+                t2 = perf_counter()
+                if self.runs_sampler:
+                    with profile_range("sampler"):
+                        if guided is not None:
+                            self.apply_guided(logits, *guided)
+                        micro_batch_token_ids = self.sampler(logits, temperatures)
+                    if self.is_sampler:
+                        token_ids.extend(micro_batch_token_ids.tolist())
+            reset_context()
+            timings = [timings[0] + t1 - t0, timings[1] + t2 - t1, timings[2] + perf_counter() - t2]
+        for work, _ in sends:
+            work.wait()
+        self.timings = tuple(timings)
+        # the scheduler lives on rank 0, the first stage
+        has_pooled = is_prefill and any(seq.pooling is not None for seq in seqs)
+        if self.is_sampler:
+            dist.send(torch.tensor(token_ids, device=self.device), 0)
+            if has_pooled:
+                dist.send(torch.cat([output for output in pooled if output is not None]), 0)
+        elif self.rank == 0:
+            token_ids = torch.empty(len(seqs), dtype=torch.int64, device=self.device)
+            dist.recv(token_ids, self.world_size - self.tp_size)
+            token_ids = token_ids.tolist()
+            if has_pooled:
+                sizes = [self.pooled_size(seq) for seq in seqs if seq.pooling is not None]
+                pooled = torch.empty(sum(sizes), dtype=torch.float32, device=self.device)
+                dist.recv(pooled, self.world_size - self.tp_size)
+                pooled = iter(pooled.split(sizes))
+                token_ids = [token_id if seq.pooling is None else next(pooled).tolist() for token_id, seq in zip(token_ids, seqs)]
+            return token_ids
+        return None
+
+    def start_profile(self):
+        profiler.start(self.device)
+
+    def stop_profile(self, name: str):
+        self.synchronize()
+        profiler.stop(os.path.join(self.config.profile_dir, f"{name}.rank{self.rank}.json"))
+
+    def get_capture_sizes(self):
+        max_bs = min(self.config.max_num_seqs, 512)
+        if self.config.cudagraph_capture_sizes is None:
+            return default_capture_sizes(max_bs)
+        return [bs for bs in self.config.cudagraph_capture_sizes if bs <= max_bs] or [max_bs]
+
+    @torch.inference_mode()
+    def capture_graph(self, bs: int):
+        graph_vars = self.graph_vars
+        input_ids, positions, outputs = graph_vars["input_ids"], graph_vars["positions"], graph_vars["outputs"]
+        graph = torch.cuda.CUDAGraph()
+        # the warmup really runs, with lazy capture the buffers still hold the previous batch whose KV it must not overwrite
+        graph_vars["slot_mapping"].fill_(-1)
+        graph_vars["context_lens"].zero_()
+        set_context(False, slot_mapping=graph_vars["slot_mapping"][:bs], context_lens=graph_vars["context_lens"][:bs],
+                    block_tables=graph_vars["block_tables"][:bs])
+        outputs[:bs] = self.model(input_ids[:bs], positions[:bs])    # warmup
+        with torch.cuda.graph(graph, self.graph_pool):
+            outputs[:bs] = self.model(input_ids[:bs], positions[:bs])    # capture
+        if self.graph_pool is None:
+            self.graph_pool = graph.pool()
+        self.graphs[bs] = graph
+        torch.cuda.synchronize()
+        reset_context()
+
     @torch.inference_mode()
     def capture_cudagraph(self):
         config = self.config
         hf_config = config.hf_config
-        max_bs = min(self.config.max_num_seqs, 512)
+        self.graph_bs = self.get_capture_sizes()
+        max_bs = self.graph_bs[-1]
         max_num_blocks = (config.max_model_len + self.block_size - 1) // self.block_size
-        input_ids = torch.zeros(max_bs, dtype=torch.int64)
-        positions = torch.zeros(max_bs, dtype=torch.int64)
-        slot_mapping = torch.zeros(max_bs, dtype=torch.int32)
-        context_lens = torch.zeros(max_bs, dtype=torch.int32)
-        block_tables = torch.zeros(max_bs, max_num_blocks, dtype=torch.int32)
-        outputs = torch.zeros(max_bs, hf_config.hidden_size)
-        self.graph_bs = [1, 2, 4, 8] + list(range(16, max_bs + 1, 16))
-        self.graphs = {}
-        self.graph_pool = None
-
-        for bs in reversed(self.graph_bs):
-            graph = torch.cuda.CUDAGraph()
-            set_context(False, slot_mapping=slot_mapping[:bs], context_lens=context_lens[:bs], block_tables=block_tables[:bs])
-            outputs[:bs] = self.model(input_ids[:bs], positions[:bs])    # warmup
-            with torch.cuda.graph(graph, self.graph_pool):
-                outputs[:bs] = self.model(input_ids[:bs], positions[:bs])    # capture
-            if self.graph_pool is None:
-                self.graph_pool = graph.pool()
-            self.graphs[bs] = graph
-            torch.cuda.synchronize()
-            reset_context()
-
         self.graph_vars = dict(
-            input_ids=input_ids,
-            positions=positions,
-            slot_mapping=slot_mapping,
-            context_lens=context_lens,
-            block_tables=block_tables,
-            outputs=outputs,
+            input_ids=torch.zeros(max_bs, dtype=torch.int64),
+            positions=torch.zeros(max_bs, dtype=torch.int64),
+            slot_mapping=torch.full((max_bs,), -1, dtype=torch.int32),
+            context_lens=torch.zeros(max_bs, dtype=torch.int32),
+            block_tables=torch.zeros(max_bs, max_num_blocks, dtype=torch.int32),
+            outputs=torch.zeros(max_bs, hf_config.hidden_size),
         )
+        self.graphs = {}
+        self.graph_pool = None
+        if not config.lazy_cudagraph_capture:
+            for bs in reversed(self.graph_bs):
+                self.capture_graph(bs)
@@ -0,0 +1,110 @@
+import heapq
+from collections import deque
+
+from nanovllm.engine.sequence import Sequence
+
+
+class WaitingQueue:
+    # admission order: lower priority value first, then first come first served by seq_id,
+    # so a preempted sequence goes back ahead of later arrivals of the same priority
+
+    def __init__(self):
+        self.heap: list[tuple[int, int, Sequence]] = []
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __iter__(self):
+        return (seq for _, _, seq in sorted(self.heap))
+
+    def push(self, seq: Sequence):
+        heapq.heappush(self.heap, (seq.priority, seq.seq_id, seq))
+
+    def peek(self) -> Sequence:
+        return self.heap[0][2]
+
+    def pop(self) -> Sequence:
+        return heapq.heappop(self.heap)[2]
+
+    def __bool__(self):
+        return bool(self.heap)
+
+
+class FairWaitingQueue:
+    # weighted fair queuing across tenants: a tenant's virtual time grows by the tokens computed for it
+    # divided by its weight, and the backlogged tenant with the least virtual time admits next.
+    # Priorities and FCFS apply within a tenant.
+
+    def __init__(self, weights: dict[str, float] | None = None):
+        self.weights = weights or {}
+        self.queues: dict[str, WaitingQueue] = {}
+        self.vtime: dict[str, float] = {}
+        self.system_vtime = 0.
+        self.selected = None
+        self.num_seqs = 0
+
+    def __len__(self):
+        return self.num_seqs
+
+    def __iter__(self):
+        return (seq for queue in self.queues.values() for seq in queue)
+
+    def push(self, seq: Sequence):
+        queue = self.queues.setdefault(seq.tenant, WaitingQueue())
+        if not queue:    # a tenant returning from idle does not get credit for the time it was idle
+            self.vtime[seq.tenant] = max(self.vtime.get(seq.tenant, 0.), self.system_vtime)
+        queue.push(seq)
+        self.num_seqs += 1
+
+    def peek(self, excluded: set[str] = frozenset()) -> Sequence | None:
+        backlogged = [tenant for tenant, queue in self.queues.items() if queue and tenant not in excluded]
+        if not backlogged:
+            return None
+        self.selected = min(backlogged, key=lambda tenant: (self.vtime[tenant], self.queues[tenant].peek().seq_id))
+        return self.queues[self.selected].peek()
+
+    def pop(self) -> Sequence:
+        self.system_vtime = max(self.system_vtime, self.vtime[self.selected])
+        self.num_seqs -= 1
+        return self.queues[self.selected].pop()
+
+    def charge(self, tenant: str, num_tokens: int):
+        self.vtime[tenant] = self.vtime.get(tenant, self.system_vtime) + num_tokens / self.weights.get(tenant, 1.)
+
+
+def exclusive_blocks(seq: Sequence, block_manager) -> int:
+    return sum(block_manager.blocks[block_id].ref_count == 1 for block_id in seq.block_table)
+
+
+# a preemption policy picks the victim among the sequence being scheduled, which the caller has already
+# popped from the front of running, and the sequences still waiting for their decode slot in running
+
+def lifo(seq: Sequence, running: deque[Sequence], block_manager) -> Sequence:
+    return running[-1] if running else seq
+
+
+def lowest_priority(seq, running, block_manager):
+    candidates = [seq, *running]
+    return max(enumerate(candidates), key=lambda x: (x[1].priority, x[0]))[1]
+
+
+def fewest_computed(seq, running, block_manager):
+    candidates = [seq, *running]
+    return max(enumerate(candidates), key=lambda x: (-x[1].num_tokens, x[0]))[1]
+
+
+def most_freed_per_work(seq, running, block_manager):
+    # blocks returned to the free list per token that has to be recomputed after readmission
+    candidates = [seq, *running]
+    def score(x):
+        i, s = x
+        return exclusive_blocks(s, block_manager) / max(s.num_uncached_tokens, 1), i
+    return max(enumerate(candidates), key=score)[1]
+
+
+PREEMPTION_POLICIES = {
+    "lifo": lifo,
+    "priority": lowest_priority,
+    "fewest_computed": fewest_computed,
+    "most_freed": most_freed_per_work,
+}
@@ -0,0 +1,195 @@
+import os
+import atexit
+import queue
+from collections import OrderedDict
+from dataclasses import fields
+from itertools import count
+from tqdm.auto import tqdm
+from transformers import AutoTokenizer
+import torch.multiprocessing as mp
+
+from nanovllm.config import Config
+from nanovllm.sampling_params import SamplingParams
+from nanovllm.engine.block_manager import BlockManager
+from nanovllm.engine.llm_engine import LLMEngine
+from nanovllm.engine.mock_model_runner import MockLLMEngine
+
+
+def prefix_hashes(token_ids: list[int], block_size: int, seed: int = -1) -> list[int]:
+    # the chained hashes BlockManager.allocate computes for the full blocks of a prompt
+    hashes = []
+    h = seed
+    for i in range(len(token_ids) // block_size):
+        h = BlockManager.compute_hash(token_ids[i * block_size:(i + 1) * block_size], h)
+        hashes.append(h)
+    return hashes
+
+
+class ReplicaState:
+
+    def __init__(self, num_blocks: int):
+        self.num_blocks = num_blocks
+        self.cached: OrderedDict[int, None] = OrderedDict()    # LRU model of the replica's prefix cache
+        self.num_free_blocks = num_blocks    # as last reported by the replica
+        self.pending_tokens = 0    # uncached prompt plus max output tokens of unfinished requests
+
+    def num_cached_blocks(self, hashes: list[int]) -> int:
+        n = 0
+        while n < len(hashes) and hashes[n] in self.cached:
+            n += 1
+        return n
+
+    def touch(self, hashes: list[int]):
+        for h in hashes:
+            self.cached[h] = None
+            self.cached.move_to_end(h)
+        while len(self.cached) > self.num_blocks:
+            self.cached.popitem(last=False)
+
+
+class Router:
+    # sends a request to the replica with the least estimated work for it: the prompt tokens its prefix
+    # cache misses plus load_weight times the tokens already pending there. Replicas that reported too
+    # few free KV blocks for the request are only used when none has room.
+
+    def __init__(self, num_blocks: list[int], block_size: int, load_weight: float = 1.):
+        self.block_size = block_size
+        self.load_weight = load_weight
+        self.replicas = [ReplicaState(n) for n in num_blocks]
+
+    def route(self, token_ids: list[int], max_tokens: int, seed: int = -1) -> tuple[int, int]:
+        hashes = prefix_hashes(token_ids, self.block_size, seed)
+        num_blocks = (len(token_ids) + max_tokens + self.block_size - 1) // self.block_size
+        def score(i):
+            replica = self.replicas[i]
+            num_cached = replica.num_cached_blocks(hashes)
+            uncached = len(token_ids) - num_cached * self.block_size
+            return replica.num_free_blocks < num_blocks - num_cached, uncached + self.load_weight * replica.pending_tokens
+        i = min(range(len(self.replicas)), key=score)
+        replica = self.replicas[i]
+        cost = len(token_ids) - replica.num_cached_blocks(hashes) * self.block_size + max_tokens
+        replica.touch(hashes)
+        replica.pending_tokens += cost
+        return i, cost
+
+    def finish(self, i: int, cost: int):
+        self.replicas[i].pending_tokens -= cost
+
+    def report(self, i: int, num_free_blocks: int):
+        self.replicas[i].num_free_blocks = num_free_blocks
+
+
+def replica_main(dp_rank: int, model: str, mock: bool, kwargs: dict, inbox, outbox):
+    if mock:
+        config_fields = {field.name for field in fields(Config)}
+        engine = MockLLMEngine(Config(model, data_parallel_rank=dp_rank, **{k: v for k, v in kwargs.items() if k in config_fields}))
+    else:
+        engine = LLMEngine(model, data_parallel_rank=dp_rank, **kwargs)
+    block_manager = engine.scheduler.block_manager
+    outbox.put((dp_rank, len(block_manager.blocks), block_manager.block_size))
+    request_ids = {}
+    while True:
+        while True:
+            try:
+                msg = inbox.get(block=engine.is_finished())
+            except queue.Empty:
+                break
+            if msg is None:    # a child joins its own children before atexit handlers run
+                atexit.unregister(engine.exit)
+                engine.exit()
+                return
+            if msg == "stats":
+                outbox.put((dp_rank, "stats", engine.get_stats()))
+                continue
+            request_id, token_ids, sampling_params = msg
+            seq = engine.add_request(token_ids, sampling_params)
+            request_ids[seq.seq_id] = request_id
+        outputs, _ = engine.step()
+        if outputs:
+            outputs = [(request_ids.pop(seq_id), token_ids, metrics) for seq_id, token_ids, metrics in outputs]
+            outbox.put((dp_rank, outputs, len(block_manager.free_block_ids)))
+
+
+class DataParallelEngine:
+    # owns data_parallel_size engine processes, each with its own model runners, and routes requests to
+    # them by prefix affinity. With mock=True the replicas are MockLLMEngines and need num_kvcache_blocks.
+
+    def __init__(self, model, data_parallel_size: int = 2, mock: bool = False, load_weight: float = 1., **kwargs):
+        ctx = mp.get_context("spawn")
+        self.outbox = ctx.Queue()
+        self.inboxes = []
+        self.ps = []
+        for i in range(data_parallel_size):
+            inbox = ctx.Queue()
+            process = ctx.Process(target=replica_main, args=(i, model, mock, kwargs, inbox, self.outbox))
+            process.start()
+            self.inboxes.append(inbox)
+            self.ps.append(process)
+        num_blocks = [0] * data_parallel_size
+        for _ in range(data_parallel_size):
+            i, n, block_size = self.outbox.get()
+            num_blocks[i] = n
+        self.router = Router(num_blocks, block_size, load_weight)
+        self.tokenizer = AutoTokenizer.from_pretrained(model, use_fast=True) if not mock or os.path.isdir(model) else None
+        self.request_counter = count()
+        self.in_flight = {}    # request_id -> (replica, cost)
+        atexit.register(self.exit)
+
+    def exit(self):
+        for inbox in self.inboxes:
+            inbox.put(None)
+        for p in self.ps:
+            p.join()
+        self.ps = []
+        self.inboxes = []
+
+    def add_request(self, prompt: str | list[int], sampling_params: SamplingParams) -> int:
+        if isinstance(prompt, str):
+            prompt = self.tokenizer.encode(prompt) if self.tokenizer is not None else list(prompt.encode())
+        request_id = next(self.request_counter)
+        seed = BlockManager.hash_seed(sampling_params.lora_id, sampling_params.sliding_window, sampling_params.num_sink_tokens)
+        i, cost = self.router.route(prompt, sampling_params.max_tokens, seed)
+        self.in_flight[request_id] = i, cost
+        self.inboxes[i].put((request_id, prompt, sampling_params))
+        return request_id
+
+    def get_outputs(self) -> list[tuple[int, list[int], dict]]:
+        i, outputs, num_free_blocks = self.outbox.get()
+        self.router.report(i, num_free_blocks)
+        for request_id, _, _ in outputs:
+            self.router.finish(*self.in_flight.pop(request_id))
+        return outputs
+
+    def get_stats(self) -> dict:
+        assert not self.in_flight
+        for inbox in self.inboxes:
+            inbox.put("stats")
+        replicas = [None] * len(self.inboxes)
+        for _ in self.inboxes:
+            i, _, stats = self.outbox.get()
+            replicas[i] = stats
+        queries = sum(stats["prefix_cache_queries_total"] for stats in replicas)
+        hits = sum(stats["prefix_cache_hits_total"] for stats in replicas)
+        return dict(prefix_cache_hit_rate=hits / queries if queries else 0., replicas=replicas)
+
+    def generate(
+        self,
+        prompts: list[str] | list[list[int]],
+        sampling_params: SamplingParams | list[SamplingParams],
+        use_tqdm: bool = True,
+    ) -> list[dict]:
+        if use_tqdm:
+            pbar = tqdm(total=len(prompts), desc="Generating", dynamic_ncols=True)
+        if not isinstance(sampling_params, list):
+            sampling_params = [sampling_params] * len(prompts)
+        request_ids = [self.add_request(prompt, sp) for prompt, sp in zip(prompts, sampling_params)]
+        outputs = {}
+        while self.in_flight:
+            for request_id, token_ids, metrics in self.get_outputs():
+                text = self.tokenizer.decode(token_ids) if self.tokenizer is not None else None
+                outputs[request_id] = {"text": text, "token_ids": token_ids, "metrics": metrics}
+                if use_tqdm:
+                    pbar.update(1)
+        if use_tqdm:
+            pbar.close()
+        return [outputs[request_id] for request_id in request_ids]
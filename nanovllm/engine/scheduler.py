@@ -1,8 +1,12 @@
 from collections import deque
+from time import perf_counter
 
 from nanovllm.config import Config
 from nanovllm.engine.sequence import Sequence, SequenceStatus
 from nanovllm.engine.block_manager import BlockManager
+from nanovllm.engine.policies import FairWaitingQueue, PREEMPTION_POLICIES
+from nanovllm.utils.guided_decoding import TokenFSM, get_token_fsm
+from nanovllm.utils.tracing import tracer, ScheduleEvent, PreemptEvent
 
 
 class Scheduler:
@@ -11,95 +15,133 @@ class Scheduler:
         self.max_num_seqs = config.max_num_seqs
         self.max_num_batched_tokens = config.max_num_batched_tokens
         self.eos = config.eos
-        print(config.num_kvcache_blocks, config.kvcache_block_size)
-        self.block_manager = BlockManager(config.num_kvcache_blocks, config.kvcache_block_size)
-        self.waiting: deque[Sequence] = deque()
+        self.block_manager = BlockManager(config.num_kvcache_blocks, config.kvcache_block_size,
+                                          config.host_kv_cache_blocks, config.disk_kv_cache_blocks, config.tenant_max_kv_blocks)
+        self.waiting = FairWaitingQueue(config.tenant_weights)
         self.running: deque[Sequence] = deque()
+        self.select_victim = PREEMPTION_POLICIES[config.preemption_policy]
+        self.lora_ids = set(config.lora_adapters or ())
+        self.max_loras = config.max_loras
+        self.model = config.model
+        self.vocab_size = config.hf_config.vocab_size
+        self.num_preemptions = 0
+        self.clock = perf_counter
 
     def is_finished(self):
         return not self.waiting and not self.running
 
     def add(self, seq: Sequence):
-        self.waiting.append(seq)
+        assert seq.num_blocks <= self.block_manager.tenant_max_blocks.get(seq.tenant, seq.num_blocks), "prompt exceeds the tenant's KV block cap"
+        assert seq.lora_id is None or seq.lora_id in self.lora_ids, f"unknown LoRA adapter {seq.lora_id}"
+        if seq.guide_key is not None:
+            self.guide(seq)    # compile the pattern now, so a bad one fails its own request
+        seq.arrival_time = self.clock()
+        self.waiting.push(seq)
 
     def schedule(self) -> tuple[list[Sequence], bool]:
         # prefill
         scheduled_seqs = []
         num_seqs = 0
         num_batched_tokens = 0
-        break_reason = None
+        reason = None
+        capped_tenants = set()
+        # every adapter of the running sequences needs a slot in the same decode batch
+        lora_ids = {seq.lora_id for seq in self.running if seq.lora_id is not None} if self.lora_ids else set()
         while self.waiting and num_seqs < self.max_num_seqs:
-            seq = self.waiting[0]
-            if Config.DEBUG_SCHEDULER:
-                print(f"Trying to prefill for seq {seq.seq_id}, can_allocate? {self.block_manager.can_allocate(seq)}")
-            # 🟢 新增：印出 prompt 開頭 tokens，幫助比對內容
-            if Config.DEBUG_BLOCK_MANAGER_LV2:
-                print(f"  🔍 Prompt prefix: {seq.token_ids[:10]}...")
-            if num_batched_tokens + len(seq) > self.max_num_batched_tokens:
-                break_reason = "token budget exceeded"
+            seq = self.waiting.peek(capped_tenants)
+            if seq is None:
+                reason = "tenant block caps reached"
                 break
-            if not self.block_manager.can_allocate(seq):
-                break_reason = "cannot allocate blocks"
+            if num_batched_tokens + seq.num_resident_tokens > self.max_num_batched_tokens:
+                reason = "token budget exceeded"
                 break
+            if not self.block_manager.can_allocate(seq):
+                if self.block_manager.tenant_has_room(seq, seq.num_resident_blocks):
+                    reason = "cannot allocate blocks"
+                    break
+                capped_tenants.add(seq.tenant)
+                continue
+            if seq.lora_id is not None and seq.lora_id not in lora_ids:
+                if len(lora_ids) >= self.max_loras:
+                    reason = "LoRA slots full"
+                    break
+                lora_ids.add(seq.lora_id)
             num_seqs += 1
-            if Config.DEBUG_BLOCK_MANAGER_LV2:
-                print(f"Actually allocating for seq {seq.seq_id}")
             self.block_manager.allocate(seq)
-            num_batched_tokens += len(seq) - seq.num_cached_tokens
+            num_batched_tokens += seq.num_uncached_tokens
             seq.status = SequenceStatus.RUNNING
-            self.waiting.popleft()
-            self.running.append(seq)
+            if seq.first_scheduled_time is None:
+                seq.first_scheduled_time = self.clock()
+            self.waiting.pop()
+            self.waiting.charge(seq.tenant, seq.num_uncached_tokens)
+            self.add_running(seq)
             scheduled_seqs.append(seq)
-        else:
-            if not self.waiting:
-                break_reason = "no more waiting sequences"
-            else:
-                break_reason = "max num seqs reached"
-        if Config.DEBUG_SCHEDULER and break_reason:
-            print(f"[Scheduler] Prefill loop exited because: {break_reason}")
         if scheduled_seqs:
+            if tracer.enabled:
+                tracer.emit(ScheduleEvent(True, [seq.seq_id for seq in scheduled_seqs], num_batched_tokens, reason))
             return scheduled_seqs, True
 
         # decode
         while self.running and num_seqs < self.max_num_seqs:
             seq = self.running.popleft()
-            if Config.DEBUG_SCHEDULER:
-                print(f"Trying to append for seq {seq.seq_id}, can_append? {self.block_manager.can_append(seq)}")
             while not self.block_manager.can_append(seq):
-                if Config.DEBUG_PREEMPT:
-                    print(f"[BLOCK SHORTAGE] seq {seq.seq_id} needs to append but no free blocks!")
-                if self.running:
-                    victim = self.running.pop()
-                    if Config.DEBUG_PREEMPT:
-                        print(f"  ➤ Preempting victim seq {victim.seq_id} to free blocks...")
-                    self.preempt(victim)
-                else:
-                    self.preempt(seq)
+                candidates = self.running
+                if not self.block_manager.tenant_has_room(seq, 1):    # only the tenant's own sequences free its quota
+                    candidates = deque(other for other in self.running if other.tenant == seq.tenant)
+                victim = self.select_victim(seq, candidates, self.block_manager)
+                self.preempt(victim)
+                if victim is seq:
                     break
+                self.running.remove(victim)
             else:
                 num_seqs += 1
-                if Config.DEBUG_BLOCK_MANAGER_LV2:
-                    print(f"Actually may_appending for seq {seq.seq_id}")
                 self.block_manager.may_append(seq)
+                self.waiting.charge(seq.tenant, 1)
                 scheduled_seqs.append(seq)
         assert scheduled_seqs
         self.running.extendleft(reversed(scheduled_seqs))
+        if tracer.enabled:
+            tracer.emit(ScheduleEvent(False, [seq.seq_id for seq in scheduled_seqs], num_seqs, reason))
         return scheduled_seqs, False
 
+    def add_running(self, seq: Sequence):
+        # keep running ordered by priority, so higher priority sequences get decode slots and blocks first
+        if not self.running or self.running[-1].priority <= seq.priority:
+            self.running.append(seq)
+            return
+        i = next(i for i, other in enumerate(self.running) if other.priority > seq.priority)
+        self.running.insert(i, seq)
+
     def preempt(self, seq: Sequence):
-        if Config.DEBUG_PREEMPT:
-            print(f"[PREEMPT] seq {seq.seq_id:2d} | "
-                f"status: {seq.status.name:8s} | "
-                f"tokens: {seq.num_tokens:4d} (prompt: {seq.num_prompt_tokens:3d}, comp: {seq.num_completion_tokens:3d}) | "
-                f"blocks: {len(seq.block_table):2d} {seq.block_table}")
+        if tracer.enabled:
+            tracer.emit(PreemptEvent(seq.seq_id, seq.num_tokens, seq.num_prompt_tokens, list(seq.block_table)))
+        self.num_preemptions += 1
         seq.status = SequenceStatus.WAITING
         self.block_manager.deallocate(seq)
-        self.waiting.appendleft(seq)
+        self.waiting.push(seq)
+
+    def guide(self, seq: Sequence) -> TokenFSM:
+        return get_token_fsm(self.model, self.vocab_size, seq.guide_key, seq.guided_pattern)
 
-    def postprocess(self, seqs: list[Sequence], token_ids: list[int]) -> list[bool]:
+    def postprocess(self, seqs: list[Sequence], token_ids: list[int | list[float]]) -> list[bool]:
+        now = self.clock()
         for seq, token_id in zip(seqs, token_ids):
+            if seq.pooling is not None:    # prefill-only, done after its one step
+                seq.pooled_output = token_id
+                seq.token_times.append(now)
+                self.finish(seq, now)
+                continue
             seq.append_token(token_id)
-            if (not seq.ignore_eos and token_id == self.eos) or seq.num_completion_tokens == seq.max_tokens:
-                seq.status = SequenceStatus.FINISHED
-                self.block_manager.deallocate(seq)
-                self.running.remove(seq)
+            seq.token_times.append(now)
+            if seq.guide_key is not None:
+                seq.guide_state = self.guide(seq).next_state(seq.guide_state, token_id)
+            # a guided sequence only samples EOS once its pattern is complete
+            eos = token_id == self.eos and (not seq.ignore_eos or seq.guide_key is not None)
+            if eos or seq.num_completion_tokens == seq.max_tokens:
+                self.finish(seq, now)
+
+    def finish(self, seq: Sequence, now: float):
+        seq.status = SequenceStatus.FINISHED
+        seq.finish_time = now
+        self.block_manager.deallocate(seq)
+        self.running.remove(seq)
@@ -3,6 +3,7 @@ from enum import Enum, auto
 from itertools import count
 
 from nanovllm.sampling_params import SamplingParams
+from nanovllm.utils.guided_decoding import guide_pattern, pattern_key
 
 
 class SequenceStatus(Enum):
@@ -23,10 +24,26 @@ class Sequence:
         self.num_tokens = len(self.token_ids)
         self.num_prompt_tokens = len(token_ids)
         self.num_cached_tokens = 0
+        self.num_dropped_blocks = 0
         self.block_table = []
         self.temperature = sampling_params.temperature
         self.max_tokens = sampling_params.max_tokens
         self.ignore_eos = sampling_params.ignore_eos
+        self.sliding_window = sampling_params.sliding_window
+        self.num_sink_tokens = sampling_params.num_sink_tokens
+        self.priority = sampling_params.priority
+        self.tenant = sampling_params.tenant
+        self.lora_id = sampling_params.lora_id
+        self.guided_pattern = guide_pattern(sampling_params)
+        self.guide_key = pattern_key(self.guided_pattern) if self.guided_pattern is not None else None
+        self.guide_state = 0
+        self.pooling = None    # "last", "mean" or "logprobs" for prefill-only embedding and scoring sequences
+        self.output_start = 0    # the first position whose hidden state the pooling needs
+        self.pooled_output = None
+        self.arrival_time = None
+        self.first_scheduled_time = None
+        self.token_times = []
+        self.finish_time = None
 
     def __len__(self):
         return self.num_tokens
@@ -54,6 +71,31 @@ class Sequence:
     def num_cached_blocks(self):
         return self.num_cached_tokens // self.block_size
 
+    @property
+    def num_sink_blocks(self):
+        return (self.num_sink_tokens + self.block_size - 1) // self.block_size
+
+    @property
+    def num_resident_tokens(self):
+        return self.num_tokens - self.num_dropped_blocks * self.block_size
+
+    @property
+    def num_uncached_tokens(self):
+        return self.num_resident_tokens - self.num_cached_tokens
+
+    @property
+    def num_resident_blocks(self):
+        return self.num_blocks - self.num_dropped_blocks
+
+    def is_dropped_block(self, i: int) -> bool:
+        return self.num_sink_blocks <= i < self.num_sink_blocks + self.num_dropped_blocks
+
+    def resident_positions(self) -> range | list[int]:
+        if not self.num_dropped_blocks:
+            return range(self.num_tokens)
+        sink_end = self.num_sink_blocks * self.block_size
+        return [*range(sink_end), *range(sink_end + self.num_dropped_blocks * self.block_size, self.num_tokens)]
+
     @property
     def num_blocks(self):
         return (self.num_tokens + self.block_size - 1) // self.block_size
@@ -62,6 +104,17 @@ class Sequence:
     def last_block_num_tokens(self):
         return self.num_tokens - (self.num_blocks - 1) * self.block_size
 
+    @property
+    def metrics(self):
+        first_token_time = self.token_times[0] if self.token_times else None
+        num_decode_tokens = len(self.token_times) - 1
+        return dict(
+            queue_time=self.first_scheduled_time - self.arrival_time if self.first_scheduled_time is not None else None,
+            ttft=first_token_time - self.arrival_time if first_token_time is not None else None,
+            tpot=(self.token_times[-1] - first_token_time) / num_decode_tokens if num_decode_tokens > 0 else None,
+            e2e_latency=self.finish_time - self.arrival_time if self.finish_time is not None else None,
+        )
+
     def block(self, i):
         assert 0 <= i < self.num_blocks
         return self.token_ids[i*self.block_size: (i+1)*self.block_size]
@@ -72,11 +125,16 @@ class Sequence:
         self.num_tokens += 1
 
     def __getstate__(self):
-        return (self.num_tokens, self.num_prompt_tokens, self.num_cached_tokens, self.block_table,
-                self.token_ids if self.num_completion_tokens == 0 else self.last_token)
+        # like the prompt, the guided decoding pattern is only sent with the first prefill
+        prefill = self.num_completion_tokens == 0
+        return (self.num_tokens, self.num_prompt_tokens, self.num_cached_tokens, self.num_dropped_blocks, self.num_sink_tokens,
+                self.block_table, self.temperature, self.lora_id, self.guide_key, self.guide_state, self.guided_pattern if prefill else None,
+                self.pooling, self.output_start, self.token_ids if prefill else self.last_token)
 
     def __setstate__(self, state):
-        self.num_tokens, self.num_prompt_tokens, self.num_cached_tokens, self.block_table = state[:-1]
+        (self.num_tokens, self.num_prompt_tokens, self.num_cached_tokens, self.num_dropped_blocks, self.num_sink_tokens,
+         self.block_table, self.temperature, self.lora_id, self.guide_key, self.guide_state, self.guided_pattern,
+         self.pooling, self.output_start) = state[:-1]
         if self.num_completion_tokens == 0:
             self.token_ids = state[-1]
         else:
@@ -0,0 +1,107 @@
+from nanovllm.config import Config
+from nanovllm.engine.sequence import Sequence
+from nanovllm.engine.mock_model_runner import MockModelRunner, MockLLMEngine
+from nanovllm.utils.memory_profiler import get_head_dim, weight_bytes, kv_block_bytes, dtype_bytes
+from nanovllm.utils.workload import Request, replay, summarize
+
+
+class CostModel:
+
+    def step_time(self, seqs: list[Sequence], is_prefill: bool) -> float:
+        raise NotImplementedError
+
+
+class LinearCostModel(CostModel):
+    # step time linear in computed prompt tokens for prefill, in batch size and attended tokens for decode,
+    # coefficients are meant to be fitted from bench.py step timings
+
+    def __init__(
+        self,
+        prefill_base: float = 5e-3,
+        prefill_per_token: float = 5e-5,
+        decode_base: float = 8e-3,
+        decode_per_seq: float = 5e-5,
+        decode_per_context_token: float = 5e-8,
+    ):
+        self.prefill_base = prefill_base
+        self.prefill_per_token = prefill_per_token
+        self.decode_base = decode_base
+        self.decode_per_seq = decode_per_seq
+        self.decode_per_context_token = decode_per_context_token
+
+    def step_time(self, seqs, is_prefill):
+        if is_prefill:
+            return self.prefill_base + self.prefill_per_token * sum(seq.num_uncached_tokens for seq in seqs)
+        return (self.decode_base + self.decode_per_seq * len(seqs) +
+                self.decode_per_context_token * sum(seq.num_resident_tokens for seq in seqs))
+
+
+class RooflineCostModel(CostModel):
+    # max of compute and memory time per step from the model shape and accelerator peaks, defaults are an A100
+
+    def __init__(
+        self,
+        hf_config,
+        tensor_parallel_size: int = 1,
+        peak_flops: float = 312e12,
+        memory_bandwidth: float = 2.0e12,
+        flops_efficiency: float = 0.5,
+        bandwidth_efficiency: float = 0.8,
+        step_overhead: float = 2e-3,
+    ):
+        self.weight_bytes = weight_bytes(hf_config, tensor_parallel_size)
+        self.num_params = self.weight_bytes // dtype_bytes(hf_config)
+        self.kv_token_bytes = kv_block_bytes(hf_config, 1, tensor_parallel_size)
+        self.attention_width = hf_config.num_hidden_layers * hf_config.num_attention_heads * get_head_dim(hf_config) // tensor_parallel_size
+        self.flops = peak_flops * flops_efficiency
+        self.bandwidth = memory_bandwidth * bandwidth_efficiency
+        self.step_overhead = step_overhead
+
+    def step_time(self, seqs, is_prefill):
+        if is_prefill:
+            new_tokens = [seq.num_uncached_tokens for seq in seqs]
+            flops = 2 * self.num_params * sum(new_tokens)
+            flops += 4 * self.attention_width * sum(n * len(seq) for n, seq in zip(new_tokens, seqs))
+            memory = self.weight_bytes + self.kv_token_bytes * sum(len(seq) for seq in seqs)
+        else:
+            context = sum(seq.num_resident_tokens for seq in seqs)
+            flops = 2 * self.num_params * len(seqs) + 4 * self.attention_width * context
+            memory = self.weight_bytes + self.kv_token_bytes * context
+        return self.step_overhead + max(flops / self.flops, memory / self.bandwidth)
+
+
+class VirtualClock:
+
+    def __init__(self):
+        self.now = 0.
+
+    def __call__(self) -> float:
+        return self.now
+
+    def advance(self, seconds: float):
+        self.now += max(seconds, 0.)
+
+
+class SimulatedModelRunner(MockModelRunner):
+
+    def __init__(self, config: Config, cost_model: CostModel, clock: VirtualClock, seed: int = 0):
+        super().__init__(config, seed)
+        self.cost_model = cost_model
+        self.clock = clock
+
+    def run(self, seqs, is_prefill):
+        step_time = self.cost_model.step_time(seqs, is_prefill)
+        self.clock.advance(step_time)
+        self.timings = (0., step_time, 0.)
+        return super().run(seqs, is_prefill)
+
+
+def simulate(config: Config, requests: list[Request], cost_model: CostModel, seed: int = 0) -> dict:
+    # replays requests through the real Scheduler and BlockManager on a virtual clock advanced by the cost model
+    clock = VirtualClock()
+    engine = MockLLMEngine(config, model_runner=SimulatedModelRunner(config, cost_model, clock, seed))
+    engine.scheduler.clock = clock
+    seqs, duration = replay(engine, requests, wait=clock.advance)
+    results = summarize(seqs, duration, engine.get_stats())
+    results["preemption_rate"] = results["num_preemptions"] / max(len(seqs), 1)
+    return results
@@ -0,0 +1,308 @@
+from abc import ABC, abstractmethod
+import torch
+import torch.nn.functional as F
+import triton
+import triton.language as tl
+
+try:
+    from flash_attn import flash_attn_varlen_func, flash_attn_with_kvcache
+except ImportError:
+    flash_attn_varlen_func = flash_attn_with_kvcache = None
+from nanovllm.engine.sequence import Sequence
+from nanovllm.utils.context import get_context
+
+
+ATTENTION_BACKENDS: dict[str, type["AttentionBackend"]] = {}
+
+
+def register_attention_backend(name: str):
+    def decorator(cls):
+        assert not cls.__abstractmethods__, f"attention backend {name!r} does not implement {sorted(cls.__abstractmethods__)}"
+        cls.name = name
+        ATTENTION_BACKENDS[name] = cls
+        return cls
+    return decorator
+
+
+def get_attention_backend(name: str, device: str = "cuda") -> type["AttentionBackend"]:
+    if name == "auto":
+        name = "flash_attn" if device == "cuda" and flash_attn_varlen_func is not None else "sdpa"
+    assert name in ATTENTION_BACKENDS, f"unknown attention backend {name!r}, choose from {list(ATTENTION_BACKENDS)}"
+    return ATTENTION_BACKENDS[name]
+
+
+class AttentionBackend(ABC):
+    name = ""
+    supports_cudagraph = False
+
+    def __init__(self, runner):
+        self.runner = runner
+
+    def prepare_prefill(self, seqs: list[Sequence], cu_seqlens_q: list[int], cu_seqlens_k: list[int],
+                        max_seqlen_q: int, max_seqlen_k: int) -> dict:
+        block_tables = None
+        if cu_seqlens_k[-1] > cu_seqlens_q[-1]:    # prefix cache
+            block_tables = self.runner.prepare_block_tables(seqs)
+        return dict(
+            cu_seqlens_q=self.runner.to_device(cu_seqlens_q, torch.int32),
+            cu_seqlens_k=self.runner.to_device(cu_seqlens_k, torch.int32),
+            max_seqlen_q=max_seqlen_q,
+            max_seqlen_k=max_seqlen_k,
+            block_tables=block_tables,
+        )
+
+    def prepare_decode(self, seqs: list[Sequence], context_lens: list[int]) -> dict:
+        return dict(
+            context_lens=self.runner.to_device(context_lens, torch.int32),
+            block_tables=self.runner.prepare_block_tables(seqs),
+        )
+
+    @abstractmethod
+    def forward(self, q: torch.Tensor, k: torch.Tensor, v: torch.Tensor,
+                k_cache: torch.Tensor, v_cache: torch.Tensor, scale: float) -> torch.Tensor:
+        ...
+
+
+@register_attention_backend("flash_attn")
+class FlashAttentionBackend(AttentionBackend):
+    supports_cudagraph = True
+
+    def __init__(self, runner):
+        assert flash_attn_varlen_func is not None, "flash_attn is not installed"
+        super().__init__(runner)
+
+    def forward(self, q, k, v, k_cache, v_cache, scale):
+        context = get_context()
+        if context.is_prefill:
+            if context.block_tables is not None:    # prefix cache
+                k, v = k_cache, v_cache
+            return flash_attn_varlen_func(q, k, v,
+                                          max_seqlen_q=context.max_seqlen_q, cu_seqlens_q=context.cu_seqlens_q,
+                                          max_seqlen_k=context.max_seqlen_k, cu_seqlens_k=context.cu_seqlens_k,
+                                          softmax_scale=scale, causal=True, block_table=context.block_tables)
+        return flash_attn_with_kvcache(q.unsqueeze(1), k_cache, v_cache,
+                                       cache_seqlens=context.context_lens, block_table=context.block_tables,
+                                       softmax_scale=scale, causal=True)
+
+
+def sdpa_attention(q: torch.Tensor, k: torch.Tensor, v: torch.Tensor, scale: float):
+    seqlen_q, seqlen_k = q.size(0), k.size(0)
+    num_groups = q.size(1) // k.size(1)
+    k = k.repeat_interleave(num_groups, 1)
+    v = v.repeat_interleave(num_groups, 1)
+    mask = torch.ones(seqlen_q, seqlen_k, dtype=torch.bool, device=q.device).tril(seqlen_k - seqlen_q)
+    o = F.scaled_dot_product_attention(q.transpose(0, 1), k.transpose(0, 1), v.transpose(0, 1), attn_mask=mask, scale=scale)
+    return o.transpose(0, 1)
+
+
+def sdpa_varlen_attention(
+    q: torch.Tensor,
+    k: torch.Tensor,
+    v: torch.Tensor,
+    cu_seqlens_q: torch.Tensor,
+    seqlens_k: torch.Tensor,
+    scale: float,
+    block_tables: torch.Tensor | None = None,
+):
+    # reference path: k and v are packed like q, or paged caches when block_tables is given
+    cu_seqlens_q = cu_seqlens_q.tolist()
+    seqlens_k = seqlens_k.tolist()
+    o = torch.empty_like(q)
+    start_k = 0
+    for i, seqlen_k in enumerate(seqlens_k):
+        start_q, end_q = cu_seqlens_q[i], cu_seqlens_q[i + 1]
+        if block_tables is None:
+            k_i = k[start_k:start_k + seqlen_k]
+            v_i = v[start_k:start_k + seqlen_k]
+            start_k += seqlen_k
+        else:
+            block_size = k.size(1)
+            block_ids = block_tables[i, :(seqlen_k + block_size - 1) // block_size]
+            k_i = k[block_ids].flatten(0, 1)[:seqlen_k]
+            v_i = v[block_ids].flatten(0, 1)[:seqlen_k]
+        o[start_q:end_q] = sdpa_attention(q[start_q:end_q], k_i, v_i, scale)
+    return o
+
+
+@register_attention_backend("sdpa")
+class SDPABackend(AttentionBackend):
+
+    def forward(self, q, k, v, k_cache, v_cache, scale):
+        context = get_context()
+        if context.is_prefill:
+            seqlens_k = context.cu_seqlens_k.diff()
+            if context.block_tables is not None:    # prefix cache
+                k, v = k_cache, v_cache
+            return sdpa_varlen_attention(q, k, v, context.cu_seqlens_q, seqlens_k, scale, context.block_tables)
+        cu_seqlens_q = torch.arange(q.size(0) + 1, dtype=torch.int32, device=q.device)
+        return sdpa_varlen_attention(q, k_cache, v_cache, cu_seqlens_q, context.context_lens, scale, context.block_tables)
+
+
+@triton.jit
+def paged_attention_kernel(
+    q_ptr,
+    k_cache_ptr,
+    v_cache_ptr,
+    o_ptr,
+    cu_seqlens_q_ptr,
+    seqlens_k_ptr,
+    block_tables_ptr,
+    scale,
+    q_stride_t,
+    q_stride_h,
+    o_stride_t,
+    o_stride_h,
+    cache_stride_b,
+    cache_stride_s,
+    cache_stride_h,
+    block_tables_stride,
+    NUM_QUERIES_PER_KV: tl.constexpr,
+    BLOCK_SIZE: tl.constexpr,
+    HEAD_DIM: tl.constexpr,
+    BLOCK_M: tl.constexpr,
+    BLOCK_N: tl.constexpr,
+):
+    seq_idx = tl.program_id(0)
+    head_idx = tl.program_id(1)
+    m_block = tl.program_id(2)
+    q_start = tl.load(cu_seqlens_q_ptr + seq_idx)
+    seqlen_q = tl.load(cu_seqlens_q_ptr + seq_idx + 1) - q_start
+    if m_block * BLOCK_M >= seqlen_q:
+        return
+    seqlen_k = tl.load(seqlens_k_ptr + seq_idx)
+    kv_head_idx = head_idx // NUM_QUERIES_PER_KV
+    offs_m = m_block * BLOCK_M + tl.arange(0, BLOCK_M)
+    offs_d = tl.arange(0, HEAD_DIM)
+    mask_m = offs_m < seqlen_q
+    q = tl.load(q_ptr + (q_start + offs_m)[:, None] * q_stride_t + head_idx * q_stride_h + offs_d[None, :],
+                mask=mask_m[:, None], other=0.0)
+    q_pos = seqlen_k - seqlen_q + offs_m
+    m_i = tl.full([BLOCK_M], -1e30, dtype=tl.float32)
+    l_i = tl.zeros([BLOCK_M], dtype=tl.float32)
+    acc = tl.zeros([BLOCK_M, HEAD_DIM], dtype=tl.float32)
+    end_n = tl.minimum(seqlen_k, seqlen_k - seqlen_q + (m_block + 1) * BLOCK_M)
+    for start_n in range(0, end_n, BLOCK_N):
+        offs_n = start_n + tl.arange(0, BLOCK_N)
+        mask_n = offs_n < seqlen_k
+        block_ids = tl.load(block_tables_ptr + seq_idx * block_tables_stride + offs_n // BLOCK_SIZE, mask=mask_n, other=0)
+        kv_offsets = block_ids * cache_stride_b + (offs_n % BLOCK_SIZE) * cache_stride_s + kv_head_idx * cache_stride_h
+        k = tl.load(k_cache_ptr + kv_offsets[:, None] + offs_d[None, :], mask=mask_n[:, None], other=0.0)
+        v = tl.load(v_cache_ptr + kv_offsets[:, None] + offs_d[None, :], mask=mask_n[:, None], other=0.0)
+        s = tl.dot(q, tl.trans(k)) * scale
+        s = tl.where((offs_n[None, :] <= q_pos[:, None]) & mask_n[None, :], s, float("-inf"))
+        m_new = tl.maximum(m_i, tl.max(s, 1))
+        p = tl.exp(s - m_new[:, None])
+        alpha = tl.exp(m_i - m_new)
+        l_i = l_i * alpha + tl.sum(p, 1)
+        acc = acc * alpha[:, None] + tl.dot(p.to(v.dtype), v)
+        m_i = m_new
+    acc = acc / l_i[:, None]
+    tl.store(o_ptr + (q_start + offs_m)[:, None] * o_stride_t + head_idx * o_stride_h + offs_d[None, :],
+             acc.to(o_ptr.dtype.element_ty), mask=mask_m[:, None])
+
+
+def paged_attention(
+    q: torch.Tensor,
+    k_cache: torch.Tensor,
+    v_cache: torch.Tensor,
+    cu_seqlens_q: torch.Tensor,
+    seqlens_k: torch.Tensor,
+    block_tables: torch.Tensor,
+    max_seqlen_q: int,
+    scale: float,
+):
+    _, num_heads, head_dim = q.shape
+    block_size, num_kv_heads = k_cache.size(1), k_cache.size(2)
+    assert k_cache.stride() == v_cache.stride() and k_cache.stride(-1) == 1
+    o = torch.empty_like(q)
+    BLOCK_M = 16 if max_seqlen_q <= 16 else 64
+    grid = (seqlens_k.numel(), num_heads, triton.cdiv(max_seqlen_q, BLOCK_M))
+    paged_attention_kernel[grid](
+        q, k_cache, v_cache, o, cu_seqlens_q, seqlens_k, block_tables, scale,
+        q.stride(0), q.stride(1), o.stride(0), o.stride(1),
+        k_cache.stride(0), k_cache.stride(1), k_cache.stride(2), block_tables.stride(0),
+        num_heads // num_kv_heads, block_size, head_dim, BLOCK_M, 64,
+    )
+    return o
+
+
+@register_attention_backend("triton")
+class TritonBackend(AttentionBackend):
+    supports_cudagraph = True
+
+    def prepare_prefill(self, seqs, cu_seqlens_q, cu_seqlens_k, max_seqlen_q, max_seqlen_k):
+        if not seqs[0].block_table:    # warmup
+            return super().prepare_prefill(seqs, cu_seqlens_q, cu_seqlens_k, max_seqlen_q, max_seqlen_k)
+        return dict(
+            cu_seqlens_q=self.runner.to_device(cu_seqlens_q, torch.int32),
+            max_seqlen_q=max_seqlen_q,
+            context_lens=self.runner.to_device([seq.num_resident_tokens for seq in seqs], torch.int32),
+            block_tables=self.runner.prepare_block_tables(seqs),
+        )
+
+    def forward(self, q, k, v, k_cache, v_cache, scale):
+        context = get_context()
+        if context.is_prefill:
+            if context.block_tables is None:    # warmup, nothing is cached yet
+                return sdpa_varlen_attention(q, k, v, context.cu_seqlens_q, context.cu_seqlens_k.diff(), scale)
+            return paged_attention(q, k_cache, v_cache, context.cu_seqlens_q, context.context_lens,
+                                   context.block_tables, context.max_seqlen_q, scale)
+        cu_seqlens_q = torch.arange(q.size(0) + 1, dtype=torch.int32, device=q.device)
+        return paged_attention(q, k_cache, v_cache, cu_seqlens_q, context.context_lens,
+                               context.block_tables, 1, scale)
+
+
+@register_attention_backend("flashinfer")
+class FlashInferBackend(AttentionBackend):
+
+    def __init__(self, runner):
+        import flashinfer
+        super().__init__(runner)
+        hf_config = runner.config.hf_config
+        self.head_dim = getattr(hf_config, "head_dim", None) or hf_config.hidden_size // hf_config.num_attention_heads
+        self.num_qo_heads = hf_config.num_attention_heads // runner.tp_size
+        self.num_kv_heads = hf_config.num_key_value_heads // runner.tp_size
+        self.dtype = hf_config.torch_dtype
+        workspace = torch.empty(128 * 1024 * 1024, dtype=torch.uint8, device="cuda")
+        self.ragged_wrapper = flashinfer.BatchPrefillWithRaggedKVCacheWrapper(workspace, "NHD")
+        self.prefill_wrapper = flashinfer.BatchPrefillWithPagedKVCacheWrapper(workspace, "NHD")
+        self.decode_wrapper = flashinfer.BatchDecodeWithPagedKVCacheWrapper(workspace, "NHD")
+        self.use_ragged = False
+
+    def paged_kv_indices(self, seqs: list[Sequence]):
+        kv_indptr = [0]
+        kv_indices = []
+        kv_last_page_len = []
+        for seq in seqs:
+            kv_indices.extend(seq.block_table)
+            kv_indptr.append(len(kv_indices))
+            kv_last_page_len.append(seq.last_block_num_tokens)
+        return (self.runner.to_device(kv_indptr, torch.int32), self.runner.to_device(kv_indices, torch.int32),
+                self.runner.to_device(kv_last_page_len, torch.int32))
+
+    def prepare_prefill(self, seqs, cu_seqlens_q, cu_seqlens_k, max_seqlen_q, max_seqlen_k):
+        scale = self.head_dim ** -0.5
+        qo_indptr = self.runner.to_device(cu_seqlens_q, torch.int32)
+        self.use_ragged = not seqs[0].block_table    # warmup
+        if self.use_ragged:
+            kv_indptr = self.runner.to_device(cu_seqlens_k, torch.int32)
+            self.ragged_wrapper.plan(qo_indptr, kv_indptr, self.num_qo_heads, self.num_kv_heads, self.head_dim,
+                                     causal=True, sm_scale=scale, q_data_type=self.dtype)
+        else:
+            self.prefill_wrapper.plan(qo_indptr, *self.paged_kv_indices(seqs), self.num_qo_heads, self.num_kv_heads,
+                                      self.head_dim, self.runner.block_size, causal=True, sm_scale=scale,
+                                      q_data_type=self.dtype, kv_data_type=self.dtype)
+        return {}
+
+    def prepare_decode(self, seqs, context_lens):
+        self.decode_wrapper.plan(*self.paged_kv_indices(seqs), self.num_qo_heads, self.num_kv_heads, self.head_dim,
+                                 self.runner.block_size, sm_scale=self.head_dim ** -0.5,
+                                 q_data_type=self.dtype, kv_data_type=self.dtype)
+        return {}
+
+    def forward(self, q, k, v, k_cache, v_cache, scale):
+        if not get_context().is_prefill:
+            return self.decode_wrapper.run(q, (k_cache, v_cache))
+        if self.use_ragged:
+            return self.ragged_wrapper.run(q, k, v)
+        return self.prefill_wrapper.run(q, (k_cache, v_cache))
@@ -4,6 +4,7 @@ import torch.nn.functional as F
 import torch.distributed as dist
 
 from nanovllm.utils.context import get_context
+from nanovllm.utils.parallel_state import get_tp_group, get_tp_rank, get_tp_size, get_num_comm_chunks
 
 
 class VocabParallelEmbedding(nn.Module):
@@ -14,8 +15,8 @@ class VocabParallelEmbedding(nn.Module):
         embedding_dim: int,
     ):
         super().__init__()
-        self.tp_rank = dist.get_rank()
-        self.tp_size = dist.get_world_size()
+        self.tp_rank = get_tp_rank()
+        self.tp_size = get_tp_size()
         assert num_embeddings % self.tp_size == 0
         self.num_embeddings = num_embeddings
         self.num_embeddings_per_partition = self.num_embeddings // self.tp_size
@@ -35,10 +36,22 @@ class VocabParallelEmbedding(nn.Module):
         if self.tp_size > 1:
             mask = (x >= self.vocab_start_idx) & (x < self.vocab_end_idx)
             x = mask * (x - self.vocab_start_idx)
-        y = F.embedding(x, self.weight)
-        if self.tp_size > 1:
-            y = mask.unsqueeze(1) * y
-            dist.all_reduce(y)
+        num_chunks = get_num_comm_chunks(x.size(0))
+        if num_chunks == 1:
+            y = F.embedding(x, self.weight)
+            if self.tp_size > 1:
+                y = mask.unsqueeze(1) * y
+                dist.all_reduce(y, group=get_tp_group())
+            return y
+        y = self.weight.new_empty(x.size(0), self.weight.size(1))
+        works = []
+        chunks = zip(x.tensor_split(num_chunks), mask.tensor_split(num_chunks), y.tensor_split(num_chunks))
+        for x_chunk, mask_chunk, y_chunk in chunks:
+            torch.index_select(self.weight, 0, x_chunk, out=y_chunk)
+            y_chunk.mul_(mask_chunk.unsqueeze(1))
+            works.append(dist.all_reduce(y_chunk, group=get_tp_group(), async_op=True))
+        for work in works:
+            work.wait()
         return y
 
 
@@ -52,6 +65,7 @@ class ParallelLMHead(VocabParallelEmbedding):
     ):
         assert not bias
         super().__init__(num_embeddings, embedding_dim)
+        self.gather_logits = True    # False returns this rank's vocab shard, for VocabParallelSampler
 
     def forward(self, x: torch.Tensor):
         context = get_context()
@@ -59,8 +73,24 @@ class ParallelLMHead(VocabParallelEmbedding):
             last_indices = context.cu_seqlens_q[1:] - 1
             x = x[last_indices].contiguous()
         logits = F.linear(x, self.weight)
-        if self.tp_size > 1:
+        if self.tp_size > 1 and self.gather_logits:
             all_logits = [torch.empty_like(logits) for _ in range(self.tp_size)] if self.tp_rank == 0 else None
-            dist.gather(logits, all_logits, 0)
+            dist.gather(logits, all_logits, group_dst=0, group=get_tp_group())
             logits = torch.cat(all_logits, -1) if self.tp_rank == 0 else None
         return logits
+
+    def logprobs(self, x: torch.Tensor, token_ids: torch.Tensor) -> torch.Tensor:
+        # log_softmax over the sharded vocab at token_ids, for every row of x. The ranks exchange a max,
+        # a sum of exponentials and the target logit per row instead of gathering the logits.
+        logits = F.linear(x, self.weight).float()
+        in_shard = (token_ids >= self.vocab_start_idx) & (token_ids < self.vocab_end_idx)
+        target_logits = logits.gather(1, ((token_ids - self.vocab_start_idx) * in_shard).unsqueeze(1)).squeeze(1) * in_shard
+        max_logits = logits.max(dim=-1).values
+        if self.tp_size > 1:
+            dist.all_reduce(max_logits, dist.ReduceOp.MAX, group=get_tp_group())
+        sum_exp = logits.sub_(max_logits.unsqueeze(1)).exp_().sum(dim=-1)
+        if self.tp_size > 1:
+            sums = torch.stack([sum_exp, target_logits])
+            dist.all_reduce(sums, group=get_tp_group())
+            sum_exp, target_logits = sums
+        return target_logits - max_logits - sum_exp.log()
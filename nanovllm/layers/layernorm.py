@@ -21,7 +21,7 @@ class RMSNorm(nn.Module):
         orig_dtype = x.dtype
         x = x.float()
         var = x.pow(2).mean(dim=-1, keepdim=True)
-        x.mul_(torch.rsqrt(var + self.eps))
+        x = x * torch.rsqrt(var + self.eps)
         x = x.to(orig_dtype).mul_(self.weight)
         return x
 
@@ -32,10 +32,10 @@ class RMSNorm(nn.Module):
         residual: torch.Tensor,
     ) -> tuple[torch.Tensor, torch.Tensor]:
         orig_dtype = x.dtype
-        x = x.float().add_(residual.float())
+        x = x.float() + residual.float()
         residual = x.to(orig_dtype)
         var = x.pow(2).mean(dim=-1, keepdim=True)
-        x.mul_(torch.rsqrt(var + self.eps))
+        x = x * torch.rsqrt(var + self.eps)
         x = x.to(orig_dtype).mul_(self.weight)
         return x, residual
 
@@ -3,6 +3,8 @@ from torch import nn
 import torch.nn.functional as F
 import torch.distributed as dist
 
+from nanovllm.utils.parallel_state import get_tp_group, get_tp_rank, get_tp_size, get_num_comm_chunks
+
 
 def divide(numerator, denominator):
     assert numerator % denominator == 0
@@ -20,8 +22,8 @@ class LinearBase(nn.Module):
     ):
         super().__init__()
         self.tp_dim = tp_dim
-        self.tp_rank = dist.get_rank()
-        self.tp_size = dist.get_world_size()
+        self.tp_rank = get_tp_rank()
+        self.tp_size = get_tp_size()
         self.weight = nn.Parameter(torch.empty(output_size, input_size))
         self.weight.weight_loader = self.weight_loader
         if bias:
@@ -59,7 +61,7 @@ class ColumnParallelLinear(LinearBase):
         output_size: int,
         bias: bool = False,
     ):
-        tp_size = dist.get_world_size()
+        tp_size = get_tp_size()
         super().__init__(input_size, divide(output_size, tp_size), bias, 0)
 
     def weight_loader(self, param: nn.Parameter, loaded_weight: torch.Tensor):
@@ -103,7 +105,7 @@ class QKVParallelLinear(ColumnParallelLinear):
         total_num_kv_heads: int | None = None,
         bias: bool = False,
     ):
-        tp_size = dist.get_world_size()
+        tp_size = get_tp_size()
         total_num_kv_heads = total_num_kv_heads or total_num_heads
         self.head_size = head_size
         self.num_heads = divide(total_num_heads, tp_size)
@@ -136,18 +138,32 @@ class RowParallelLinear(LinearBase):
         output_size: int,
         bias: bool = False,
     ):
-        tp_size = dist.get_world_size()
+        tp_size = get_tp_size()
         super().__init__(divide(input_size, tp_size), output_size, bias, 1)
 
     def weight_loader(self, param: nn.Parameter, loaded_weight: torch.Tensor):
         param_data = param.data
-        shard_size = param_data.size(self.tp_dim)
-        start_idx = self.tp_rank * shard_size
-        loaded_weight = loaded_weight.narrow(self.tp_dim, start_idx, shard_size)
+        if param_data.dim() > self.tp_dim:    # the bias is not sharded
+            shard_size = param_data.size(self.tp_dim)
+            start_idx = self.tp_rank * shard_size
+            loaded_weight = loaded_weight.narrow(self.tp_dim, start_idx, shard_size)
         param_data.copy_(loaded_weight)
 
     def forward(self, x: torch.Tensor) -> torch.Tensor:
-        y = F.linear(x, self.weight, self.bias if self.tp_rank == 0 else None)
-        if self.tp_size > 1:
-            dist.all_reduce(y)
+        bias = self.bias if self.tp_rank == 0 else None
+        num_chunks = get_num_comm_chunks(x.size(0))
+        if num_chunks == 1:
+            y = F.linear(x, self.weight, bias)
+            if self.tp_size > 1:
+                dist.all_reduce(y, group=get_tp_group())
+            return y
+        y = x.new_empty(x.size(0), self.weight.size(0))
+        works = []
+        for x_chunk, y_chunk in zip(x.tensor_split(num_chunks), y.tensor_split(num_chunks)):
+            torch.matmul(x_chunk, self.weight.t(), out=y_chunk)
+            if bias is not None:
+                y_chunk.add_(bias)
+            works.append(dist.all_reduce(y_chunk, group=get_tp_group(), async_op=True))
+        for work in works:
+            work.wait()
         return y
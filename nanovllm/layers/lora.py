@@ -0,0 +1,83 @@
+import torch
+from torch import nn
+import torch.distributed as dist
+
+from nanovllm.layers.linear import LinearBase, QKVParallelLinear, MergedColumnParallelLinear, RowParallelLinear
+from nanovllm.utils.context import get_context
+from nanovllm.utils.parallel_state import get_tp_group
+
+
+class LoRALinear(nn.Module):
+    # a parallel linear plus max_loras adapter slots. A packed projection stacks one rank-max_rank block per
+    # sub-projection along the rank dimension, lora_b is zero outside each block's own output rows.
+    # Tokens are gathered per slot from context.lora_segments, so a batch mixing adapters is one forward.
+
+    def __init__(self, base: LinearBase, max_loras: int, max_rank: int):
+        super().__init__()
+        self.base = base
+        self.max_rank = max_rank
+        self.row_parallel = isinstance(base, RowParallelLinear)
+        if isinstance(base, QKVParallelLinear):
+            self.shard_ids = ["q", "k", "v"]
+        elif isinstance(base, MergedColumnParallelLinear):
+            self.shard_ids = list(range(len(base.output_sizes)))
+        else:
+            self.shard_ids = [None]
+        output_size, input_size = base.weight.shape
+        rank = max_rank * len(self.shard_ids)
+        self.register_buffer("lora_a", torch.zeros(max_loras, rank, input_size), persistent=False)
+        self.register_buffer("lora_b", torch.zeros(max_loras, output_size, rank), persistent=False)
+
+    def set_slot(self, slot: int, shard_id, lora_a: torch.Tensor, lora_b: torch.Tensor):
+        # lora_a [r, in] and lora_b [out, r] as stored by PEFT, sharded like the base weight: lora_b along
+        # the output of column parallel layers, lora_a along the input of row parallel ones
+        i = self.shard_ids.index(shard_id)
+        r = lora_a.size(0)
+        assert r <= self.max_rank
+        block = slice(i * self.max_rank, i * self.max_rank + r)
+        if self.row_parallel:
+            a = self.lora_a.new_empty(r, self.lora_a.size(2))
+            self.base.weight_loader(nn.Parameter(a, requires_grad=False), lora_a)
+            self.lora_a[slot, block] = a
+            self.lora_b[slot, :, block] = lora_b
+        else:
+            b = self.lora_b.new_zeros(self.lora_b.size(1), r)
+            args = () if shard_id is None else (shard_id,)
+            self.base.weight_loader(nn.Parameter(b, requires_grad=False), lora_b, *args)
+            self.lora_a[slot, block] = lora_a
+            self.lora_b[slot, :, block] = b
+
+    def clear_slot(self, slot: int):
+        self.lora_a[slot].zero_()
+        self.lora_b[slot].zero_()
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        y = self.base(x)
+        segments = get_context().lora_segments
+        if not segments:
+            return y
+        shrinks = []
+        for slot, indices in segments:
+            shrinks.append(x.index_select(0, indices) @ self.lora_a[slot].t())
+        if self.row_parallel and self.base.tp_size > 1:
+            # each rank holds a slice of the input, the rank-sized partial products are summed
+            # instead of the full-width outputs
+            shrink = torch.cat(shrinks)
+            dist.all_reduce(shrink, group=get_tp_group())
+            shrinks = shrink.split([len(indices) for _, indices in segments])
+        for (slot, indices), shrink in zip(segments, shrinks):
+            y.index_add_(0, indices, shrink @ self.lora_b[slot].t())
+        return y
+
+
+def add_lora(model: nn.Module, max_loras: int, max_rank: int) -> dict[str, LoRALinear]:
+    lora_modules = {}
+    for name, module in list(model.named_modules()):
+        for child_name, child in list(module.named_children()):
+            if ".experts." in f"{name}.":    # MoE experts use their weights directly
+                continue
+            if isinstance(child, (QKVParallelLinear, MergedColumnParallelLinear, RowParallelLinear)):
+                lora_module = LoRALinear(child, max_loras, max_rank)
+                setattr(module, child_name, lora_module)
+                lora_modules[f"{name}.{child_name}" if name else child_name] = lora_module
+    return lora_modules
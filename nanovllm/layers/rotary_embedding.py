@@ -1,3 +1,4 @@
+import math
 from functools import lru_cache
 import torch
 from torch import nn
@@ -22,15 +23,16 @@ class RotaryEmbedding(nn.Module):
         rotary_dim: int,
         max_position_embeddings: int,
         base: float,
+        rope_scaling: dict | None = None,
     ) -> None:
         super().__init__()
         self.head_size = head_size
         assert rotary_dim == head_size
-        inv_freq = 1.0 / (base**(torch.arange(0, rotary_dim, 2, dtype=torch.float) / rotary_dim))
-        t = torch.arange(max_position_embeddings, dtype=torch.float)
+        inv_freq, mscale = compute_inv_freq(rotary_dim, base, max_position_embeddings, rope_scaling or {})
+        t = torch.arange(scaled_max_position(max_position_embeddings, rope_scaling), dtype=torch.float)
         freqs = torch.einsum("i,j -> ij", t, inv_freq)
-        cos = freqs.cos()
-        sin = freqs.sin()
+        cos = freqs.cos() * mscale
+        sin = freqs.sin() * mscale
         cache = torch.cat((cos, sin), dim=-1).unsqueeze_(1)
         self.register_buffer("cos_sin_cache", cache, persistent=False)
 
@@ -48,14 +50,74 @@ class RotaryEmbedding(nn.Module):
         return query, key
 
 
+def compute_inv_freq(rotary_dim: int, base: float, max_position: int, scaling: dict) -> tuple[torch.Tensor, float]:
+    # the rotary frequencies of each scaling variant and the factor cos and sin are multiplied by
+    rope_type = scaling.get("rope_type", "default")
+    factor = scaling.get("factor", 1.0)
+    if rope_type == "dynamic":
+        # NTK-aware base for the whole scaled context. Unlike transformers, which only rescales once a sequence
+        # outgrows max_position, every position of every sequence uses it so cached keys stay valid.
+        base *= (factor * factor - factor + 1) ** (rotary_dim / (rotary_dim - 2))
+    inv_freq = 1.0 / (base**(torch.arange(0, rotary_dim, 2, dtype=torch.float) / rotary_dim))
+    mscale = 1.0
+    if rope_type == "linear":
+        inv_freq = inv_freq / factor
+    elif rope_type == "yarn":
+        original_max_position = scaling.get("original_max_position_embeddings") or max_position
+        factor = scaling.get("factor") or max_position / original_max_position
+        correction_dim = lambda rotations: (rotary_dim * math.log(original_max_position / (rotations * 2 * math.pi))
+                                            / (2 * math.log(base)))
+        low, high = correction_dim(scaling.get("beta_fast") or 32), correction_dim(scaling.get("beta_slow") or 1)
+        if scaling.get("truncate", True):
+            low, high = math.floor(low), math.ceil(high)
+        low, high = max(low, 0), min(high, rotary_dim - 1)
+        ramp = ((torch.arange(rotary_dim // 2, dtype=torch.float) - low) / max(high - low, 0.001)).clamp(0, 1)
+        inv_freq = inv_freq / factor * ramp + inv_freq * (1 - ramp)
+        get_mscale = lambda m: 1.0 if factor <= 1 else 0.1 * m * math.log(factor) + 1.0
+        mscale = scaling.get("attention_factor")
+        if mscale is None:
+            m, m_all = scaling.get("mscale"), scaling.get("mscale_all_dim")
+            mscale = get_mscale(m) / get_mscale(m_all) if m and m_all else get_mscale(1)
+    elif rope_type == "llama3":
+        old_context_len = scaling["original_max_position_embeddings"]
+        low_freq_factor, high_freq_factor = scaling["low_freq_factor"], scaling["high_freq_factor"]
+        wavelen = 2 * math.pi / inv_freq
+        smooth = ((old_context_len / wavelen - low_freq_factor) / (high_freq_factor - low_freq_factor)).clamp(0, 1)
+        inv_freq = inv_freq / factor * (1 - smooth) + inv_freq * smooth
+    return inv_freq, mscale
+
+
+def scaled_max_position(max_position: int, rope_scaling: dict | tuple | None) -> int:
+    # the context length the scaled frequencies are meant for
+    scaling = dict(rope_scaling or {})
+    rope_type = scaling.get("rope_type", "default")
+    if rope_type in ("linear", "dynamic"):
+        return int(max_position * scaling["factor"])
+    if rope_type == "yarn" and scaling.get("factor"):
+        return max(max_position, int(scaling.get("original_max_position_embeddings", max_position) * scaling["factor"]))
+    return max_position
+
+
+def get_rope_parameters(config) -> tuple[float, tuple | None]:
+    # rope_theta and a hashable rope_scaling. transformers 5 keeps both in config.rope_parameters, older versions
+    # have config.rope_theta and a rope_scaling dict that names its variant "type"
+    scaling = dict(getattr(config, "rope_parameters", None) or getattr(config, "rope_scaling", None) or {})
+    base = scaling.pop("rope_theta", getattr(config, "rope_theta", 10000))
+    rope_type = scaling.pop("type", scaling.get("rope_type", "default"))
+    assert rope_type in ("default", "linear", "dynamic", "yarn", "llama3"), f"unsupported rope_type {rope_type}"
+    if rope_type == "default":
+        return base, None
+    scaling["rope_type"] = rope_type
+    return base, tuple(sorted(scaling.items()))
+
+
 @lru_cache(1)
 def get_rope(
     head_size: int,
     rotary_dim: int,
     max_position: int,
     base: float,
-    rope_scaling: dict | None = None,
+    rope_scaling: tuple | None = None,
 ):
-    assert rope_scaling is None
-    rotary_emb = RotaryEmbedding(head_size, rotary_dim, max_position, base)
+    rotary_emb = RotaryEmbedding(head_size, rotary_dim, max_position, base, dict(rope_scaling or ()))
     return rotary_emb
@@ -1,5 +1,19 @@
+from functools import wraps
 import torch
 from torch import nn
+import torch.distributed as dist
+
+from nanovllm.utils.parallel_state import get_tp_group, get_tp_size
+
+
+def compile_on_cuda(method):
+    # inductor fails to compile the sampling kernels for cpu (KeyError: 'buf4'), so they run eagerly there
+    compiled = torch.compile(method)
+
+    @wraps(method)
+    def wrapper(self, logits: torch.Tensor, temperatures: torch.Tensor):
+        return (compiled if logits.is_cuda else method)(self, logits, temperatures)
+    return wrapper
 
 
 class Sampler(nn.Module):
@@ -7,9 +21,36 @@ class Sampler(nn.Module):
     def __init__(self):
         super().__init__()
 
-    @torch.compile
+    @compile_on_cuda
     def forward(self, logits: torch.Tensor, temperatures: torch.Tensor):
         logits = logits.float().div_(temperatures.unsqueeze(dim=1))
         probs = torch.softmax(logits, dim=-1)
         sample_tokens = probs.div_(torch.empty_like(probs).exponential_(1).clamp_min_(1e-10)).argmax(dim=-1)
         return sample_tokens
+
+
+class VocabParallelSampler(nn.Module):
+    # samples from logits sharded over the vocab across the tensor parallel group without gathering them.
+    # Sampler's exponential race argmax(p / E) equals the Gumbel-max argmax(logits / T - log E), as the
+    # softmax normalizer is shared by a whole row. So every rank takes the max over its own shard and
+    # only a (score, token id) pair per sequence and rank is exchanged.
+
+    def __init__(self, vocab_start_idx: int):
+        super().__init__()
+        self.vocab_start_idx = vocab_start_idx
+        self.tp_size = get_tp_size()
+
+    @compile_on_cuda
+    def local_max(self, logits: torch.Tensor, temperatures: torch.Tensor):
+        logits = logits.float().div_(temperatures.unsqueeze(dim=1))
+        scores = logits.sub_(torch.empty_like(logits).exponential_(1).clamp_min_(1e-10).log_())
+        return scores.max(dim=-1)
+
+    def forward(self, logits: torch.Tensor, temperatures: torch.Tensor):
+        max_scores, indices = self.local_max(logits, temperatures)
+        candidates = torch.stack([max_scores.double(), (indices + self.vocab_start_idx).double()])
+        all_candidates = [torch.empty_like(candidates) for _ in range(self.tp_size)]
+        dist.all_gather(all_candidates, candidates, group=get_tp_group())
+        all_candidates = torch.stack(all_candidates)
+        best = all_candidates[:, 0].argmax(dim=0, keepdim=True)
+        return all_candidates[:, 1].gather(0, best).squeeze(0).long()
@@ -1,5 +1,10 @@
 from nanovllm.engine.llm_engine import LLMEngine
+from nanovllm.engine.router import DataParallelEngine
 
 
 class LLM(LLMEngine):
     pass
+
+
+class DataParallelLLM(DataParallelEngine):
+    pass
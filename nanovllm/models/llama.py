@@ -0,0 +1,10 @@
+from nanovllm.models.qwen3 import Qwen3DecoderLayer, Qwen3ForCausalLM
+
+
+class LlamaDecoderLayer(Qwen3DecoderLayer):
+    qk_norm = False
+
+
+class LlamaForCausalLM(Qwen3ForCausalLM):
+    # Qwen3 without the q/k norms, which also covers Mistral
+    decoder_layer = LlamaDecoderLayer
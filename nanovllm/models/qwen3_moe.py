@@ -0,0 +1,62 @@
+import torch
+from torch import nn
+import torch.nn.functional as F
+import torch.distributed as dist
+from transformers import Qwen3MoeConfig
+
+from nanovllm.layers.linear import ReplicatedLinear
+from nanovllm.models.qwen3 import Qwen3MLP, Qwen3DecoderLayer, Qwen3ForCausalLM
+from nanovllm.utils.parallel_state import get_tp_group, get_tp_size
+
+
+class Qwen3MoeSparseMoeBlock(nn.Module):
+
+    def __init__(
+        self,
+        config: Qwen3MoeConfig,
+    ) -> None:
+        super().__init__()
+        self.tp_size = get_tp_size()
+        self.top_k = config.num_experts_per_tok
+        self.norm_topk_prob = config.norm_topk_prob
+        self.gate = ReplicatedLinear(config.hidden_size, config.num_experts, bias=False)
+        self.experts = nn.ModuleList([
+            Qwen3MLP(
+                hidden_size=config.hidden_size,
+                intermediate_size=config.moe_intermediate_size,
+                hidden_act=config.hidden_act,
+            )
+            for _ in range(config.num_experts)
+        ])
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        routing_weights = self.gate(x).float().softmax(-1)
+        routing_weights, selected_experts = routing_weights.topk(self.top_k, dim=-1)
+        if self.norm_topk_prob:
+            routing_weights /= routing_weights.sum(-1, keepdim=True)
+        routing_weights = routing_weights.to(x.dtype)
+        # every expert is sharded like a dense MLP. Each runs on its own tokens without reducing, and the
+        # partial sums of all experts share one all-reduce.
+        y = torch.zeros_like(x)
+        for e in selected_experts.unique().tolist():
+            token_idx, k = (selected_experts == e).nonzero(as_tuple=True)
+            expert = self.experts[e]
+            h = expert.act_fn(expert.gate_up_proj(x[token_idx]))
+            y.index_add_(0, token_idx, F.linear(h, expert.down_proj.weight) * routing_weights[token_idx, k, None])
+        if self.tp_size > 1:
+            dist.all_reduce(y, group=get_tp_group())
+        return y
+
+
+class Qwen3MoeDecoderLayer(Qwen3DecoderLayer):
+
+    def build_mlp(self, config: Qwen3MoeConfig, layer_idx: int) -> nn.Module:
+        if (layer_idx not in config.mlp_only_layers and config.num_experts > 0 and
+                (layer_idx + 1) % config.decoder_sparse_step == 0):
+            return Qwen3MoeSparseMoeBlock(config)
+        return super().build_mlp(config, layer_idx)
+
+
+class Qwen3MoeForCausalLM(Qwen3ForCausalLM):
+    decoder_layer = Qwen3MoeDecoderLayer
+    supports_cudagraph = False    # the routing decides on the host which experts run
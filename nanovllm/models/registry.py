@@ -0,0 +1,21 @@
+from torch import nn
+
+from nanovllm.models.llama import LlamaForCausalLM
+from nanovllm.models.qwen3 import Qwen3ForCausalLM
+from nanovllm.models.qwen3_moe import Qwen3MoeForCausalLM
+
+
+MODEL_REGISTRY: dict[str, type[nn.Module]] = {
+    "Qwen3ForCausalLM": Qwen3ForCausalLM,
+    "Qwen3MoeForCausalLM": Qwen3MoeForCausalLM,
+    "LlamaForCausalLM": LlamaForCausalLM,
+    "MistralForCausalLM": LlamaForCausalLM,
+}
+
+
+def get_model_class(hf_config) -> type[nn.Module]:
+    architectures = getattr(hf_config, "architectures", None) or []
+    for architecture in architectures:
+        if architecture in MODEL_REGISTRY:
+            return MODEL_REGISTRY[architecture]
+    raise ValueError(f"unsupported architectures {architectures}, expected one of {list(MODEL_REGISTRY)}")
@@ -6,6 +6,17 @@ class SamplingParams:
     temperature: float = 1.0
     max_tokens: int = 64
     ignore_eos: bool = False
+    sliding_window: int | None = None
+    num_sink_tokens: int = 0
+    priority: int = 0
+    tenant: str = "default"
+    lora_id: str | None = None
+    guided_regex: str | None = None
+    guided_json: dict | str | None = None
+    guided_grammar: str | None = None
 
     def __post_init__(self):
         assert self.temperature > 1e-10, "greedy sampling is not permitted"
+        assert self.sliding_window is None or self.sliding_window > 0
+        assert self.num_sink_tokens >= 0
+        assert sum(guide is not None for guide in (self.guided_regex, self.guided_json, self.guided_grammar)) <= 1
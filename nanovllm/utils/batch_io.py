@@ -0,0 +1,72 @@
+import os
+import json
+from dataclasses import asdict, fields
+
+from nanovllm.sampling_params import SamplingParams
+
+
+def record_prompt(record: dict) -> str | list[int]:
+    if "prompt_token_ids" in record:
+        return record["prompt_token_ids"]
+    if "prompt" in record:
+        return record["prompt"]
+    return "\n\n".join(record[key] for key in ("title", "body") if key in record)
+
+
+def record_sampling_params(record: dict, default: SamplingParams) -> SamplingParams:
+    # per-record overrides of any SamplingParams field, e.g. max_tokens or temperature
+    overrides = {field.name: record[field.name] for field in fields(SamplingParams) if field.name in record}
+    return SamplingParams(**{**asdict(default), **overrides}) if overrides else default
+
+
+def read_records(path: str, batch_size: int = 1024):
+    # yields (index, record) lazily from a JSONL or Parquet file
+    if path.endswith(".parquet"):
+        import pyarrow.parquet as pq    # optional, only needed for Parquet input
+        index = 0
+        for batch in pq.ParquetFile(path).iter_batches(batch_size):
+            for record in batch.to_pylist():
+                yield index, record
+                index += 1
+        return
+    with open(path) as f:
+        index = 0
+        for line in f:
+            if line.strip():
+                yield index, json.loads(line)
+                index += 1
+
+
+class Checkpoint:
+    # every record below low_water_mark and those in completed have their output in the first
+    # output_offset bytes of the output file, anything written after that offset is redone on resume
+
+    def __init__(self, path: str | None):
+        self.path = path
+        self.low_water_mark = 0
+        self.completed: set[int] = set()
+        self.output_offset = 0
+        if path is not None and os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.low_water_mark = state["low_water_mark"]
+            self.completed = set(state["completed"])
+            self.output_offset = state["output_offset"]
+
+    def is_done(self, index: int) -> bool:
+        return index < self.low_water_mark or index in self.completed
+
+    def mark_done(self, index: int):
+        self.completed.add(index)
+        while self.low_water_mark in self.completed:
+            self.completed.remove(self.low_water_mark)
+            self.low_water_mark += 1
+
+    def save(self, output_offset: int):
+        self.output_offset = output_offset
+        if self.path is None:
+            return
+        state = dict(low_water_mark=self.low_water_mark, completed=sorted(self.completed), output_offset=output_offset)
+        with open(self.path + ".tmp", "w") as f:
+            json.dump(state, f)
+        os.replace(self.path + ".tmp", self.path)
@@ -0,0 +1,50 @@
+from bisect import bisect_left
+
+
+def default_capture_sizes(max_bs: int) -> list[int]:
+    return [bs for bs in (1, 2, 4, 8) if bs <= max_bs] + list(range(16, max_bs + 1, 16))
+
+
+def select_bucket(capture_sizes: list[int], bs: int) -> int | None:
+    i = bisect_left(capture_sizes, bs)
+    return capture_sizes[i] if i < len(capture_sizes) else None
+
+
+def padding_cost(capture_sizes: list[int], histogram: dict[int, int]) -> int:
+    return sum(count * (select_bucket(capture_sizes, bs) - bs) for bs, count in histogram.items())
+
+
+def tune_capture_sizes(histogram: dict[int, int], max_graphs: int) -> list[int]:
+    # choose at most max_graphs buckets among the observed sizes minimizing the total padded batch slots
+    sizes = sorted(bs for bs, count in histogram.items() if count > 0)
+    if len(sizes) <= max_graphs:
+        return sizes
+    n = len(sizes)
+    prefix_count = [0]
+    prefix_slots = [0]
+    for bs in sizes:
+        prefix_count.append(prefix_count[-1] + histogram[bs])
+        prefix_slots.append(prefix_slots[-1] + histogram[bs] * bs)
+
+    def cost(i, j):    # sizes[i..j] all padded up to sizes[j]
+        return sizes[j] * (prefix_count[j + 1] - prefix_count[i]) - (prefix_slots[j + 1] - prefix_slots[i])
+
+    inf = float("inf")
+    best = [[inf] * n for _ in range(max_graphs + 1)]
+    choice = [[-1] * n for _ in range(max_graphs + 1)]
+    for j in range(n):
+        best[1][j] = cost(0, j)
+    for k in range(2, max_graphs + 1):
+        for j in range(n):
+            for i in range(j):
+                c = best[k - 1][i] + cost(i + 1, j)
+                if c < best[k][j]:
+                    best[k][j], choice[k][j] = c, i
+    k = min(range(1, max_graphs + 1), key=lambda k: best[k][n - 1])
+    buckets = []
+    j = n - 1
+    while j != -1:
+        buckets.append(sizes[j])
+        j = choice[k][j]
+        k -= 1
+    return buckets[::-1]
@@ -0,0 +1,445 @@
+import re
+import json
+import string
+from functools import lru_cache
+import xxhash
+import torch
+from transformers import AutoTokenizer
+
+
+CLASS_ESCAPES = {
+    "d": frozenset(string.digits),
+    "w": frozenset(string.ascii_letters + string.digits + "_"),
+    "s": frozenset(" \t\n\r\f\v"),
+}
+CHAR_ESCAPES = {"n": "\n", "t": "\t", "r": "\r", "f": "\f", "v": "\v", "0": "\0"}
+METACHARS = frozenset("\\.^$|?*+()[]{}")
+
+
+def escape(text: str) -> str:
+    return "".join("\\" + c if c in METACHARS else c for c in text)
+
+
+class RegexParser:
+    # parses the regular subset of Python regex syntax into ("set", chars, negated), ("cat", nodes),
+    # ("alt", nodes) and ("repeat", node, min, max) nodes. The whole pattern must match, so ^ and $ are no-ops.
+
+    def __init__(self, pattern: str):
+        self.pattern = pattern
+        self.pos = 0
+
+    def parse(self):
+        node = self.alternation()
+        if self.pos != len(self.pattern):
+            raise ValueError(f"unexpected {self.pattern[self.pos]!r} at {self.pos} in regex {self.pattern!r}")
+        return node
+
+    def peek(self):
+        return self.pattern[self.pos] if self.pos < len(self.pattern) else None
+
+    def next(self):
+        c = self.peek()
+        if c is None:
+            raise ValueError(f"unexpected end of regex {self.pattern!r}")
+        self.pos += 1
+        return c
+
+    def alternation(self):
+        nodes = [self.concatenation()]
+        while self.peek() == "|":
+            self.pos += 1
+            nodes.append(self.concatenation())
+        return nodes[0] if len(nodes) == 1 else ("alt", nodes)
+
+    def concatenation(self):
+        nodes = []
+        while self.peek() not in (None, "|", ")"):
+            nodes.append(self.repetition())
+        return ("cat", nodes)
+
+    def repetition(self):
+        node = self.atom()
+        while True:
+            c = self.peek()
+            if c in ("*", "+", "?"):
+                self.pos += 1
+                lo, hi = {"*": (0, None), "+": (1, None), "?": (0, 1)}[c]
+            elif c == "{" and (m := re.match(r"\{(\d+)(,(\d*))?\}", self.pattern[self.pos:])):
+                self.pos += m.end()
+                lo = int(m[1])
+                hi = lo if m[2] is None else int(m[3]) if m[3] else None
+                if hi is not None and hi < lo:
+                    raise ValueError(f"bad repetition {m[0]} in regex {self.pattern!r}")
+            else:
+                return node
+            if self.peek() == "?":    # lazy quantifiers match the same strings
+                self.pos += 1
+            node = ("repeat", node, lo, hi)
+
+    def atom(self):
+        start = self.pos
+        c = self.next()
+        if c == "(":
+            if self.pattern.startswith("?:", self.pos):
+                self.pos += 2
+            elif self.peek() == "?":
+                raise ValueError(f"unsupported group at {start} in regex {self.pattern!r}")
+            node = self.alternation()
+            if self.next() != ")":
+                raise ValueError(f"unbalanced parenthesis at {start} in regex {self.pattern!r}")
+            return node
+        if c == "[":
+            return self.char_class()
+        if c == ".":
+            return ("set", frozenset("\n"), True)
+        if c == "\\":
+            return ("set", *self.escape())
+        if c in ("^", "$"):
+            return ("cat", [])
+        if c in ("*", "+", "?"):
+            raise ValueError(f"nothing to repeat at {start} in regex {self.pattern!r}")
+        return ("set", frozenset(c), False)
+
+    def escape(self) -> tuple[frozenset, bool]:
+        c = self.next()
+        if c.lower() in CLASS_ESCAPES:
+            return CLASS_ESCAPES[c.lower()], c.isupper()
+        if c in CHAR_ESCAPES:
+            return frozenset(CHAR_ESCAPES[c]), False
+        if c in ("x", "u"):
+            n = 2 if c == "x" else 4
+            digits = self.pattern[self.pos:self.pos + n]
+            if len(digits) != n or any(d not in string.hexdigits for d in digits):
+                raise ValueError(f"bad \\{c} escape at {self.pos} in regex {self.pattern!r}")
+            self.pos += n
+            return frozenset(chr(int(digits, 16))), False
+        if c.isalnum():
+            raise ValueError(f"unsupported escape \\{c} in regex {self.pattern!r}")
+        return frozenset(c), False
+
+    def class_char(self) -> str | frozenset:
+        c = self.next()
+        if c != "\\":
+            return c
+        chars, negated = self.escape()
+        if negated:
+            raise ValueError(f"negated escapes inside a character class are not supported in regex {self.pattern!r}")
+        return next(iter(chars)) if len(chars) == 1 else chars
+
+    def char_class(self):
+        negated = self.peek() == "^"
+        if negated:
+            self.pos += 1
+        chars = set()
+        first = True
+        while first or self.peek() != "]":
+            first = False
+            c = self.class_char()
+            if isinstance(c, frozenset):
+                chars |= c
+            elif self.peek() == "-" and self.pattern[self.pos + 1:self.pos + 2] not in ("]", ""):
+                self.pos += 1
+                end = self.class_char()
+                if isinstance(end, frozenset) or end < c:
+                    raise ValueError(f"bad character range at {self.pos} in regex {self.pattern!r}")
+                chars.update(map(chr, range(ord(c), ord(end) + 1)))
+            else:
+                chars.add(c)
+        self.pos += 1
+        return ("set", frozenset(chars), negated)
+
+
+class DFA:
+    # a Thompson NFA of the pattern, determinized breadth first so every process numbers the states the
+    # same way and the ranks can exchange them. A state has a transition for every character its NFA
+    # edges name and a default one for all other characters. State -1 is dead.
+
+    def __init__(self, pattern: str, max_states: int = 65536):
+        self.edges: list[list[tuple[frozenset, bool, int]]] = []
+        self.epsilons: list[list[int]] = []
+        start = self.new_node()
+        self.accept = self.build(RegexParser(pattern).parse(), start)
+        self.states: list[frozenset[int]] = []
+        self.index: dict[frozenset[int], int] = {}
+        self.transitions: list[dict[str, int]] = []
+        self.defaults: list[int] = []
+        self.add_state(self.closure([start]))
+        for nodes in self.states:    # grows while iterating
+            if len(self.states) > max_states:
+                raise ValueError(f"regex {pattern!r} needs more than {max_states} DFA states")
+            edges = [edge for node in nodes for edge in self.edges[node]]
+            named = sorted(set().union(*(chars for chars, _, _ in edges)))
+            self.transitions.append({c: self.target(edges, c) for c in named})
+            self.defaults.append(self.target(edges, None))
+
+    def new_node(self) -> int:
+        self.edges.append([])
+        self.epsilons.append([])
+        return len(self.edges) - 1
+
+    def build(self, node, start: int) -> int:
+        kind = node[0]
+        if kind == "set":
+            end = self.new_node()
+            self.edges[start].append((node[1], node[2], end))
+            return end
+        if kind == "cat":
+            for child in node[1]:
+                start = self.build(child, start)
+            return start
+        if kind == "alt":
+            end = self.new_node()
+            for child in node[1]:
+                child_start = self.new_node()
+                self.epsilons[start].append(child_start)
+                self.epsilons[self.build(child, child_start)].append(end)
+            return end
+        _, child, lo, hi = node
+        for _ in range(lo):
+            start = self.build(child, start)
+        end = self.new_node()
+        if hi is None:
+            loop = self.new_node()
+            self.epsilons[start].append(loop)
+            self.epsilons[self.build(child, loop)].append(loop)
+            self.epsilons[loop].append(end)
+            return end
+        for _ in range(hi - lo):
+            self.epsilons[start].append(end)
+            start = self.build(child, start)
+        self.epsilons[start].append(end)
+        return end
+
+    def closure(self, nodes) -> frozenset[int]:
+        closure = set(nodes)
+        stack = list(nodes)
+        while stack:
+            for node in self.epsilons[stack.pop()]:
+                if node not in closure:
+                    closure.add(node)
+                    stack.append(node)
+        return frozenset(closure)
+
+    def add_state(self, nodes: frozenset[int]) -> int:
+        if nodes not in self.index:
+            self.index[nodes] = len(self.states)
+            self.states.append(nodes)
+        return self.index[nodes]
+
+    def target(self, edges: list[tuple[frozenset, bool, int]], c: str | None) -> int:
+        targets = [end for chars, negated, end in edges if (c in chars) != negated]
+        return self.add_state(self.closure(targets)) if targets else -1
+
+    def step(self, state: int, c: str) -> int:
+        return self.transitions[state].get(c, self.defaults[state])
+
+    def is_accepting(self, state: int) -> bool:
+        return state != -1 and self.accept in self.states[state]
+
+
+WHITESPACE = r"[ ]?"
+STRING_CHAR = r'(?:[^"\\\x00-\x1f]|\\["\\/bfnrt]|\\u[0-9a-fA-F]{4})'
+STRING = f'"{STRING_CHAR}*"'
+INTEGER = r"-?(?:0|[1-9][0-9]*)"
+NUMBER = INTEGER + r"(?:\.[0-9]+)?(?:[eE][+-]?[0-9]+)?"
+SCALAR = f"(?:{STRING}|{NUMBER}|true|false|null)"
+# JSON nests arbitrarily deep, which no regex can express, so free-form arrays and objects hold scalars only
+FREE_ARRAY = rf"\[{WHITESPACE}(?:{SCALAR}(?:,{WHITESPACE}{SCALAR})*)?{WHITESPACE}\]"
+FREE_MEMBER = f"{STRING}{WHITESPACE}:{WHITESPACE}{SCALAR}"
+FREE_OBJECT = rf"\{{{WHITESPACE}(?:{FREE_MEMBER}(?:,{WHITESPACE}{FREE_MEMBER})*)?{WHITESPACE}\}}"
+JSON_TYPES = {
+    "string": STRING,
+    "integer": INTEGER,
+    "number": NUMBER,
+    "boolean": "(?:true|false)",
+    "null": "null",
+}
+MAX_SCHEMA_DEPTH = 32
+
+
+def json_schema_to_regex(schema: dict) -> str:
+    # objects emit their properties in schema order, without additional properties
+    def convert(schema: dict, depth: int) -> str:
+        if depth > MAX_SCHEMA_DEPTH:
+            raise ValueError("JSON schema nests too deep, recursive schemas are not supported")
+        if "$ref" in schema:
+            ref = schema["$ref"]
+            if not ref.startswith("#/"):
+                raise ValueError(f"only local $refs are supported, got {ref!r}")
+            target = root
+            for part in ref[2:].split("/"):
+                target = target[part]
+            return convert(target, depth + 1)
+        if "const" in schema:
+            return escape(json.dumps(schema["const"]))
+        if "enum" in schema:
+            return "(?:" + "|".join(escape(json.dumps(value)) for value in schema["enum"]) + ")"
+        for key in ("anyOf", "oneOf"):
+            if key in schema:
+                return "(?:" + "|".join(convert(option, depth + 1) for option in schema[key]) + ")"
+        if "allOf" in schema:
+            if len(schema["allOf"]) != 1:
+                raise ValueError("allOf with more than one schema is not supported")
+            return convert(schema["allOf"][0], depth + 1)
+        json_type = schema.get("type")
+        if isinstance(json_type, list):
+            return "(?:" + "|".join(convert({**schema, "type": t}, depth) for t in json_type) + ")"
+        if json_type == "string":
+            if "pattern" in schema:
+                return f'"(?:{schema["pattern"]})"'
+            if "minLength" in schema or "maxLength" in schema:
+                return f'"{STRING_CHAR}{{{schema.get("minLength", 0)},{schema.get("maxLength", "")}}}"'
+            return STRING
+        if json_type in JSON_TYPES:
+            return JSON_TYPES[json_type]
+        if json_type == "array":
+            return convert_array(schema, depth)
+        if json_type == "object" or "properties" in schema:
+            return convert_object(schema, depth) if schema.get("properties") else FREE_OBJECT
+        if json_type is None:
+            return f"(?:{SCALAR}|{FREE_ARRAY}|{FREE_OBJECT})"
+        raise ValueError(f"unsupported JSON schema type {json_type!r}")
+
+    def convert_array(schema: dict, depth: int) -> str:
+        lo, hi = schema.get("minItems", 0), schema.get("maxItems")
+        if hi == 0:
+            return rf"\[{WHITESPACE}\]"
+        item = convert(schema.get("items", {}), depth + 1)
+        items = f"{item}(?:,{WHITESPACE}{item}){{{max(lo - 1, 0)},{'' if hi is None else hi - 1}}}"
+        if lo == 0:
+            items = f"(?:{items})?"
+        return rf"\[{WHITESPACE}{items}{WHITESPACE}\]"
+
+    def convert_object(schema: dict, depth: int) -> str:
+        required = set(schema.get("required", ()))
+        members = [(escape(json.dumps(name)) + f"{WHITESPACE}:{WHITESPACE}" + convert(subschema, depth + 1), name in required)
+                   for name, subschema in schema["properties"].items()]
+        def tail(i: int, first: bool) -> str:
+            # the members from i on, preceded by a comma unless none was emitted yet
+            if i == len(members):
+                return ""
+            member, is_required = members[i]
+            separator = "" if first else f",{WHITESPACE}"
+            if is_required:
+                return separator + member + tail(i + 1, False)
+            if first:
+                return f"(?:{member}{tail(i + 1, False)}|{tail(i + 1, True)})"
+            return f"(?:{separator}{member})?{tail(i + 1, False)}"
+        return rf"\{{{WHITESPACE}{tail(0, True)}{WHITESPACE}\}}"
+
+    root = schema
+    return convert(schema, 0)
+
+
+def grammar_to_regex(grammar: str) -> str:
+    # "name ::= regex" rules starting from root, where <name> refers to another rule. Rules are inlined,
+    # so recursive grammars, which are not regular, are rejected
+    rules = {}
+    for line in grammar.splitlines():
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        name, sep, body = line.partition("::=")
+        if not sep:
+            raise ValueError(f"expected 'name ::= regex', got {line!r}")
+        rules[name.strip()] = body.strip()
+    def expand(name: str, stack: tuple[str, ...]) -> str:
+        if name in stack:
+            raise ValueError(f"recursive grammar rule {name!r} is not supported")
+        if name not in rules:
+            raise ValueError(f"undefined grammar rule {name!r}")
+        return "(?:" + re.sub(r"<(\w+)>", lambda m: expand(m[1], stack + (name,)), rules[name]) + ")"
+    return expand("root", ())
+
+
+def guide_pattern(sampling_params) -> str | None:
+    if sampling_params.guided_regex is not None:
+        return sampling_params.guided_regex
+    if sampling_params.guided_json is not None:
+        schema = sampling_params.guided_json
+        return json_schema_to_regex(json.loads(schema) if isinstance(schema, str) else schema)
+    if sampling_params.guided_grammar is not None:
+        return grammar_to_regex(sampling_params.guided_grammar)
+    return None
+
+
+def pattern_key(pattern: str) -> int:
+    return xxhash.xxh64(pattern.encode()).intdigest()
+
+
+class TokenVocabulary:
+    # the text of every token as a trie, so the tokens allowed in a DFA state are found by stepping the
+    # DFA once per distinct token prefix instead of once per character of every token
+
+    def __init__(self, tokenizer, vocab_size: int):
+        self.vocab_size = vocab_size
+        self.eos = tokenizer.eos_token_id
+        special_ids = set(tokenizer.all_special_ids)
+        self.trie = ({}, [])    # (children by character, ids of the tokens ending here)
+        for token, token_id in tokenizer.get_vocab().items():
+            if token_id >= vocab_size or token_id in special_ids:
+                continue
+            text = tokenizer.convert_tokens_to_string([token])
+            if not text or "\ufffd" in text:    # empty, or part of a multi-byte character
+                continue
+            node = self.trie
+            for c in text:
+                node = node[0].setdefault(c, ({}, []))
+            node[1].append(token_id)
+
+
+class TokenFSM:
+    # the pattern's DFA lifted to tokens. The allowed-token mask of a state and the states its tokens lead
+    # to are computed the first time a sequence reaches it, and shared by all sequences with the pattern.
+    # EOS is allowed where the pattern may end, or where no token can continue it.
+
+    def __init__(self, pattern: str, vocab: TokenVocabulary):
+        self.dfa = DFA(pattern)
+        self.vocab = vocab
+        self.masks: dict[int, torch.Tensor] = {}
+        self.next_states: dict[int, dict[int, int]] = {}
+
+    def compile_state(self, state: int):
+        next_states = {}
+        stack = [(self.vocab.trie, state)] if state != -1 else []
+        while stack:
+            node, s = stack.pop()
+            for c, child in node[0].items():
+                t = self.dfa.step(s, c)
+                if t == -1:
+                    continue
+                for token_id in child[1]:
+                    next_states[token_id] = t
+                stack.append((child, t))
+        if self.vocab.eos is not None and (self.dfa.is_accepting(state) or not next_states):
+            next_states[self.vocab.eos] = state
+        mask = torch.zeros(self.vocab.vocab_size, dtype=torch.bool)
+        mask[list(next_states)] = True
+        self.masks[state] = mask
+        self.next_states[state] = next_states
+
+    def allowed(self, state: int) -> torch.Tensor:
+        if state not in self.masks:
+            self.compile_state(state)
+        return self.masks[state]
+
+    def next_state(self, state: int, token_id: int) -> int:
+        if state not in self.next_states:
+            self.compile_state(state)
+        return self.next_states[state].get(token_id, -1)
+
+
+@lru_cache(maxsize=None)
+def get_vocabulary(model: str, vocab_size: int) -> TokenVocabulary:
+    return TokenVocabulary(AutoTokenizer.from_pretrained(model, use_fast=True), vocab_size)
+
+
+_token_fsms: dict[int, TokenFSM] = {}
+
+def get_token_fsm(model: str, vocab_size: int, key: int, pattern: str | None = None) -> TokenFSM:
+    # a process compiles a pattern the first time it sees it, which is with a prefill, as only prefills
+    # ship the pattern to the other ranks
+    if key not in _token_fsms:
+        assert pattern is not None
+        _token_fsms[key] = TokenFSM(pattern, get_vocabulary(model, vocab_size))
+    return _token_fsms[key]
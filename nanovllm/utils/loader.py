@@ -11,6 +11,7 @@ def default_weight_loader(param: nn.Parameter, loaded_weight: torch.Tensor):
 
 def load_model(model: nn.Module, path: str):
     packed_modules_mapping = getattr(model, "packed_modules_mapping", {})
+    params = dict(model.named_parameters())    # only this pipeline stage's, weights of other stages are skipped
     for file in glob(os.path.join(path, "*.safetensors")):
         with safe_open(file, "pt", "cpu") as f:
             for weight_name in f.keys():
@@ -18,11 +19,15 @@ def load_model(model: nn.Module, path: str):
                     if k in weight_name:
                         v, shard_id = packed_modules_mapping[k]
                         param_name = weight_name.replace(k, v)
-                        param = model.get_parameter(param_name)
+                        if param_name not in params:
+                            break
+                        param = params[param_name]
                         weight_loader = getattr(param, "weight_loader")
                         weight_loader(param, f.get_tensor(weight_name), shard_id)
                         break
                 else:
-                    param = model.get_parameter(weight_name)
+                    if weight_name not in params:
+                        continue
+                    param = params[weight_name]
                     weight_loader = getattr(param, "weight_loader", default_weight_loader)
                     weight_loader(param, f.get_tensor(weight_name))
@@ -0,0 +1,146 @@
+import os
+import json
+from dataclasses import dataclass, asdict
+import xxhash
+
+from nanovllm.utils.cudagraph import default_capture_sizes
+
+MiB = 1024 ** 2
+GiB = 1024 ** 3
+CUDA_CONTEXT_BYTES = 512 * MiB
+CUDAGRAPH_OVERHEAD_BYTES = 2 * MiB
+
+
+@dataclass
+class Workload:
+    avg_prompt_len: int
+    avg_output_len: int
+    prefix_hit_rate: float = 0.
+
+
+@dataclass
+class MemoryProfile:
+    weight_bytes: int
+    activation_bytes: int
+    cudagraph_bytes: int
+    kv_block_bytes: int
+    num_kvcache_blocks: int
+    kvcache_block_size: int
+    max_num_seqs: int
+    max_num_batched_tokens: int
+
+
+def get_head_dim(hf_config) -> int:
+    return getattr(hf_config, "head_dim", None) or hf_config.hidden_size // hf_config.num_attention_heads
+
+
+def dtype_bytes(hf_config) -> int:
+    return hf_config.torch_dtype.itemsize
+
+
+def weight_bytes(hf_config, tp_size: int = 1) -> int:
+    hidden, inter, head_dim = hf_config.hidden_size, hf_config.intermediate_size, get_head_dim(hf_config)
+    num_heads, num_kv_heads = hf_config.num_attention_heads, hf_config.num_key_value_heads
+    qkv = hidden * (num_heads + 2 * num_kv_heads) * head_dim
+    o = num_heads * head_dim * hidden
+    mlp = 3 * hidden * inter
+    norms = 2 * hidden + 2 * head_dim
+    if getattr(hf_config, "num_experts", 0):    # every layer counted as sparse, the router is replicated
+        mlp = hf_config.num_experts * 3 * hidden * hf_config.moe_intermediate_size
+        norms += hf_config.num_experts * hidden
+    layer = (qkv + o + mlp) // tp_size + norms
+    embed = hf_config.vocab_size * hidden // tp_size
+    lm_head = 0 if hf_config.tie_word_embeddings else embed
+    return (hf_config.num_hidden_layers * layer + embed + lm_head + hidden) * dtype_bytes(hf_config)
+
+
+def mlp_activation_elems(hf_config, tp_size: int = 1) -> int:
+    # per token, the largest MLP of any layer
+    dense = 3 * hf_config.intermediate_size // tp_size
+    if not getattr(hf_config, "num_experts", 0):
+        return dense
+    # experts run one after another and any one of them may receive every token. The float32 routing
+    # probs, the gathered input and the output accumulator stay live across the experts.
+    sparse = (3 * hf_config.moe_intermediate_size // tp_size + 2 * hf_config.hidden_size +
+              2 * hf_config.num_experts * 4 // dtype_bytes(hf_config))
+    has_dense_layers = getattr(hf_config, "mlp_only_layers", None) or getattr(hf_config, "decoder_sparse_step", 1) > 1
+    return max(dense, sparse) if has_dense_layers else sparse
+
+
+def activation_bytes(hf_config, num_tokens: int, num_seqs: int, tp_size: int = 1) -> int:
+    # live tensors of one decoder layer plus the float32 logits and probs of the sampled positions
+    hidden, head_dim = hf_config.hidden_size, get_head_dim(hf_config)
+    qkv = (hf_config.num_attention_heads + 2 * hf_config.num_key_value_heads) * head_dim // tp_size
+    per_token = 4 * hidden + qkv + mlp_activation_elems(hf_config, tp_size)
+    logits = 2 * num_seqs * hf_config.vocab_size * 4
+    rope = hf_config.max_position_embeddings * head_dim * 4
+    return num_tokens * per_token * dtype_bytes(hf_config) + logits + rope
+
+
+def cudagraph_bytes(hf_config, max_bs: int, num_graphs: int, tp_size: int = 1) -> int:
+    # graphs share one memory pool sized by the largest batch
+    return activation_bytes(hf_config, max_bs, max_bs, tp_size) + num_graphs * CUDAGRAPH_OVERHEAD_BYTES
+
+
+def kv_block_bytes(hf_config, block_size: int, tp_size: int = 1) -> int:
+    num_kv_heads = hf_config.num_key_value_heads // tp_size
+    return 2 * hf_config.num_hidden_layers * block_size * num_kv_heads * get_head_dim(hf_config) * dtype_bytes(hf_config)
+
+
+def num_cudagraphs(max_num_seqs: int) -> int:
+    return len(default_capture_sizes(min(max_num_seqs, 512)))
+
+
+def recommend_block_size(workload: Workload, candidates: list[int]) -> int:
+    # largest block whose expected half-block tail wastes at most 5% of an average sequence
+    avg_len = workload.avg_prompt_len + workload.avg_output_len
+    fitting = [bs for bs in candidates if bs / 2 <= 0.05 * avg_len]
+    return max(fitting) if fitting else min(candidates)
+
+
+def profile(
+    hf_config,
+    total_memory: int,
+    workload: Workload,
+    max_model_len: int,
+    gpu_memory_utilization: float = 0.9,
+    tensor_parallel_size: int = 1,
+    block_size_candidates: list[int] = (256, 512, 1024),
+    enforce_eager: bool = False,
+) -> MemoryProfile:
+    budget = int(total_memory * gpu_memory_utilization) - CUDA_CONTEXT_BYTES
+    weights = weight_bytes(hf_config, tensor_parallel_size)
+    assert budget > weights, "model weights do not fit in the memory budget"
+    block_size = recommend_block_size(workload, list(block_size_candidates))
+    max_num_batched_tokens = max_model_len
+    while activation_bytes(hf_config, 2 * max_num_batched_tokens, 1, tensor_parallel_size) <= 0.15 * (budget - weights):
+        max_num_batched_tokens *= 2
+    max_num_seqs = 512
+    for _ in range(2):    # the graph pool depends on max_num_seqs and vice versa
+        activations = activation_bytes(hf_config, max_num_batched_tokens, min(max_num_seqs, max_num_batched_tokens // max_model_len or 1), tensor_parallel_size)
+        graphs = 0 if enforce_eager else cudagraph_bytes(hf_config, min(max_num_seqs, 512), num_cudagraphs(max_num_seqs), tensor_parallel_size)
+        block_bytes = kv_block_bytes(hf_config, block_size, tensor_parallel_size)
+        num_blocks = (budget - weights - activations - graphs) // block_bytes
+        assert num_blocks > 0, "no memory left for the KV cache"
+        tokens_per_seq = workload.avg_prompt_len * (1 - workload.prefix_hit_rate) + workload.avg_output_len + block_size / 2
+        max_num_seqs = max(1, min(512, int(num_blocks * block_size / tokens_per_seq)))
+    return MemoryProfile(weights, activations, graphs, block_bytes, num_blocks, block_size, max_num_seqs, max_num_batched_tokens)
+
+
+def cache_dir() -> str:
+    return os.environ.get("NANOVLLM_CACHE_DIR", os.path.expanduser("~/.cache/nanovllm"))
+
+
+def profile_cached(model: str, hf_config, total_memory: int, workload: Workload, **kwargs) -> MemoryProfile:
+    key = json.dumps([os.path.abspath(model), hf_config.to_dict(), total_memory, asdict(workload), kwargs],
+                     sort_keys=True, default=str)
+    path = os.path.join(cache_dir(), "profiles", f"{xxhash.xxh64(key.encode()).hexdigest()}.json")
+    if os.path.exists(path):
+        with open(path) as f:
+            return MemoryProfile(**json.load(f))
+    result = profile(hf_config, total_memory, workload, **kwargs)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(asdict(result), f)
+    return result
+
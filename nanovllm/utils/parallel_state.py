@@ -0,0 +1,104 @@
+from torch import nn
+import torch.distributed as dist
+
+
+# ranks are laid out stage-major: rank = pp_rank * tp_size + tp_rank, so a stage's tensor parallel
+# group is contiguous and every rank exchanges activations with the same tp_rank of the adjacent stages
+
+_tp_group = None
+_tp_size = 1
+_pp_size = 1
+_num_comm_chunks = 1
+MIN_COMM_CHUNK_TOKENS = 256
+
+
+def init_parallel_state(tensor_parallel_size: int, pipeline_parallel_size: int, num_comm_chunks: int = 1):
+    global _tp_group, _tp_size, _pp_size, _num_comm_chunks
+    assert dist.get_world_size() == tensor_parallel_size * pipeline_parallel_size
+    _tp_size, _pp_size = tensor_parallel_size, pipeline_parallel_size
+    _num_comm_chunks = num_comm_chunks
+    _tp_group = dist.group.WORLD
+    if pipeline_parallel_size > 1:
+        for stage in range(pipeline_parallel_size):    # every rank must create every group, in the same order
+            group = dist.new_group(list(range(stage * tensor_parallel_size, (stage + 1) * tensor_parallel_size)))
+            if stage == get_pp_rank():
+                _tp_group = group
+
+
+def get_tp_group():
+    return _tp_group
+
+
+def get_tp_size() -> int:
+    return _tp_size
+
+
+def get_tp_rank() -> int:
+    return dist.get_rank() % _tp_size
+
+
+def get_num_comm_chunks(num_tokens: int) -> int:
+    # row chunks the tensor parallel all-reduces are split into, so that a chunk's all-reduce runs while
+    # the next chunk is computed. Small batches such as decode stay whole, there the per-chunk latency
+    # costs more than the overlap saves
+    return max(min(_num_comm_chunks, num_tokens // MIN_COMM_CHUNK_TOKENS), 1) if _tp_size > 1 else 1
+
+
+def get_pp_size() -> int:
+    return _pp_size
+
+
+def get_pp_rank() -> int:
+    return dist.get_rank() // _tp_size
+
+
+def is_first_stage() -> bool:
+    return get_pp_rank() == 0
+
+
+def is_last_stage() -> bool:
+    return get_pp_rank() == _pp_size - 1
+
+
+def prev_stage_rank() -> int:
+    return dist.get_rank() - _tp_size
+
+
+def next_stage_rank() -> int:
+    return dist.get_rank() + _tp_size
+
+
+def partition_layers(num_layers: int, pp_size: int, pp_rank: int) -> tuple[int, int]:
+    # contiguous split, the remainder goes to the middle stages since the first stage also
+    # runs the embedding and the last one the final norm, lm_head and sampler
+    assert num_layers >= pp_size
+    sizes = [num_layers // pp_size] * pp_size
+    remainder = num_layers % pp_size
+    middle = (pp_size - remainder) // 2
+    for stage in range(middle, middle + remainder):
+        sizes[stage] += 1
+    start = sum(sizes[:pp_rank])
+    return start, start + sizes[pp_rank]
+
+
+def split_micro_batches(num_tokens: list[int], num_micro_batches: int) -> list[tuple[int, int]]:
+    # contiguous [start, end) ranges over the scheduled sequences with roughly equal token counts,
+    # so that sampled tokens come back in the scheduled order
+    num_micro_batches = max(min(num_micro_batches, len(num_tokens)), 1)
+    total = sum(num_tokens)
+    bounds = [0]
+    cumulative = 0
+    for i, n in enumerate(num_tokens):
+        cumulative += n
+        remaining_seqs = len(num_tokens) - i - 1
+        remaining_batches = num_micro_batches - len(bounds)
+        if remaining_batches > 0 and (cumulative >= total * len(bounds) / num_micro_batches or remaining_seqs == remaining_batches):
+            bounds.append(i + 1)
+    bounds.append(len(num_tokens))
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+class PPMissingLayer(nn.Identity):
+    # placeholder for a module owned by another pipeline stage, keeps the parameter names of the
+    # remaining modules aligned with the checkpoint
+    pass
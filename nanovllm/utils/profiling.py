@@ -0,0 +1,66 @@
+import os
+from contextlib import nullcontext
+import torch
+from torch.profiler import profile, record_function, ProfilerActivity
+
+
+class ProfileRange:
+
+    def __init__(self, name: str, nvtx: bool):
+        self.record = record_function(name)
+        self.name = name
+        self.nvtx = nvtx
+
+    def __enter__(self):
+        self.record.__enter__()
+        if self.nvtx:
+            torch.cuda.nvtx.range_push(self.name)
+
+    def __exit__(self, *args):
+        if self.nvtx:
+            torch.cuda.nvtx.range_pop()
+        self.record.__exit__(*args)
+
+
+class StepProfiler:
+    # torch profiler over a window of engine steps, ranges are only recorded while it runs
+
+    def __init__(self):
+        self.active = False
+        self.nvtx = False
+        self.profiler = None
+
+    def start(self, device: str):
+        activities = [ProfilerActivity.CPU]
+        if device == "cuda":
+            activities.append(ProfilerActivity.CUDA)
+        self.profiler = profile(activities=activities, record_shapes=True)
+        self.profiler.start()
+        self.nvtx = device == "cuda"
+        self.active = True
+
+    def stop(self, path: str):
+        self.active = False
+        self.profiler.stop()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.profiler.export_chrome_trace(path)
+        self.profiler = None
+
+
+profiler = StepProfiler()
+
+
+def profile_range(name: str):
+    return ProfileRange(name, profiler.nvtx) if profiler.active else nullcontext()
+
+
+def parse_profile_steps(spec: str) -> list[int]:
+    # "100-110" for steps 100..109, or a comma separated list of steps and ranges
+    steps = []
+    for part in spec.split(","):
+        if "-" in part:
+            start, end = part.split("-")
+            steps.extend(range(int(start), int(end)))
+        elif part.strip():
+            steps.append(int(part))
+    return steps
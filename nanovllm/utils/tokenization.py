@@ -0,0 +1,54 @@
+from concurrent.futures import Future, ThreadPoolExecutor, ProcessPoolExecutor
+from multiprocessing import get_context
+from transformers import AutoTokenizer
+
+
+def encode_batch(tokenizer, prompts: list[str | list[int]]) -> list[str | list[int]]:
+    # without a tokenizer prompts pass through unchanged, the engine decides what to do with text
+    if tokenizer is None:
+        return list(prompts)
+    texts = [prompt for prompt in prompts if isinstance(prompt, str)]
+    encoded = iter(tokenizer(texts)["input_ids"] if texts else ())
+    return [next(encoded) if isinstance(prompt, str) else prompt for prompt in prompts]
+
+
+def decode_tokens(tokenizer, token_ids: list[int]) -> str | None:
+    return tokenizer.decode(token_ids) if tokenizer is not None else None
+
+
+worker_tokenizer = None
+
+
+def init_worker(name_or_path: str):
+    global worker_tokenizer
+    worker_tokenizer = AutoTokenizer.from_pretrained(name_or_path, use_fast=True)
+
+
+def worker_encode_batch(prompts: list[str | list[int]]) -> list[list[int]]:
+    return encode_batch(worker_tokenizer, prompts)
+
+
+class TokenizerWorker:
+    # a single background thread owns the tokenizer, fast tokenizers must not be used from two threads at once.
+    # Encoding can instead fan out to a process pool, each process loading its own tokenizer.
+
+    def __init__(self, tokenizer, num_processes: int = 0):
+        self.tokenizer = tokenizer
+        self.thread = ThreadPoolExecutor(1, thread_name_prefix="nanovllm-tokenizer")
+        self.pool = None
+        if num_processes and tokenizer is not None:
+            self.pool = ProcessPoolExecutor(num_processes, get_context("spawn"), init_worker, (tokenizer.name_or_path,))
+        self.max_in_flight = 2 * max(num_processes, 1)
+
+    def encode(self, prompts: list[str | list[int]]) -> Future:
+        if self.pool is not None:
+            return self.pool.submit(worker_encode_batch, prompts)
+        return self.thread.submit(encode_batch, self.tokenizer, prompts)
+
+    def decode(self, token_ids: list[int]) -> Future:
+        return self.thread.submit(decode_tokens, self.tokenizer, token_ids)
+
+    def shutdown(self):
+        self.thread.shutdown()
+        if self.pool is not None:
+            self.pool.shutdown()
@@ -0,0 +1,109 @@
+import json
+from collections import deque
+from dataclasses import dataclass, asdict
+from time import perf_counter
+
+
+@dataclass
+class InitEvent:
+    num_blocks: int
+    block_size: int
+
+
+@dataclass
+class StepEvent:
+    is_prefill: bool
+    block_tables: dict[int, list[int]]
+
+
+@dataclass
+class ScheduleEvent:
+    is_prefill: bool
+    seq_ids: list[int]
+    num_batched_tokens: int
+    reason: str | None
+
+
+@dataclass
+class AllocateEvent:
+    seq_id: int
+    block_table: list[int]
+    num_cached_tokens: int
+
+
+@dataclass
+class CacheHitEvent:
+    seq_id: int
+    block_id: int
+
+
+@dataclass
+class FreeEvent:
+    seq_id: int
+    block_ids: list[int]
+
+
+@dataclass
+class PreemptEvent:
+    seq_id: int
+    num_tokens: int
+    num_prompt_tokens: int
+    block_table: list[int]
+
+
+EVENT_TYPES = {
+    InitEvent: "init",
+    StepEvent: "step",
+    ScheduleEvent: "schedule",
+    AllocateEvent: "allocate",
+    CacheHitEvent: "cache_hit",
+    FreeEvent: "free",
+    PreemptEvent: "preempt",
+}
+
+
+class Tracer:
+    # ring buffer of engine events, call sites check tracer.enabled before building an event
+
+    def __init__(self):
+        self.enabled = False
+        self.path = None
+        self.step = 0
+        self.buffer = deque()
+
+    def enable(self, path: str | None = None, buffer_size: int = 65536):
+        self.enabled = True
+        self.path = path
+        self.buffer = deque(maxlen=buffer_size)
+        if path is not None:
+            open(path, "w").close()
+
+    def disable(self):
+        self.flush()
+        self.enabled = False
+
+    def emit(self, event):
+        self.buffer.append((self.step, perf_counter(), event))
+        if self.path is not None and len(self.buffer) == self.buffer.maxlen:
+            self.flush()
+
+    def records(self):
+        return [dict(step=step, time=t, type=EVENT_TYPES[type(event)], **asdict(event)) for step, t, event in self.buffer]
+
+    def flush(self):
+        if self.path is None or not self.buffer:
+            return
+        with open(self.path, "a") as f:
+            for record in self.records():
+                f.write(json.dumps(record) + "\n")
+        self.buffer.clear()
+
+
+tracer = Tracer()
+
+
+def read_trace(path: str):
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
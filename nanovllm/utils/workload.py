@@ -0,0 +1,162 @@
+import json
+import time
+import argparse
+from collections import deque
+from dataclasses import dataclass
+from random import Random
+import numpy as np
+
+from nanovllm.sampling_params import SamplingParams
+from nanovllm.utils.batch_io import record_prompt
+
+
+@dataclass
+class Request:
+    prompt: str | list[int]
+    max_tokens: int
+    arrival_time: float = 0.
+    temperature: float = 1.0
+    ignore_eos: bool = False
+    priority: int = 0
+    tenant: str = "default"
+
+
+def load_trace(path: str, max_tokens: int = 256, limit: int | None = None) -> list[Request]:
+    # one JSON object per line: prompt_token_ids, prompt, or title/body as in requests.jsonl,
+    # plus optional max_tokens, arrival_time, temperature, ignore_eos, priority and tenant
+    requests = []
+    with open(path) as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            requests.append(Request(
+                record_prompt(record),
+                record.get("max_tokens", max_tokens),
+                record.get("arrival_time", 0.),
+                record.get("temperature", 1.0),
+                record.get("ignore_eos", False),
+                record.get("priority", 0),
+                record.get("tenant", "default"),
+            ))
+            if limit is not None and len(requests) == limit:
+                break
+    return requests
+
+
+def synthetic_trace(
+    num_requests: int,
+    input_len: tuple[int, int],
+    output_len: tuple[int, int],
+    num_prefix_groups: int = 0,
+    shared_prefix_len: int = 0,
+    vocab_size: int = 10000,
+    seed: int = 0,
+) -> list[Request]:
+    # random token prompts, optionally split into groups sharing a common prefix
+    random = Random(seed)
+    prefixes = [[random.randrange(vocab_size) for _ in range(shared_prefix_len)] for _ in range(num_prefix_groups)]
+    requests = []
+    for i in range(num_requests):
+        prefix = prefixes[i * num_prefix_groups // num_requests] if prefixes else []
+        unique_len = random.randint(max(input_len[0] - len(prefix), 1), max(input_len[1] - len(prefix), 1))
+        prompt = prefix + [random.randrange(vocab_size) for _ in range(unique_len)]
+        requests.append(Request(prompt, random.randint(*output_len), temperature=0.6, ignore_eos=True))
+    return requests
+
+
+def assign_arrivals(requests: list[Request], request_rate: float, seed: int = 0):
+    # Poisson arrivals at request_rate per second, all at once for an infinite rate
+    random = Random(seed)
+    t = 0.
+    for request in requests:
+        request.arrival_time = t
+        if request_rate != float("inf"):
+            t += random.expovariate(request_rate)
+
+
+def add_workload_args(parser: argparse.ArgumentParser):
+    parser.add_argument("--trace", help="JSONL trace, e.g. requests.jsonl; a synthetic workload when omitted")
+    parser.add_argument("--max-tokens", type=int, default=256, help="output length for trace entries without max_tokens")
+    parser.add_argument("--num-requests", type=int, default=256)
+    parser.add_argument("--input-len", type=int, nargs=2, default=(100, 1024))
+    parser.add_argument("--output-len", type=int, nargs=2, default=(100, 1024))
+    parser.add_argument("--prefix-groups", type=int, default=3, help="synthetic prompts sharing one of N prefixes, 0 to disable")
+    parser.add_argument("--shared-prefix-len", type=int, default=256)
+    parser.add_argument("--ignore-eos", action="store_true")
+    parser.add_argument("--arrivals", choices=("poisson", "recorded"), default="poisson")
+    parser.add_argument("--request-rate", type=float, default=float("inf"), help="Poisson arrivals per second")
+    parser.add_argument("--seed", type=int, default=0)
+
+
+def build_requests(args: argparse.Namespace) -> list[Request]:
+    if args.trace:
+        requests = load_trace(args.trace, args.max_tokens, args.num_requests)
+    else:
+        shared_prefix_len = args.shared_prefix_len if args.prefix_groups else 0
+        requests = synthetic_trace(args.num_requests, args.input_len, args.output_len,
+                                   args.prefix_groups, shared_prefix_len, seed=args.seed)
+    for request in requests:
+        request.ignore_eos |= args.ignore_eos
+    if args.arrivals == "poisson":
+        assign_arrivals(requests, args.request_rate, args.seed)
+    return requests
+
+
+def replay(engine, requests: list[Request], wait=time.sleep):
+    # submit requests as their arrival times come due and step the engine until all finish,
+    # times are relative to the engine's scheduler clock
+    clock = engine.scheduler.clock
+    pending = deque(sorted(requests, key=lambda request: request.arrival_time))
+    seqs = []
+    start = clock()
+    while pending or not engine.is_finished():
+        now = clock() - start
+        while pending and pending[0].arrival_time <= now:
+            request = pending.popleft()
+            sp = SamplingParams(temperature=request.temperature, max_tokens=request.max_tokens, ignore_eos=request.ignore_eos,
+                                priority=request.priority, tenant=request.tenant)
+            seq = engine.add_request(request.prompt, sp)
+            seq.arrival_time = start + request.arrival_time
+            seqs.append(seq)
+        if engine.is_finished():
+            wait(pending[0].arrival_time - now)
+            continue
+        engine.step()
+    return seqs, clock() - start
+
+
+def percentiles(values: list[float], qs: tuple[int, ...] = (50, 90, 99)) -> dict:
+    if not values:
+        return dict(mean=None, **{f"p{q}": None for q in qs})
+    return dict(mean=float(np.mean(values)), **{f"p{q}": float(np.percentile(values, q)) for q in qs})
+
+
+def summarize(seqs, duration: float, stats: dict) -> dict:
+    metrics = [seq.metrics for seq in seqs]
+    num_input_tokens = sum(seq.num_prompt_tokens for seq in seqs)
+    num_output_tokens = sum(seq.num_completion_tokens for seq in seqs)
+    return dict(
+        num_requests=len(seqs),
+        duration=duration,
+        num_input_tokens=num_input_tokens,
+        num_output_tokens=num_output_tokens,
+        request_throughput=len(seqs) / duration,
+        output_throughput=num_output_tokens / duration,
+        total_throughput=(num_input_tokens + num_output_tokens) / duration,
+        **{key: percentiles([m[key] for m in metrics if m[key] is not None])
+           for key in ("queue_time", "ttft", "tpot", "e2e_latency")},
+        prefix_cache_hit_rate=stats["prefix_cache_hit_rate"],
+        num_preemptions=stats["num_preemptions_total"],
+        num_steps=stats["num_steps"],
+    )
+
+
+def print_summary(results: dict):
+    print(f"Requests: {results['num_requests']}, Output: {results['num_output_tokens']}tok, Time: {results['duration']:.2f}s, "
+          f"Throughput: {results['output_throughput']:.2f}tok/s")
+    for key in ("queue_time", "ttft", "tpot", "e2e_latency"):
+        values = results[key]
+        if values["mean"] is not None:
+            print(f"{key}: " + ", ".join(f"{name}={value * 1000:.2f}ms" for name, value in values.items()))
+    print(f"Prefix cache hit rate: {results['prefix_cache_hit_rate']:.2%}, Preemptions: {results['num_preemptions']}")
@@ -0,0 +1,92 @@
+import os
+import json
+import argparse
+from itertools import product
+import torch
+from transformers import AutoConfig, Qwen3Config
+from nanovllm.config import Config
+from nanovllm.engine.simulator import LinearCostModel, RooflineCostModel, simulate
+from nanovllm.utils.memory_profiler import GiB, Workload, profile_cached
+from nanovllm.utils.workload import add_workload_args, build_requests, print_summary
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Predict serving metrics by simulating the scheduler with a step cost model.")
+    parser.add_argument("--model", default=os.path.expanduser("~/huggingface/Qwen3-0.6B/"), help="model directory, only its config.json is read")
+    add_workload_args(parser)
+    parser.add_argument("--num-kvcache-blocks", type=int, nargs="+", default=[1024])
+    parser.add_argument("--kvcache-block-size", type=int, default=256)
+    parser.add_argument("--max-num-seqs", type=int, nargs="+", default=[512])
+    parser.add_argument("--max-num-batched-tokens", type=int, nargs="+", default=[16384])
+    parser.add_argument("--max-model-len", type=int, default=4096)
+    parser.add_argument("--tensor-parallel-size", type=int, default=1)
+    parser.add_argument("--cost-model", choices=("roofline", "linear"), default="roofline")
+    parser.add_argument("--peak-tflops", type=float, default=312.)
+    parser.add_argument("--memory-bandwidth-gbps", type=float, default=2000.)
+    parser.add_argument("--linear-coefficients", type=float, nargs=5, metavar=("PREFILL_BASE", "PER_TOKEN", "DECODE_BASE", "PER_SEQ", "PER_CONTEXT_TOKEN"),
+                        default=(5e-3, 5e-5, 8e-3, 5e-5, 5e-8))
+    parser.add_argument("--recommend", action="store_true",
+                        help="size the KV cache, block size, max_num_seqs and max_num_batched_tokens for --gpu-memory-gb "
+                             "with the analytical memory profiler instead of sweeping them")
+    parser.add_argument("--gpu-memory-gb", type=float, default=80.)
+    parser.add_argument("--gpu-memory-utilization", type=float, default=0.9)
+    parser.add_argument("--prefix-hit-rate", type=float, default=0., help="expected share of prompt tokens served from the prefix cache")
+    parser.add_argument("--output", help="write the results of every configuration as JSON")
+    return parser.parse_args()
+
+
+def recommend(args, hf_config):
+    requests = build_requests(args)
+    workload = Workload(
+        avg_prompt_len=round(sum(len(r.prompt.encode() if isinstance(r.prompt, str) else r.prompt) for r in requests) / len(requests)),
+        avg_output_len=round(sum(r.max_tokens for r in requests) / len(requests)),
+        prefix_hit_rate=args.prefix_hit_rate,
+    )
+    profile = profile_cached(args.model, hf_config, int(args.gpu_memory_gb * GiB), workload, max_model_len=args.max_model_len,
+                             gpu_memory_utilization=args.gpu_memory_utilization, tensor_parallel_size=args.tensor_parallel_size)
+    print(f"Recommended for {workload}: kvcache_block_size={profile.kvcache_block_size}, "
+          f"num_kvcache_blocks={profile.num_kvcache_blocks}, max_num_seqs={profile.max_num_seqs}, "
+          f"max_num_batched_tokens={profile.max_num_batched_tokens}\n")
+    args.kvcache_block_size = profile.kvcache_block_size
+    args.num_kvcache_blocks = [profile.num_kvcache_blocks]
+    args.max_num_seqs = [profile.max_num_seqs]
+    args.max_num_batched_tokens = [profile.max_num_batched_tokens]
+
+
+def main():
+    args = parse_args()
+    hf_config = AutoConfig.from_pretrained(args.model) if os.path.isdir(args.model) else Qwen3Config()
+    hf_config.torch_dtype = hf_config.torch_dtype or torch.bfloat16
+    if args.cost_model == "roofline":
+        cost_model = RooflineCostModel(hf_config, args.tensor_parallel_size, args.peak_tflops * 1e12, args.memory_bandwidth_gbps * 1e9)
+    else:
+        cost_model = LinearCostModel(*args.linear_coefficients)
+    if args.recommend:
+        recommend(args, hf_config)
+
+    results = []
+    for num_blocks, max_num_seqs, max_num_batched_tokens in product(args.num_kvcache_blocks, args.max_num_seqs, args.max_num_batched_tokens):
+        config = Config(
+            args.model,
+            hf_config=hf_config,
+            num_kvcache_blocks=num_blocks,
+            kvcache_block_size=args.kvcache_block_size,
+            max_num_seqs=max_num_seqs,
+            max_num_batched_tokens=max_num_batched_tokens,
+            max_model_len=args.max_model_len,
+            tensor_parallel_size=args.tensor_parallel_size,
+            attention_backend="sdpa",    # only block alignment is checked
+        )
+        result = simulate(config, build_requests(args), cost_model, args.seed)
+        result["config"] = dict(num_kvcache_blocks=num_blocks, max_num_seqs=max_num_seqs, max_num_batched_tokens=max_num_batched_tokens)
+        print(f"num_kvcache_blocks={num_blocks}, max_num_seqs={max_num_seqs}, max_num_batched_tokens={max_num_batched_tokens}")
+        print_summary(result)
+        print(f"Preemption rate: {result['preemption_rate']:.2f}\n")
+        results.append(result)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
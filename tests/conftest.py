@@ -0,0 +1,42 @@
+from concurrent.futures import ProcessPoolExecutor
+import pytest
+import torch
+import torch.multiprocessing as mp
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import AutoConfig, AutoModelForCausalLM, PreTrainedTokenizerFast
+
+TINY = dict(vocab_size=320, hidden_size=64, intermediate_size=128, num_hidden_layers=2, num_attention_heads=4,
+            num_key_value_heads=2, head_dim=16, max_position_embeddings=1024, eos_token_id=256)
+
+
+@pytest.fixture(scope="session")
+def tiny_model(tmp_path_factory):
+    # saves a tiny random-weight model with a word level tokenizer over "t0" ... "t255", returns its path
+    # and the transformers model as the reference
+    cache = {}
+
+    def build(model_type: str = "qwen3", **overrides) -> tuple[str, torch.nn.Module]:
+        key = model_type, repr(sorted(overrides.items()))
+        if key not in cache:
+            path = str(tmp_path_factory.mktemp(model_type))
+            config = AutoConfig.for_model(model_type, **TINY | overrides)
+            torch.manual_seed(0)
+            model = AutoModelForCausalLM.from_config(config, dtype=torch.float32)
+            model.save_pretrained(path)
+            vocab = {f"t{i}": i for i in range(256)} | {"<eos>": 256}
+            tokenizer = Tokenizer(models.WordLevel(vocab, unk_token="t0"))
+            tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+            PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="<eos>").save_pretrained(path)
+            cache[key] = path, model
+        return cache[key]
+    return build
+
+
+
+@pytest.fixture
+def run_in_process():
+    # an engine's process group keeps its port bound until the process exits, so every engine runs in a fresh one
+    def run(fn, *args):
+        with ProcessPoolExecutor(1, mp_context=mp.get_context("spawn")) as pool:
+            return pool.submit(fn, *args).result()
+    return run
@@ -0,0 +1,30 @@
+from nanovllm.engine.block_manager import BlockManager
+from nanovllm.engine.sequence import Sequence
+from nanovllm.sampling_params import SamplingParams
+
+BLOCK_SIZE = 16
+
+
+def run(block_manager: BlockManager, token_ids: list[int], num_prompt_tokens: int, **kwargs) -> Sequence:
+    seq = Sequence(token_ids[:num_prompt_tokens], SamplingParams(**kwargs))
+    block_manager.allocate(seq)
+    for token_id in token_ids[num_prompt_tokens:]:
+        seq.append_token(token_id)
+        block_manager.may_append(seq)
+    return seq
+
+
+def test_windowed_blocks_are_not_shared_with_full_attention():
+    Sequence.block_size = BLOCK_SIZE
+    block_manager = BlockManager(32, BLOCK_SIZE)
+    token_ids = list(range(1, 7 * BLOCK_SIZE + 1))
+    windowed = run(block_manager, token_ids, 2 * BLOCK_SIZE, sliding_window=2 * BLOCK_SIZE, num_sink_tokens=BLOCK_SIZE)
+    assert windowed.num_dropped_blocks > 0
+    # the blocks decoded after the first drop attended over the window only, a full attention request
+    # with the same tokens must not reuse them
+    full = Sequence(token_ids)
+    block_manager.allocate(full)
+    assert full.num_cached_tokens == 0
+    same_window = Sequence(token_ids[:2 * BLOCK_SIZE], SamplingParams(sliding_window=2 * BLOCK_SIZE, num_sink_tokens=BLOCK_SIZE))
+    block_manager.allocate(same_window)
+    assert same_window.num_cached_tokens == 2 * BLOCK_SIZE
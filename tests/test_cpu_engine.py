@@ -0,0 +1,20 @@
+import torch
+
+from nanovllm import LLM, SamplingParams
+
+
+def generate(path: str, prompts: list[list[int]]) -> list[list[int]]:
+    llm = LLM(path, device="cpu", max_model_len=256, max_num_batched_tokens=256)
+    outputs = llm.generate(prompts, SamplingParams(temperature=1e-6, max_tokens=8, ignore_eos=True), use_tqdm=False)
+    llm.exit()
+    return [output["token_ids"] for output in outputs]
+
+
+def test_cpu_engine_matches_transformers(tiny_model, run_in_process):
+    # builds the full engine on cpu, with torch.compile enabled as shipped
+    path, hf_model = tiny_model()
+    prompts = [[1, 2, 3], list(range(5, 45)), list(range(100, 200, 3))]
+    outputs = run_in_process(generate, path, prompts)
+    for prompt, output in zip(prompts, outputs):
+        reference = hf_model.generate(torch.tensor([prompt]), max_new_tokens=8, do_sample=False)
+        assert output == reference[0, len(prompt):].tolist()
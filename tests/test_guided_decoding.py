@@ -0,0 +1,120 @@
+import re
+import json
+import random
+import pytest
+from tokenizers import Tokenizer, models, pre_tokenizers
+from transformers import PreTrainedTokenizerFast
+
+from nanovllm.utils.guided_decoding import (DFA, TokenFSM, TokenVocabulary, get_token_fsm, grammar_to_regex,
+                                            json_schema_to_regex, pattern_key)
+
+TOKENS = ["0", "1", "2", "12", "007", "a", "b", "ab", "ba", "{", "}", '"', ":", ",", " ", "1a", "<eos>"]
+
+
+def make_tokenizer() -> PreTrainedTokenizerFast:
+    tokenizer = Tokenizer(models.WordLevel({token: i for i, token in enumerate(TOKENS)}, unk_token="a"))
+    tokenizer.pre_tokenizer = pre_tokenizers.Whitespace()
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, eos_token="<eos>")
+
+
+def matches(dfa: DFA, text: str) -> bool:
+    state = 0
+    for c in text:
+        state = dfa.step(state, c)
+        if state == -1:
+            return False
+    return dfa.is_accepting(state)
+
+
+@pytest.mark.parametrize("pattern", [r"\d{3}-\d{2,4}", r"(ab|cd)*e?", r"[^a-c\n]+x", r"colou?r", r"(?:yes|no|maybe)",
+                                     r"[\w.]+@[a-z]+\.(com|org)", r"a{2,}b{0,2}", r"\[[0-9, ]*\]", r"[]a]+", r"xA\x42.",
+                                     r"^a+?$", r"\D\W\S"])
+def test_dfa_matches_re(pattern):
+    dfa = DFA(pattern)
+    rng = random.Random(0)
+    alphabet = "abcdexyz0123456789-.@ ,[]\nABC_r"
+    for _ in range(2000):
+        text = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 8)))
+        assert matches(dfa, text) == bool(re.fullmatch(pattern, text)), text
+
+
+@pytest.mark.parametrize("pattern", ["(ab", "ab)", "a{3,1}", "*a", "(?=a)", r"\p", "[z-a]", r"\x4"])
+def test_dfa_rejects_bad_regex(pattern):
+    with pytest.raises(ValueError):
+        DFA(pattern)
+
+
+def test_json_schema_to_regex():
+    schema = {"type": "object", "required": ["name"], "properties": {
+        "name": {"type": "string", "maxLength": 5},
+        "age": {"type": "integer"},
+        "tags": {"type": "array", "items": {"enum": ["a", "b"]}, "maxItems": 2},
+        "ok": {"type": ["boolean", "null"]},
+        "pet": {"$ref": "#/$defs/pet"},
+    }, "$defs": {"pet": {"anyOf": [{"const": "cat"}, {"type": "number"}]}}}
+    pattern = json_schema_to_regex(schema)
+    dfa = DFA(pattern)
+    valid = ['{"name":"bob"}', '{ "name": "bob", "age": -3, "ok": null }', '{"name":"bob","tags":["a","b"]}',
+             '{"name":"x","ok":true,"pet":"cat"}', '{"name":"x","pet":1.5e3}', '{"name":"\\u00e9\\n"}']
+    invalid = ['{"age":3}', '{"name":"toolong"}', '{"name":"x","tags":["a","b","a"]}', '{"name":"x","age":1.5}',
+               '{"age":3,"name":"x"}', '{"name":"x",}', '{"name":"x","pet":"dog"}']
+    for text in valid:
+        json.loads(text)
+        assert re.fullmatch(pattern, text) and matches(dfa, text), text
+    for text in invalid:
+        assert not re.fullmatch(pattern, text) and not matches(dfa, text), text
+
+
+def test_json_schema_optional_members():
+    pattern = json_schema_to_regex({"type": "object", "properties": {"a": {"type": "integer"}, "b": {"type": "integer"}}})
+    for text, valid in [("{}", True), ('{"a":1}', True), ('{"b":2}', True), ('{"a":1,"b":2}', True),
+                        ('{,"b":2}', False), ('{"a":1,}', False), ('{"b":2,"a":1}', False)]:
+        assert bool(re.fullmatch(pattern, text)) == valid, text
+
+
+def test_json_schema_rejects_unsupported():
+    with pytest.raises(ValueError):
+        json_schema_to_regex({"$ref": "other.json#/a"})
+    with pytest.raises(ValueError):
+        json_schema_to_regex({"$defs": {"node": {"type": "array", "items": {"$ref": "#/$defs/node"}}}, "$ref": "#/$defs/node"})
+
+
+def test_grammar_to_regex():
+    pattern = grammar_to_regex("# greeting\nroot ::= <greet> <name>\ngreet ::= hi|hello\nname ::= [A-Z][a-z]+")
+    assert re.fullmatch(pattern, "hello Bob") and not re.fullmatch(pattern, "hey Bob")
+    for grammar in ["root ::= a<root>", "root ::= <missing>", "root = a"]:
+        with pytest.raises(ValueError):
+            grammar_to_regex(grammar)
+
+
+def test_token_mask():
+    vocab = TokenVocabulary(make_tokenizer(), len(TOKENS))
+    eos = TOKENS.index("<eos>")
+    fsm = TokenFSM(r"\d+", vocab)
+    digits = {i for i, token in enumerate(TOKENS) if token.isdigit()}
+    assert set(fsm.allowed(0).nonzero().flatten().tolist()) == digits
+    state = fsm.next_state(0, TOKENS.index("12"))
+    # the pattern may end after a digit, so EOS joins the digits
+    assert set(fsm.allowed(state).nonzero().flatten().tolist()) == digits | {eos}
+    assert fsm.next_state(0, TOKENS.index("1a")) == -1
+    # a token may cross the end of a pattern only if the pattern continues with its remaining characters
+    fsm = TokenFSM(r"(ab|b)a", vocab)
+    allowed = {TOKENS[i] for i in fsm.allowed(0).nonzero().flatten().tolist()}
+    assert allowed == {"a", "b", "ab", "ba"}
+    # nothing continues a complete pattern, only EOS is allowed
+    state = fsm.next_state(0, TOKENS.index("ba"))
+    assert fsm.allowed(state).nonzero().flatten().tolist() == [eos]
+
+
+def test_mask_cache(tmp_path):
+    make_tokenizer().save_pretrained(tmp_path)
+    pattern = json_schema_to_regex({"type": "object", "properties": {"a": {"type": "integer"}}})
+    key = pattern_key(pattern)
+    fsm = get_token_fsm(str(tmp_path), len(TOKENS), key, pattern)
+    # later lookups, like those of the ranks that only get the key with decodes, reuse the compiled pattern
+    assert get_token_fsm(str(tmp_path), len(TOKENS), key) is fsm
+    mask = fsm.allowed(0)
+    assert list(fsm.masks) == [0]
+    assert fsm.allowed(0) is mask
+    assert fsm.allowed(fsm.next_state(0, TOKENS.index("{"))) is not mask
+    assert len(fsm.masks) == 2
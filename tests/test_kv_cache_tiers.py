@@ -0,0 +1,70 @@
+import torch
+
+from nanovllm.engine.block_manager import BlockManager
+from nanovllm.engine.kv_cache_tiers import TierIndex, KVCacheTiers, HOST, DISK
+from nanovllm.engine.sequence import Sequence
+
+BLOCK_SIZE = 4
+
+
+def test_tier_index_lru():
+    index = TierIndex(2, 2)
+    assert index.offload(1, [1], 10) == [("gpu_to_host", 10, 0)]
+    assert index.offload(2, [2], 11) == [("gpu_to_host", 11, 1)]
+    assert index.offload(1, [1], 12) == []    # already offloaded
+    assert index.lookup(1, [1]) == (HOST, 0)    # now the most recently used host block
+    # the host pool is full, its least recently used block spills to disk
+    assert index.offload(3, [3], 13) == [("host_to_disk", 1, 0), ("gpu_to_host", 13, 1)]
+    assert index.lookup(2, [2]) == (DISK, 0)
+    assert index.lookup(3, [4]) is None    # hash collision with other tokens
+    assert index.offload(4, [4], 14) == [("host_to_disk", 0, 1), ("gpu_to_host", 14, 0)]
+    # the disk is full too, its least recently used block is dropped
+    assert index.offload(5, [5], 15) == [("host_to_disk", 1, 0), ("gpu_to_host", 15, 1)]
+    assert index.lookup(2, [2]) is None
+    assert len(index) == 4
+    assert index.load_op(index.lookup(1, [1]), 7) == ("disk_to_gpu", 1, 7)
+
+
+def test_kv_cache_tiers_round_trip(tmp_path):
+    kv_cache = torch.randn(2, 3, 4, BLOCK_SIZE, 2, 8)
+    blocks = kv_cache.clone()
+    tiers = KVCacheTiers(kv_cache, 1, 2, str(tmp_path / "kv"))
+    tiers.apply([("gpu_to_host", 0, 0), ("host_to_disk", 0, 1), ("gpu_to_host", 1, 0), ("gpu_to_disk", 2, 0)])
+    kv_cache.zero_()
+    tiers.apply([("disk_to_gpu", 1, 3), ("host_to_gpu", 0, 2), ("disk_to_gpu", 0, 1)])
+    torch.testing.assert_close(kv_cache[:, :, 3], blocks[:, :, 0])
+    torch.testing.assert_close(kv_cache[:, :, 2], blocks[:, :, 1])
+    torch.testing.assert_close(kv_cache[:, :, 1], blocks[:, :, 2])
+    tiers.close()
+    assert not (tmp_path / "kv").exists()
+
+
+def test_block_manager_reloads_evicted_prefixes(tmp_path):
+    # fake KV: a block holds its chained hash, so a block loaded back must hold the hash it is indexed by
+    Sequence.block_size = BLOCK_SIZE
+    block_manager = BlockManager(4, BLOCK_SIZE, num_host_blocks=2, num_disk_blocks=8)
+    kv_cache = torch.zeros(2, 1, 4, BLOCK_SIZE, 1, 1, dtype=torch.float64)
+    tiers = KVCacheTiers(kv_cache, 2, 8, str(tmp_path / "kv"))
+
+    def run(token_ids: list[int]) -> int:
+        seq = Sequence(token_ids)
+        block_manager.allocate(seq)
+        tiers.apply(block_manager.kv_transfers)
+        block_manager.kv_transfers = []
+        for i, block_id in enumerate(seq.block_table):
+            h = block_manager.blocks[block_id].hash % 2**31
+            if i >= seq.num_cached_blocks:    # computed by the forward pass
+                kv_cache[:, :, block_id] = h
+            assert (kv_cache[:, :, block_id] == h).all()
+        num_cached_tokens = seq.num_cached_tokens
+        block_manager.deallocate(seq)
+        return num_cached_tokens
+
+    prompts = [[i] * 2 * BLOCK_SIZE for i in range(1, 5)]
+    for prompt in prompts:
+        assert run(prompt) == 0
+    # every gpu block was reused since, the first prompts come back from the host and disk tiers
+    for prompt in prompts:
+        assert run(prompt) == 2 * BLOCK_SIZE
+    assert block_manager.num_tier_hits >= 4
+    tiers.close()
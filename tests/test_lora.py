@@ -0,0 +1,66 @@
+import os
+import json
+import pytest
+import torch
+from safetensors.torch import save_file
+
+from nanovllm import LLM, SamplingParams
+
+MODULES = {"self_attn": ["q_proj", "k_proj", "v_proj", "o_proj"], "mlp": ["gate_proj", "up_proj", "down_proj"]}
+
+
+def save_adapter(hf_model, path: str, seed: int, r: int) -> dict[str, torch.Tensor]:
+    # a random PEFT adapter over every projection, returns the weight deltas it merges into the model
+    generator = torch.Generator().manual_seed(seed)
+    alpha = 2 * r
+    tensors = {}
+    deltas = {}
+    for i, layer in enumerate(hf_model.model.layers):
+        for parent, names in MODULES.items():
+            for name in names:
+                linear = getattr(getattr(layer, parent), name)
+                lora_a = torch.randn(r, linear.in_features, generator=generator) * 0.3
+                lora_b = torch.randn(linear.out_features, r, generator=generator) * 0.3
+                prefix = f"base_model.model.model.layers.{i}.{parent}.{name}"
+                tensors[f"{prefix}.lora_A.weight"] = lora_a
+                tensors[f"{prefix}.lora_B.weight"] = lora_b
+                deltas[f"model.layers.{i}.{parent}.{name}.weight"] = alpha / r * lora_b @ lora_a
+    os.makedirs(path)
+    save_file(tensors, os.path.join(path, "adapter_model.safetensors"))
+    with open(os.path.join(path, "adapter_config.json"), "w") as f:
+        json.dump({"r": r, "lora_alpha": alpha}, f)
+    return deltas
+
+
+def generate(path: str, adapters: dict[str, str], prompts: list[list[int]], lora_ids: list[str | None], tp_size: int):
+    llm = LLM(path, device="cpu", tensor_parallel_size=tp_size, attention_backend="sdpa", kvcache_block_size=16,
+              max_model_len=256, max_num_batched_tokens=1024, lora_adapters=adapters, max_loras=2, max_lora_rank=8)
+    sampling_params = [SamplingParams(temperature=1e-6, max_tokens=8, ignore_eos=True, lora_id=lora_id) for lora_id in lora_ids]
+    outputs = llm.generate(prompts, sampling_params, use_tqdm=False)
+    llm.exit()
+    return [output["token_ids"] for output in outputs]
+
+
+@pytest.mark.parametrize("tp_size", [1, 2])
+def test_mixed_adapter_batch_matches_merged_weights(tiny_model, run_in_process, tmp_path, tp_size):
+    path, hf_model = tiny_model()
+    adapters = {}
+    deltas = {}
+    for i, r in enumerate([4, 8, 2]):
+        adapters[f"a{i}"] = str(tmp_path / f"a{i}")
+        deltas[f"a{i}"] = save_adapter(hf_model, adapters[f"a{i}"], i, r)
+    # three adapters over two slots, so a batch mixing them swaps one out, sequences without one see the base model
+    prompts = [list(range(i, i + 20 + 7 * i)) for i in range(6)] + [list(range(20))]
+    lora_ids = [None, "a0", "a1", "a2", "a0", None, "a2"]
+    outputs = run_in_process(generate, path, adapters, prompts, lora_ids, tp_size)
+    base_state = {k: v.clone() for k, v in hf_model.state_dict().items()}
+    base_outputs = run_in_process(generate, path, adapters, prompts, [None] * len(prompts), tp_size)
+    assert all((output != base) == (lora_id is not None) for output, base, lora_id in zip(outputs, base_outputs, lora_ids))
+    for prompt, lora_id, output in zip(prompts, lora_ids, outputs):
+        state = {k: v.clone() for k, v in base_state.items()}
+        for name, delta in deltas.get(lora_id, {}).items():
+            state[name] += delta
+        hf_model.load_state_dict(state)
+        reference = hf_model.generate(torch.tensor([prompt]), max_new_tokens=8, do_sample=False)
+        assert output == reference[0, len(prompt):].tolist(), lora_id
+    hf_model.load_state_dict(base_state)
@@ -0,0 +1,37 @@
+import json
+import os
+import torch
+from transformers import Qwen3Config, Qwen3MoeConfig
+
+from nanovllm.config import Config
+from nanovllm.engine.llm_engine import LLMEngine
+from nanovllm.utils.memory_profiler import Workload, activation_bytes, cache_dir
+
+SMALL = dict(hidden_size=256, intermediate_size=1024, num_hidden_layers=2, num_attention_heads=4, num_key_value_heads=2,
+             head_dim=64, vocab_size=1000, torch_dtype=torch.bfloat16)
+
+
+def test_moe_activations_use_expert_size():
+    dense = Qwen3Config(**SMALL)
+    moe = Qwen3MoeConfig(**SMALL, num_experts=8, num_experts_per_tok=2, moe_intermediate_size=128)
+    assert activation_bytes(moe, 1024, 1) < activation_bytes(dense, 1024, 1)
+    moe_with_dense = Qwen3MoeConfig(**SMALL, num_experts=8, num_experts_per_tok=2, moe_intermediate_size=128, mlp_only_layers=[0])
+    assert activation_bytes(moe_with_dense, 1024, 1) == activation_bytes(dense, 1024, 1)
+
+
+def test_engine_start_reads_cached_profile(tmp_path, monkeypatch):
+    monkeypatch.setenv("NANOVLLM_CACHE_DIR", str(tmp_path))
+    make_config = lambda: Config("tiny", hf_config=Qwen3Config(**SMALL), device="cpu", max_model_len=1024,
+                                 kv_cache_profiling="analytical", profile_workload=Workload(2000, 500))
+    config = make_config()
+    LLMEngine.apply_memory_profile(config)
+    assert config.kvcache_block_size == 256 and config.max_num_batched_tokens >= 1024
+    [path] = [os.path.join(root, name) for root, _, names in os.walk(cache_dir()) for name in names]
+    with open(path) as f:
+        profile = json.load(f)
+    profile.update(kvcache_block_size=512, max_num_seqs=7, max_num_batched_tokens=4096)
+    with open(path, "w") as f:
+        json.dump(profile, f)
+    config = make_config()
+    LLMEngine.apply_memory_profile(config)
+    assert (config.kvcache_block_size, config.max_num_seqs, config.max_num_batched_tokens) == (512, 7, 4096)
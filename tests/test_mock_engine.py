@@ -0,0 +1,30 @@
+from transformers import Qwen3Config
+
+from nanovllm.config import Config
+from nanovllm.engine.mock_model_runner import MockLLMEngine
+from nanovllm.sampling_params import SamplingParams
+
+
+def make_engine(**kwargs) -> MockLLMEngine:
+    config = Config("tiny", hf_config=Qwen3Config(vocab_size=320), attention_backend="sdpa", kvcache_block_size=16,
+                    num_kvcache_blocks=64, max_model_len=256, max_num_batched_tokens=256, **kwargs)
+    return MockLLMEngine(config)
+
+
+def test_generate_without_tokenizer():
+    llm = make_engine(tokenizer_batch_size=2)
+    prompts = [[1, 2, 3], "abc", [4] * 20, [5, 6]]
+    outputs = llm.generate(prompts, SamplingParams(max_tokens=4, ignore_eos=True), use_tqdm=False)
+    llm.exit()
+    assert len(outputs) == len(prompts)
+    assert all(output["text"] is None and len(output["token_ids"]) == 4 for output in outputs)
+
+
+def test_prefill_steps_count_no_decode_tokens():
+    llm = make_engine()
+    llm.generate([[1, 2, 3], [4, 5]], SamplingParams(max_tokens=4, ignore_eos=True), use_tqdm=False)
+    stats = llm.get_stats()
+    llm.exit()
+    # one prefill step for both prompts, then three decode steps of two sequences
+    assert stats["prefill_tokens_total"] == 5
+    assert stats["decode_tokens_total"] == 6
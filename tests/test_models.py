@@ -0,0 +1,47 @@
+import random
+import pytest
+import torch
+
+from nanovllm import LLM, SamplingParams
+
+TINY_CONFIGS = {
+    "qwen3": ("qwen3", {}),
+    "qwen3-yarn": ("qwen3", dict(rope_parameters=dict(rope_type="yarn", rope_theta=10000.0, factor=4.0,
+                                                      original_max_position_embeddings=256))),
+    "llama": ("llama", dict(attention_bias=True, mlp_bias=True)),
+    "llama-linear": ("llama", dict(rope_parameters=dict(rope_type="linear", rope_theta=10000.0, factor=2.0))),
+    "llama-dynamic": ("llama", dict(rope_parameters=dict(rope_type="dynamic", rope_theta=10000.0, factor=2.0))),
+    "llama3": ("llama", dict(rope_parameters=dict(rope_type="llama3", rope_theta=500000.0, factor=8.0, low_freq_factor=1.0,
+                                                  high_freq_factor=4.0, original_max_position_embeddings=64))),
+    "mistral": ("mistral", dict(sliding_window=4096)),
+    "qwen3-moe": ("qwen3_moe", dict(moe_intermediate_size=32, num_experts=8, num_experts_per_tok=2, norm_topk_prob=True,
+                                    mlp_only_layers=[1])),
+}
+
+
+def generate(path: str, prompts: list[list[int]], tp_size: int) -> list[list[int]]:
+    llm = LLM(path, device="cpu", tensor_parallel_size=tp_size, max_model_len=1024, max_num_batched_tokens=2048)
+    outputs = llm.generate(prompts, SamplingParams(temperature=1e-6, max_tokens=16, ignore_eos=True), use_tqdm=False)
+    llm.exit()
+    return [output["token_ids"] for output in outputs]
+
+
+@pytest.mark.parametrize("name", list(TINY_CONFIGS))
+def test_model_matches_transformers(tiny_model, run_in_process, name):
+    model_type, overrides = TINY_CONFIGS[name]
+    path, hf_model = tiny_model(model_type, **overrides)
+    rng = random.Random(0)
+    # up to 300 tokens, past the original context of the scaled rope configs
+    prompts = [[rng.randrange(256) for _ in range(rng.randint(5, 300))] for _ in range(4)]
+    outputs = run_in_process(generate, path, prompts, 1)
+    for prompt, output in zip(prompts, outputs):
+        reference = hf_model.generate(torch.tensor([prompt]), max_new_tokens=16, do_sample=False)
+        assert output == reference[0, len(prompt):].tolist()
+
+
+@pytest.mark.parametrize("name", ["llama", "qwen3-moe"])
+def test_tensor_parallel_model_matches_single_rank(tiny_model, run_in_process, name):
+    model_type, overrides = TINY_CONFIGS[name]
+    path, _ = tiny_model(model_type, **overrides)
+    prompts = [list(range(1, 50)), [9, 8, 7]]
+    assert run_in_process(generate, path, prompts, 2) == run_in_process(generate, path, prompts, 1)
@@ -0,0 +1,46 @@
+import pytest
+import torch
+
+from nanovllm import LLM, SamplingParams
+from nanovllm.utils.parallel_state import partition_layers, split_micro_batches
+
+
+@pytest.mark.parametrize("num_layers,pp_size", [(4, 2), (5, 2), (7, 3), (10, 4), (3, 3)])
+def test_partition_layers(num_layers, pp_size):
+    ranges = [partition_layers(num_layers, pp_size, pp_rank) for pp_rank in range(pp_size)]
+    assert ranges[0][0] == 0 and ranges[-1][1] == num_layers
+    assert all(prev[1] == next[0] for prev, next in zip(ranges, ranges[1:]))
+    sizes = [end - start for start, end in ranges]
+    assert max(sizes) - min(sizes) <= 1
+    # the first and last stages run the embedding and the lm_head, so they get the smaller shares
+    assert sizes[0] == sizes[-1] == min(sizes) or pp_size == 2 and num_layers % 2
+
+
+@pytest.mark.parametrize("num_tokens,num_micro_batches", [([5] * 8, 2), ([100, 1, 1, 1], 2), ([1, 1, 1, 100], 3),
+                                                          ([7], 4), ([3, 9, 2, 8, 4], 4)])
+def test_split_micro_batches(num_tokens, num_micro_batches):
+    ranges = split_micro_batches(num_tokens, num_micro_batches)
+    assert len(ranges) == min(num_micro_batches, len(num_tokens))
+    assert ranges[0][0] == 0 and ranges[-1][1] == len(num_tokens)
+    assert all(start < end for start, end in ranges)
+    assert all(prev[1] == next[0] for prev, next in zip(ranges, ranges[1:]))
+    if num_tokens == [5] * 8:
+        assert ranges == [(0, 4), (4, 8)]
+
+
+def generate(path: str, prompts: list[list[int]], tp_size: int, pp_size: int) -> list[list[int]]:
+    llm = LLM(path, device="cpu", tensor_parallel_size=tp_size, pipeline_parallel_size=pp_size,
+              max_model_len=256, max_num_batched_tokens=256)
+    outputs = llm.generate(prompts, SamplingParams(temperature=1e-6, max_tokens=8, ignore_eos=True), use_tqdm=False)
+    llm.exit()
+    return [output["token_ids"] for output in outputs]
+
+
+@pytest.mark.parametrize("tp_size,pp_size", [(1, 2), (2, 2)])
+def test_pipeline_parallel_engine_matches_transformers(tiny_model, run_in_process, tp_size, pp_size):
+    path, hf_model = tiny_model(num_hidden_layers=3)
+    prompts = [list(range(1, 40)), [7, 8, 9], list(range(200, 100, -2)), [42] * 17]
+    outputs = run_in_process(generate, path, prompts, tp_size, pp_size)
+    for prompt, output in zip(prompts, outputs):
+        reference = hf_model.generate(torch.tensor([prompt]), max_new_tokens=8, do_sample=False)
+        assert output == reference[0, len(prompt):].tolist()
@@ -0,0 +1,65 @@
+import random
+
+from nanovllm import DataParallelLLM, SamplingParams
+from nanovllm.engine.block_manager import BlockManager
+from nanovllm.engine.router import Router, prefix_hashes
+from nanovllm.engine.sequence import Sequence
+
+BLOCK_SIZE = 16
+
+
+def test_prefix_hashes_match_block_manager():
+    Sequence.block_size = BLOCK_SIZE
+    block_manager = BlockManager(16, BLOCK_SIZE)
+    token_ids = list(range(3 * BLOCK_SIZE + 5))
+    for sampling_params in [SamplingParams(), SamplingParams(lora_id="a"), SamplingParams(sliding_window=32, num_sink_tokens=4)]:
+        seq = Sequence(token_ids, sampling_params)
+        block_manager.allocate(seq)
+        seed = BlockManager.hash_seed(sampling_params.lora_id, sampling_params.sliding_window, sampling_params.num_sink_tokens)
+        assert prefix_hashes(token_ids, BLOCK_SIZE, seed) == [block_manager.blocks[i].hash for i in seq.block_table[:3]]
+        block_manager.deallocate(seq)
+
+
+def test_router_prefers_cached_prefix_then_load():
+    router = Router([64, 64], BLOCK_SIZE)
+    prefix = list(range(4 * BLOCK_SIZE))
+    i, cost = router.route(prefix + [1], 8)
+    router.finish(i, cost)
+    # the prefix is cached on replica i only, prompts sharing it go there, others to the idle replica
+    assert router.route(prefix + [2], 8)[0] == i
+    j, _ = router.route(list(range(1000, 1000 + 4 * BLOCK_SIZE)), 8)
+    assert j != i
+    # once replica i has far more pending work, the prefix is recomputed on the other one
+    assert router.route(prefix + [3], 1000)[0] == i
+    assert router.route(prefix + [4], 8)[0] == j
+    # a replica reporting too few free blocks is only used when no other has room
+    router = Router([64, 64], BLOCK_SIZE)
+    i, cost = router.route(prefix + [1], 8)
+    router.finish(i, cost)
+    router.report(i, 0)
+    assert router.route(prefix + [2], 8)[0] != i
+
+
+def run_data_parallel(path: str, prompts: list[list[int]], random_routing: bool) -> tuple[list[dict], dict]:
+    llm = DataParallelLLM(path, data_parallel_size=2, mock=True, attention_backend="sdpa", num_kvcache_blocks=48,
+                          kvcache_block_size=BLOCK_SIZE, max_model_len=256, max_num_batched_tokens=512)
+    if random_routing:
+        rng = random.Random(0)
+        route = llm.router.route
+        llm.router.route = lambda *args: (rng.randrange(2), route(*args)[1])
+    outputs = llm.generate(prompts, SamplingParams(max_tokens=8, ignore_eos=True), use_tqdm=False)
+    stats = llm.get_stats()
+    llm.exit()
+    return outputs, stats
+
+
+def test_data_parallel_mock_engines(tiny_model):
+    path, _ = tiny_model()
+    rng = random.Random(0)
+    prefixes = [[rng.randrange(256) for _ in range(4 * BLOCK_SIZE)] for _ in range(6)]
+    prompts = [rng.choice(prefixes) + [rng.randrange(256) for _ in range(rng.randint(1, 20))] for _ in range(60)]
+    outputs, stats = run_data_parallel(path, prompts, False)
+    assert all(len(output["token_ids"]) == 8 for output in outputs)
+    assert all(replica["prefix_cache_queries_total"] > 0 for replica in stats["replicas"])
+    _, random_stats = run_data_parallel(path, prompts, True)
+    assert stats["prefix_cache_hit_rate"] > random_stats["prefix_cache_hit_rate"] + 0.05
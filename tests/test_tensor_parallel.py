@@ -0,0 +1,93 @@
+import socket
+from unittest.mock import patch
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from nanovllm.utils.parallel_state import init_parallel_state, get_num_comm_chunks, MIN_COMM_CHUNK_TOKENS
+from nanovllm.layers.linear import RowParallelLinear
+from nanovllm.layers.embed_head import VocabParallelEmbedding
+from nanovllm.layers.sampler import Sampler, VocabParallelSampler
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("localhost", 0))
+        return s.getsockname()[1]
+
+
+def run_distributed(worker, world_size: int = 2, *args):
+    # runs worker(rank, world_size, *args) on every rank of a gloo group, a failing rank fails the test
+    mp.spawn(init_worker, (worker, world_size, free_port(), args), nprocs=world_size)
+
+
+def init_worker(rank: int, worker, world_size: int, port: int, args):
+    dist.init_process_group("gloo", f"tcp://localhost:{port}", world_size=world_size, rank=rank)
+    try:
+        with torch.inference_mode():
+            worker(rank, world_size, *args)
+    finally:
+        dist.destroy_process_group()
+
+
+def vocab_parallel_sampling_worker(rank: int, world_size: int):
+    init_parallel_state(world_size, 1)
+    num_seqs, vocab_size = 16, 96
+    shard_size = vocab_size // world_size
+    start = rank * shard_size
+    torch.manual_seed(0)
+    logits = torch.randn(num_seqs, vocab_size) * 3
+    temperatures = torch.rand(num_seqs) + 0.1
+    noise = torch.empty(num_seqs, vocab_size).exponential_(1)
+
+    def exponential_(self, lambd=1.):
+        # every sampler draws the same noise for the vocab entries it sees
+        return self.copy_(noise if self.size(-1) == vocab_size else noise[:, start:start + shard_size])
+
+    with patch.object(torch.Tensor, "exponential_", exponential_):
+        expected = Sampler()(logits.clone(), temperatures)
+        tokens = VocabParallelSampler(start)(logits[:, start:start + shard_size].clone(), temperatures)
+    assert torch.equal(tokens, expected)
+
+
+def test_vocab_parallel_sampling_matches_sampler():
+    run_distributed(vocab_parallel_sampling_worker, 2)
+
+
+def comm_overlap_worker(rank: int, world_size: int):
+    init_parallel_state(world_size, 1)
+    input_size, output_size, vocab_size = 64, 32, 128
+    num_tokens = 4 * MIN_COMM_CHUNK_TOKENS
+    torch.manual_seed(0)
+    down_proj = RowParallelLinear(input_size, output_size)
+    down_proj.weight_loader(down_proj.weight, torch.randn(output_size, input_size))
+    embed = VocabParallelEmbedding(vocab_size, output_size)
+    embed.weight_loader(embed.weight, torch.randn(vocab_size, output_size))
+    x = torch.randn(num_tokens, input_size)
+    input_ids = torch.randint(0, vocab_size, (num_tokens,))
+    shard_size = input_size // world_size
+    x_shard = x[:, rank * shard_size:(rank + 1) * shard_size].contiguous()
+    torch.testing.assert_close(down_proj(x_shard), x @ down_proj_weight(down_proj, world_size).T)
+    torch.testing.assert_close(embed(input_ids), embed_weight(embed, world_size)[input_ids])
+    reference = down_proj(x_shard), embed(input_ids)
+    for num_chunks in (2, 4):
+        init_parallel_state(world_size, 1, num_chunks)
+        assert get_num_comm_chunks(num_tokens) == num_chunks
+        torch.testing.assert_close(down_proj(x_shard), reference[0])
+        torch.testing.assert_close(embed(input_ids), reference[1])
+
+
+def down_proj_weight(down_proj: RowParallelLinear, world_size: int) -> torch.Tensor:
+    shards = [torch.empty_like(down_proj.weight) for _ in range(world_size)]
+    dist.all_gather(shards, down_proj.weight)
+    return torch.cat(shards, 1)
+
+
+def embed_weight(embed: VocabParallelEmbedding, world_size: int) -> torch.Tensor:
+    shards = [torch.empty_like(embed.weight) for _ in range(world_size)]
+    dist.all_gather(shards, embed.weight)
+    return torch.cat(shards)
+
+
+def test_chunked_all_reduce_matches_unchunked():
+    run_distributed(comm_overlap_worker, 2)
@@ -1,77 +1,28 @@
 # visualize_blocks.py (Final Clean Version for Prefix Sharing)
+import sys
 import json
-import re
-import os
 
 
-def parse_output_file(filename):
-    with open(filename, 'r') as f:
-        lines = f.readlines()
-
-    # 1. Skip first two lines (KV cache allocation info)
-    lines = lines[2:]
-
-    # 2. Parse third line: "5 256" → num_blocks
-    first_data_line = lines[0].strip()
-    match = re.match(r'(\d+)\s+(\d+)', first_data_line)
-    if not match:
-        raise ValueError(f"Expected format 'num_kv_cache_block total_tokens' but got: {first_data_line}")
-    num_kv_cache_block = int(match.group(1))
-    print(f"🔢 Auto-detected num_blocks = {num_kv_cache_block}")
-
-    # 3. Next line: {"num_seqs": 2} → optional, for info
-    second_data_line = lines[1].strip()
-    num_seqs = 1  # default
-    try:
-        if second_data_line.startswith('{') and '"num_seqs"' in second_data_line:
-            meta = json.loads(second_data_line)
-            num_seqs = meta.get("num_seqs", 1)
-            print(f"🧬 Detected num_seqs = {num_seqs}")
-    except Exception as e:
-        print(f"⚠️ Could not parse metadata line: {second_data_line}, error: {e}")
-
-    # 4. Remove last line (summary) and first two data lines we just used
-    lines = lines[2:-1]
-
-    # Rejoin for splitting by separator
-    content = ''.join(lines)
-
-    # Split steps by 20+ dashes
-    steps = re.split(r'-{20,}', content)
-    steps = [step.strip() for step in steps if step.strip()]
-
+def parse_trace_file(filename):
+    # trace written by LLM(..., trace_file=filename)
+    num_kv_cache_block = 0
     all_steps = []
     all_seq_ids = set()
-
-    for step in steps:
-        lines = step.strip().splitlines()
-        step_data = {}  # block_id -> set(seq_ids)
-        for line in lines:
-            line = line.strip()
-            if not line or not re.match(r'\d+\s+\[.*\]', line):
-                continue
-            try:
-                match = re.match(r'(\d+)\s+(\[.*\])', line)
-                if not match:
-                    continue
-                seq_id = int(match.group(1))
+    with open(filename) as f:
+        events = [json.loads(line) for line in f if line.strip()]
+    for event in events:
+        if event["type"] == "init":
+            num_kv_cache_block = event["num_blocks"]
+            print(f"🔢 Auto-detected num_blocks = {num_kv_cache_block}")
+        elif event["type"] == "step":
+            step_data = {}  # block_id -> set(seq_ids)
+            for seq_id, block_list in event["block_tables"].items():
+                seq_id = int(seq_id)
                 all_seq_ids.add(seq_id)
-                block_str = match.group(2)
-                block_list = list(map(int, re.findall(r'-?\d+', block_str)))
                 for block_idx in block_list:
-                    if block_idx != -1:
-                        if block_idx not in step_data:
-                            step_data[block_idx] = set()
-                        step_data[block_idx].add(seq_id)
-            except Exception as e:
-                print(f"⚠️ Error parsing line: {line}, error: {e}")
-                continue
-        all_steps.append(step_data)
-
-    max_seq_id = max(all_seq_ids) if all_seq_ids else 0
-    min_seq_id = min(all_seq_ids) if all_seq_ids else 0
+                    step_data.setdefault(block_idx, set()).add(seq_id)
+            all_steps.append(step_data)
     print(f"🆔 Observed seq_ids: {sorted(all_seq_ids)}")
-
     return all_steps, num_kv_cache_block, sorted(all_seq_ids)
 
 
@@ -382,7 +333,7 @@ def generate_html_visualization(all_steps, num_blocks, seq_ids):
 
 
 if __name__ == "__main__":
-    all_steps, num_blocks, seq_ids = parse_output_file("output.txt")
+    all_steps, num_blocks, seq_ids = parse_trace_file(sys.argv[1] if len(sys.argv) > 1 else "trace.jsonl")
     print(f"📊 總共解析 {len(all_steps)} 個 steps")
     print(f"👥 涉及序列: {seq_ids}")
     generate_html_visualization(all_steps, num_blocks, seq_ids)
\ No newline at end of file